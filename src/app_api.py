@@ -4,6 +4,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from loggate import getLogger, setup_logging
 
 from config import get_config, log_level, to_bool
+from endpoints import NEXT_CURSOR_HEADER
+from lib import metrics
 from lib.db import DBConnection
 from lib.helper import dicts_val, get_yaml
 from model.server import WGServer
@@ -39,6 +41,7 @@ app.add_middleware(
     allow_credentials=get_config('CORS_ALLOW_CREDENTIALS', wrapper=to_bool),
     allow_methods=get_config('CORS_ALLOW_METHODS').split(','),
     allow_headers=get_config('CORS_ALLOW_HEADERS').split(','),
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 if get_config('API_ENABLED', wrapper=to_bool):
@@ -54,6 +57,12 @@ if get_config('API_ENABLED', wrapper=to_bool):
     app.include_router(tool_router, prefix="/api/tool")
 
 
+if metrics.METRICS:
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/", include_in_schema=False)
 async def root():
     return Response('Hello')
@@ -3,6 +3,7 @@ import signal
 from loggate import getLogger, setup_logging
 
 from config import get_config, log_level
+from lib import metrics
 from lib.db import DBConnection
 from lib.helper import dicts_val, get_yaml
 from model.server import WGServer
@@ -47,6 +48,8 @@ def main():
         loop.add_signal_handler(
             sig, lambda s=sig: asyncio.create_task(graceful_shutdown(loop, s)))
     conn = DBConnection()
+    if metrics.METRICS and metrics.METRICS_PORT:
+        loop.run_until_complete(metrics.start_http_server())
     loop.run_until_complete(conn.start())
     try:
         loop.run_until_complete(wg_server.start_server(conn))
@@ -20,7 +20,34 @@ DEFAULT_CONFIG = {
     'CORS_ALLOW_HEADERS': '*',  # comma separated
     'CORS_ALLOW_CREDENTIALS': 'yes',
     'WIREGUARD_CONFIG_FOLDER': '/config',
+    'WIREGUARD_RECONCILE_INTERVAL': 300,   # seconds, 0 = disabled
+    'WIREGUARD_EVENT_DELAY': 0.1,   # seconds, events of one interface are coalesced within this window
+    'WIREGUARD_EVENT_MAX_DELAY': 1,   # seconds, max latency of coalesced events
+    'WIREGUARD_DRIFT_INTERVAL': 60,    # seconds, kernel state is compared with memory, 0 = disabled
+    'WIREGUARD_SET_CHUNK': 200,     # peers changed by one `wg set` command
+    'WIREGUARD_BACKEND': 'subprocess',   # kernel operations: subprocess (wg, ip), netlink or fake (in memory)
+    'WIREGUARD_INCREMENTAL_LIMIT': 50,  # more coalesced peer events make full synchronization
+    'WIREGUARD_STARTUP_CONCURRENCY': 8,     # interfaces processed in parallel on startup (and files written on stop)
+    'WIREGUARD_WRITE_DELAY': 5,     # seconds, write-behind of configuration files, 0 = written immediately
+    'WIREGUARD_STATS_INTERVAL': 10,     # seconds between reads of peer stats (`wg show all dump`), 0 = disabled
+    'WIREGUARD_STATS_FLUSH_INTERVAL': 60,   # seconds, changed peer stats are stored to the database
+    'WIREGUARD_STATS_BATCH': 5000,  # peer stats stored by one query
+    'WIREGUARD_DEFAULT_MTU': 1420,  # MTU set when it is removed from the interface, 0 = restart by wg-quick
+    'CHANGE_LOG': 'no',     # yes = changes are read from change_log table (wireguard_pg.change_log = on)
+    'CHANGE_LOG_BATCH': 1000,
+    'CHANGE_LOG_RETENTION': 24,     # hours, 0 = records are not deleted
+    'CHANGE_LOG_GAP_TIMEOUT': 300,  # seconds, skipped ids are read again (transactions committed out of order)
+    'CMD_TIMEOUT': 30,  # seconds
+    'CMD_CONCURRENCY': 8,   # max number of parallel running commands (wg, ip, wg-quick)
+    'WG_KEYGEN': 'native',  # native = keys are generated in the process (wg binary is the fallback), wg = by wg binary
+    'QRCODE_WORKERS': 2,    # processes generating QR codes and exports, 0 = thread of the API process
+    'QRCODE_CACHE_SIZE': 1024,  # number of cached QR codes
+    'CLIENT_CONFIG_CACHE_SIZE': 1024,   # number of cached client configurations
+    'EXPORT_CHUNK': 100,    # peers rendered by one task of the export
+    'EXPORT_CONCURRENCY': 4,    # tasks of the export processed at once
     'API_ENABLED': 'no',
+    'METRICS': 'no',    # yes = metrics in the Prometheus format on /metrics
+    'METRICS_PORT': 9100,   # standalone metrics listener of app_noapi.py, 0 = disabled
     'LOG_LEVEL': 'INFO',
 }
 
@@ -1,10 +1,15 @@
+from typing import AsyncIterator
 from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 from starlette.status import HTTP_403_FORBIDDEN
 import loggate
 from config import get_config
+from lib.db import DBPool
 
 
 TOKEN = get_config('API_ACCESS_TOKEN')
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+NDJSON_CHUNK = 100     # lines sent by one write
 logger = loggate.get_logger('access')
 
 
@@ -21,3 +26,30 @@ def check_token(token: str):
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Not authenticated"
         )
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    The client has the current version (header If-None-Match).
+    """
+    if not (header := request.headers.get('If-None-Match')):
+        return False
+    return any(it.strip() in ('*', etag) for it in header.split(','))
+
+
+def ndjson_response(pool: DBPool, logger_name: str, iterate, *args, **kwargs) -> StreamingResponse:
+    """
+    Stream objects of `iterate(db, *args, **kwargs)` as newline delimited JSON.
+    The connection is held till the end of the response.
+    """
+    async def stream() -> AsyncIterator[str]:
+        async with pool.acquire_with_log(logger_name) as db:
+            lines = []
+            async for obj in iterate(db, *args, **kwargs):
+                lines.append(obj.model_dump_json())
+                if len(lines) >= NDJSON_CHUNK:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
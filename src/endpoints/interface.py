@@ -1,11 +1,16 @@
-from typing import List
+from typing import List, Optional
 import loggate
-from fastapi import APIRouter, Depends, Security, status
+from fastapi import APIRouter, Depends, Query, Response, Security, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from endpoints import check_token, get_token
+from config import to_bool
+from endpoints import NEXT_CURSOR_HEADER, check_token, get_token, ndjson_response
 from model.interface import InterfaceDB, Interface, InterfaceUpdate, InterfaceCreate
+from model.export import ARCHIVE_FORMATS, export_client_configs
+from model.peer_stats import PeerStats, PeerStatsDB
 from lib.db import db_pool, DBPool
+from model.base import CursorQueryParams, Filters
 
 router = APIRouter(tags=["interface"])
 sql_logger = 'sql.interface'
@@ -13,11 +18,30 @@ logger = loggate.getLogger('Interface')
 
 
 @router.get("/", response_model=List[Interface])
-async def gets(pool: DBPool = Depends(db_pool),
+async def gets(response: Response,
+               server_name: Optional[str] = None,
+               enabled: Optional[bool] = None,
+               name: Optional[str] = Query(None, description='Prefix of the name'),
+               format: str = Query('json', pattern='^(json|ndjson)$'),
+               page: CursorQueryParams = Depends(),
+               pool: DBPool = Depends(db_pool),
                token: bool = Security(get_token)):
+    """
+    Page of objects sorted by id, the id for the next page is in the header X-Next-Cursor.
+    The format ndjson streams all objects (newline delimited JSON) without pagination.
+    """
     check_token(token)
+    filters = Filters() \
+        .add('f."server_name" = {}', server_name) \
+        .add('f."enabled" = {}', enabled) \
+        .prefix('f."interface_name"', name)
+    if format == 'ndjson':
+        return ndjson_response(pool, sql_logger, InterfaceDB.iterate, filters.query, *filters.args)
     async with pool.acquire_with_log(sql_logger) as db:
-        return await InterfaceDB.gets(db)
+        objs = await InterfaceDB.gets_after(db, filters.query, *filters.args, after=page.after, limit=page.limit)
+    if len(objs) == page.limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(objs[-1].id)
+    return objs
 
 
 @router.get("/{interface_id}", response_model=Interface)
@@ -29,6 +53,51 @@ async def get(interface_id: int,
         return await InterfaceDB.get(db, interface_id)
 
 
+@router.get("/{interface_id}/stats", response_model=List[PeerStats])
+async def gets_stats(response: Response,
+                     interface_id: int,
+                     page: CursorQueryParams = Depends(),
+                     pool: DBPool = Depends(db_pool),
+                     token: bool = Security(get_token)):
+    """
+    Page of stats of the interface peers sorted by peer id, the id for the next page is in the header X-Next-Cursor.
+    """
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db:
+        objs = await PeerStatsDB.gets_after(
+            db, 'f."interface_id" = $1', interface_id, after=page.after, limit=page.limit
+        )
+    if len(objs) == page.limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(objs[-1].id)
+    return objs
+
+
+@router.get("/{interface_id}/export", response_class=StreamingResponse,
+            responses={200: {'content': {it: {} for it in ARCHIVE_FORMATS.values()}}})
+async def export(interface_id: int,
+                 format: str = Query('zip', pattern='^(zip|tar|tar\\.gz)$'),
+                 qrcode: str = "no",
+                 enabled: Optional[bool] = None,
+                 pool: DBPool = Depends(db_pool),
+                 token: bool = Security(get_token)):
+    """
+    Archive of client configurations (and QR codes) of all peers, it is streamed during the rendering.
+    The private keys are not stored, the configurations have a placeholder.
+    """
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db:
+        iface = await InterfaceDB.get(db, interface_id, _raise=True)
+
+    async def stream():
+        async with pool.acquire_with_log(sql_logger) as db:
+            async for data in export_client_configs(db, iface, format, to_bool(qrcode), enabled):
+                yield data
+    return StreamingResponse(
+        stream(), media_type=ARCHIVE_FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="{iface.interface_name}.{format}"'}
+    )
+
+
 @router.put("/{interface_id}", response_model=Interface)
 async def update(interface_id: int,
                  update: InterfaceUpdate,
@@ -1,23 +1,98 @@
-from typing import List
+from typing import List, Optional
+from asyncpg import Connection
 import loggate
-from fastapi import APIRouter, Depends, Security, status
+from fastapi import APIRouter, Body, Depends, Query, Request, Response, Security, status
+from fastapi.responses import PlainTextResponse
 
-from config import to_bool
-from endpoints import check_token, get_token
+from config import get_config, to_bool
+from lib.helper import QRCODE_FORMATS, LRUCache, get_qrcode_async
+from endpoints import NEXT_CURSOR_HEADER, check_token, etag_matches, get_token, ndjson_response
 from model.peer import PeerCreatePrivateKey, PeerCreated, PeerDB, Peer, PeerUpdate, PeerCreate
+from model.peer_stats import PeerStats, PeerStatsDB
 from lib.db import db_pool, DBPool
+from model.base import CursorQueryParams, Filters, ObjectNotFound
 
 router = APIRouter(tags=["peer"])
 sql_logger = 'sql.peer'
 logger = loggate.getLogger('Peer')
+BULK_LIMIT = 10000
+CLIENT_CONFIG_CACHE_SIZE = get_config('CLIENT_CONFIG_CACHE_SIZE', wrapper=int)
+# ETag => rendered client configuration
+client_config_cache = LRUCache(CLIENT_CONFIG_CACHE_SIZE)
+
+
+class PeerBulkUpdate(PeerUpdate):
+    id: int
+
+
+async def get_cached_client_config(db: Connection, peer_id: int, etag: str) -> str:
+    if (config := client_config_cache.get(etag)) is None:
+        peer = await PeerDB.get(db, peer_id, _raise=True)
+        config = await PeerDB.get_client_config(db, peer)
+        client_config_cache.put(etag, config)
+    return config
+
+
+async def get_client_config_etag(db: Connection, peer_id: int) -> str:
+    if not (etag := await PeerDB.get_client_config_etag(db, peer_id)):
+        raise ObjectNotFound(f'Object PeerDB not found: {peer_id}.')
+    return etag
 
 
 @router.get("/", response_model=List[Peer])
-async def gets(pool: DBPool = Depends(db_pool),
+async def gets(response: Response,
+               interface_id: Optional[int] = None,
+               enabled: Optional[bool] = None,
+               name: Optional[str] = Query(None, description='Prefix of the name'),
+               format: str = Query('json', pattern='^(json|ndjson)$'),
+               page: CursorQueryParams = Depends(),
+               pool: DBPool = Depends(db_pool),
                token: bool = Security(get_token)):
+    """
+    Page of objects sorted by id, the id for the next page is in the header X-Next-Cursor.
+    The format ndjson streams all objects (newline delimited JSON) without pagination.
+    """
     check_token(token)
+    filters = Filters() \
+        .add('f."interface_id" = {}', interface_id) \
+        .add('f."enabled" = {}', enabled) \
+        .prefix('f."name"', name)
+    if format == 'ndjson':
+        return ndjson_response(pool, sql_logger, PeerDB.iterate, filters.query, *filters.args)
     async with pool.acquire_with_log(sql_logger) as db:
-        return await PeerDB.gets(db)
+        objs = await PeerDB.gets_after(db, filters.query, *filters.args, after=page.after, limit=page.limit)
+    if len(objs) == page.limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(objs[-1].id)
+    return objs
+
+
+@router.post("/bulk", response_model=List[PeerCreated],
+             status_code=status.HTTP_201_CREATED)
+async def create_many(creates: List[PeerCreate] = Body(max_length=BULK_LIMIT),
+                      pool: DBPool = Depends(db_pool),
+                      token: bool = Security(get_token)):
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db, db.transaction():
+        creates = [PeerDB.convert_object(it, PeerCreatePrivateKey) for it in creates]
+        return await PeerDB.create_many(db, creates)
+
+
+@router.put("/bulk", response_model=List[Peer])
+async def update_many(updates: List[PeerBulkUpdate] = Body(max_length=BULK_LIMIT),
+                      pool: DBPool = Depends(db_pool),
+                      token: bool = Security(get_token)):
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db, db.transaction():
+        return await PeerDB.update_many(db, {it.id: it for it in updates})
+
+
+@router.delete("/bulk", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_many(ids: List[int] = Body(max_length=BULK_LIMIT),
+                      pool: DBPool = Depends(db_pool),
+                      token: bool = Security(get_token)):
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db, db.transaction():
+        await PeerDB.delete_many(db, ids)
 
 
 @router.get("/{peer_id}", response_model=Peer)
@@ -29,6 +104,52 @@ async def get(peer_id: int,
         return await PeerDB.get(db, peer_id)
 
 
+@router.get("/{peer_id}/stats", response_model=PeerStats)
+async def get_stats(peer_id: int,
+                    pool: DBPool = Depends(db_pool),
+                    token: bool = Security(get_token)):
+    """
+    The last stored stats of the peer (endpoint, latest handshake, transfer).
+    """
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db:
+        return await PeerStatsDB.get(db, peer_id, _raise=True)
+
+
+@router.get("/{peer_id}/config", response_class=PlainTextResponse)
+async def get_client_config(peer_id: int,
+                            request: Request,
+                            pool: DBPool = Depends(db_pool),
+                            token: bool = Security(get_token)):
+    """
+    Client configuration, the private key is replaced by a placeholder (it is not stored).
+    Repeated downloads are answered by 304 (If-None-Match) or from the cache.
+    """
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db, db.transaction(isolation='repeatable_read', readonly=True):
+        etag = await get_client_config_etag(db, peer_id)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        config = await get_cached_client_config(db, peer_id, etag)
+    return PlainTextResponse(config, headers=headers)
+
+
+@router.get("/{peer_id}/qrcode", response_class=Response,
+            responses={200: {'content': {it[1]: {} for it in QRCODE_FORMATS.values()}}})
+async def get_qrcode(peer_id: int,
+                     format: str = Query('svg', pattern='^(svg|png)$'),
+                     pool: DBPool = Depends(db_pool),
+                     token: bool = Security(get_token)):
+    """
+    QR code of the client configuration, the private key is replaced by a placeholder (it is not stored).
+    """
+    check_token(token)
+    async with pool.acquire_with_log(sql_logger) as db, db.transaction(isolation='repeatable_read', readonly=True):
+        config = await get_cached_client_config(db, peer_id, await get_client_config_etag(db, peer_id))
+    return Response(await get_qrcode_async(config, format), media_type=QRCODE_FORMATS[format][1])
+
+
 @router.put("/{peer_id}", response_model=Peer)
 async def update(peer_id: int,
                  update: PeerUpdate,
@@ -52,9 +173,10 @@ async def delete(peer_id: int,
              status_code=status.HTTP_201_CREATED)
 async def create(create: PeerCreate,
                  drain: str = "no",
+                 qrcode: str = "yes",
                  pool: DBPool = Depends(db_pool),
                  token: bool = Security(get_token)):
     check_token(token)
     async with pool.acquire_with_log(sql_logger) as db, db.transaction():
         create = PeerDB.convert_object(create, PeerCreatePrivateKey)
-        return await PeerDB.create(db, create, _drain=to_bool(drain))
+        return await PeerDB.create(db, create, _drain=to_bool(drain), _qrcode=to_bool(qrcode))
@@ -1,10 +1,11 @@
 from typing import List, Optional
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response
 import loggate
-from fastapi import APIRouter, Security
+from fastapi import APIRouter, Query, Security
 from pydantic import BaseModel
 from endpoints import check_token, get_token
-from lib.helper import get_qrcode, get_wg_preshared_key, get_wg_private_key, get_wg_public_key, render_template
+from lib.helper import get_qrcode_async, get_wg_preshared_key, get_wg_private_key, get_wg_public_key, \
+    get_wg_secret_pairs, render_template_async
 
 router = APIRouter(tags=["tool"])
 sql_logger = 'sql.peer'
@@ -19,8 +20,18 @@ class SecretPair(BaseModel):
 @router.get("/generate_secret_pair", response_model=SecretPair)
 async def get_secret_pair(token: bool = Security(get_token)):
     check_token(token)
-    priv_key = get_wg_private_key()
-    return SecretPair(private_key=priv_key, public_key=get_wg_public_key(priv_key))
+    priv_key = await get_wg_private_key()
+    return SecretPair(private_key=priv_key, public_key=await get_wg_public_key(priv_key))
+
+
+@router.get("/generate_secret_pairs", response_model=List[SecretPair])
+async def get_secret_pairs(count: int = Query(1, ge=1, le=1000),
+                           token: bool = Security(get_token)):
+    check_token(token)
+    return [
+        SecretPair(private_key=priv_key, public_key=pub_key)
+        for priv_key, pub_key in await get_wg_secret_pairs(count)
+    ]
 
 
 class PresharedKey(BaseModel):
@@ -30,7 +41,7 @@ class PresharedKey(BaseModel):
 @router.get("/generate_preshared_key", response_model=PresharedKey)
 async def get_preshared_key(token: bool = Security(get_token)):
     check_token(token)
-    return PresharedKey(preshared_key=get_wg_preshared_key())
+    return PresharedKey(preshared_key=await get_wg_preshared_key())
 
 
 class GenerateConfigInterface(BaseModel):
@@ -63,7 +74,7 @@ class GenerateConfig(BaseModel):
 async def get_client_config(data: GenerateConfig,
                             token: bool = Security(get_token)):
     check_token(token)
-    return render_template(
+    return await render_template_async(
         'client_generator.conf.j2',
         interface=data.interface,
         peers=data.peers
@@ -74,10 +85,9 @@ async def get_client_config(data: GenerateConfig,
 async def get_client_qrcode(data: GenerateConfig,
                             token: bool = Security(get_token)):
     check_token(token)
-    conf = render_template(
+    conf = await render_template_async(
         'client_generator.conf.j2',
         interface=data.interface,
         peers=data.peers
     )
-    buffer = get_qrcode(conf)
-    return StreamingResponse(buffer, media_type="image/png")
+    return Response(await get_qrcode_async(conf), media_type="image/png")
@@ -0,0 +1,63 @@
+"""
+Export client configurations of the interface to the archive.
+
+    python export_configs.py wg0 -o wg0.zip
+    python export_configs.py 1 --format tar.gz --qrcode -o wg0.tar.gz
+"""
+import argparse
+import asyncio
+import sys
+from loggate import getLogger, setup_logging
+
+from config import get_config, log_level
+from lib.db import DBConnection
+from lib.helper import dicts_val, get_yaml
+from model.export import ARCHIVE_FORMATS, export_client_configs
+from model.interface import InterfaceDB
+
+logging_profiles = get_yaml(get_config('LOGGING_DEFINITIONS'))
+if get_config('LOG_LEVEL'):
+    root_profile = dicts_val('profiles.default.loggers.root', logging_profiles)
+    root_profile['level'] = get_config('LOG_LEVEL', wrapper=log_level)
+setup_logging(profiles=logging_profiles)
+
+logger = getLogger('main')
+
+
+async def export(args: argparse.Namespace) -> int:
+    conn = DBConnection()
+    await conn.start_pool()
+    if not conn.pool:
+        return 1
+    try:
+        async with conn.pool.acquire_with_log('sql.export') as db:
+            if args.interface.isdigit():
+                iface = await InterfaceDB.get(db, int(args.interface))
+            else:
+                iface = await InterfaceDB.get(db, 'f."interface_name" = $1', args.interface)
+            if not iface:
+                logger.error('Interface %s does not exist.', args.interface)
+                return 1
+            with open(args.output, 'wb') as fd:
+                async for data in export_client_configs(db, iface, args.format, args.qrcode, args.enabled):
+                    fd.write(data)
+            logger.info('Interface %s was exported to %s.', iface.interface_name, args.output)
+    finally:
+        await conn.stop_pool()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export client configurations of the interface.')
+    parser.add_argument('interface', help='id or name of the interface')
+    parser.add_argument('-f', '--format', choices=list(ARCHIVE_FORMATS.keys()), default='zip')
+    # Logs are written to stdout, so the archive has to be written to the file
+    parser.add_argument('-o', '--output', required=True, help='output file')
+    parser.add_argument('--qrcode', action='store_true', help='add QR codes (PNG)')
+    parser.add_argument('--enabled', action=argparse.BooleanOptionalAction, default=None,
+                        help='only enabled (or disabled) peers')
+    sys.exit(asyncio.run(export(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,18 @@
 import asyncio
+import logging
+import time
 from typing import Callable
 import loggate
 import re
 from pathlib import Path
-from asyncpg import connect, Pool, Connection, UndefinedTableError
+from asyncpg import connect, Pool, Connection, PostgresError, UndefinedTableError
 from asyncpg.connection import LoggedQuery
 from asyncpg.protocol import Record
 from asyncpg.pool import PoolAcquireContext
 
 
 from config import get_config, to_bool
+from lib import metrics
 
 logger = loggate.getLogger('db')
 
@@ -20,30 +23,66 @@ POSTGRES_POOL_MIN_SIZE = get_config('POSTGRES_POOL_MIN_SIZE', wrapper=int)
 POSTGRES_POOL_MAX_SIZE = get_config('POSTGRES_POOL_MAX_SIZE', wrapper=int)
 POSTGRES_CONNECTION_TIMEOUT = get_config('POSTGRES_CONNECTION_TIMEOUT', wrapper=float)
 POSTGRES_CONNECTION_CHECK = get_config('POSTGRES_CONNECTION_CHECK', wrapper=float)
+MIGRATION_LOCK = 0x5747_0000     # key of advisory lock
+MIGRATION_BASELINE = '0001_structure'
+
+
+acquire_duration = metrics.histogram(
+    'db_pool_acquire_seconds', 'Time waiting for a connection of the pool.', ('logger',)
+)
+query_duration = metrics.histogram(
+    'db_query_seconds', 'Duration of database queries.', ('logger',)
+)
+query_errors = metrics.counter(
+    'db_query_errors_total', 'Failed database queries.', ('logger',)
+)
+
+
+class QueryLogger:
+    """
+    Query logger of the connection. Failed queries are always logged,
+    durations are observed only with metrics and queries are logged only in debug.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+
+    def process(self, query: LoggedQuery):
+        if metrics.METRICS:
+            query_duration.observe(query.elapsed, logger=self.logger.name)
+            if query.exception:
+                query_errors.inc(logger=self.logger.name)
+        if query.exception:
+            self.logger.error(query.query, meta={
+                'args': query.args,
+                'elapsed': query.elapsed,
+            })
+        elif self.debug:
+            self.logger.debug(query.query, meta={
+                'args': query.args,
+                'elapsed': query.elapsed,
+            })
 
 
 class DBPoolAcquireContext(PoolAcquireContext):
 
     def __init__(self, pool, timeout, logger):
-        self.logger = logger
+        self.query_logger = QueryLogger(logger)
         self.conn = None
         super().__init__(pool, timeout)
 
-    async def process(self, query: LoggedQuery):
-        fce = self.logger.error if query.exception else self.logger.debug
-        fce(query.query, meta={
-            'args': query.args,
-            'elapsed': query.elapsed,
-        })
-
     async def __aenter__(self) -> Connection:
+        start = time.perf_counter()
         self.conn = await super().__aenter__()
-        self.conn.add_query_logger(self.process)
+        if metrics.METRICS:
+            acquire_duration.observe(time.perf_counter() - start, logger=self.query_logger.logger.name)
+        self.conn.add_query_logger(self.query_logger.process)
         return self.conn
 
     async def __aexit__(self, *exc):
         if self.conn:
-            self.conn.remove_query_logger(self.process)
+            self.conn.remove_query_logger(self.query_logger.process)
         await super().__aexit__()
 
 
@@ -57,6 +96,7 @@ class DBPool(Pool):
 
 class DBConnection:
     startup_callbacks = []
+    reconnect_callbacks = []
     notifications = {}
     singleton = None
 
@@ -72,6 +112,13 @@ class DBConnection:
     def register_startup(cls, fce: Callable):
         cls.startup_callbacks.append(fce)
 
+    @classmethod
+    def register_reconnect(cls, fce: Callable):
+        """
+        Callback is called after the listener reconnects (notifications could be lost).
+        """
+        cls.reconnect_callbacks.append(fce)
+
     @classmethod
     def register_notification(cls, channel: str, fce: Callable):
         cls.notifications[channel] = fce
@@ -79,21 +126,14 @@ class DBConnection:
     @classmethod
     def db_logger(cls, logger_name: str, db: Connection):
         #  @Deprecated
-        log = loggate.get_logger(logger_name)
-
-        async def process(query: LoggedQuery):
-            fce = log.error if query.exception else log.debug
-            fce(query.query, meta={
-                'args': query.args,
-                'elapsed': query.elapsed,
-            })
+        query_logger = QueryLogger(loggate.get_logger(logger_name))
 
         class Log:
             async def __aenter__(self):
-                db.add_query_logger(process)
+                db.add_query_logger(query_logger.process)
 
             async def __aexit__(self, *exc):
-                db.remove_query_logger(process)
+                db.remove_query_logger(query_logger.process)
         return Log()
 
     def __init__(self) -> None:
@@ -101,35 +141,84 @@ class DBConnection:
         self.pool: DBPool = None
         self.checking_task = None
         DBConnection.singleton = self
+        metrics.gauge(
+            'db_pool_connections', 'Connections of the pool by state.', ('state',)
+        ).callback = self.get_pool_stats
+
+    def get_pool_stats(self) -> dict:
+        if not self.pool:
+            return {}
+        size, idle = self.pool.get_size(), self.pool.get_idle_size()
+        return {
+            ('in_use',): size - idle,
+            ('idle',): idle,
+            ('max',): self.pool.get_max_size(),
+        }
+
+    @staticmethod
+    async def table_exists(db: Connection, schema: str, table: str) -> bool:
+        try:
+            count = await db.fetchval(
+                '''
+                    SELECT COUNT(*)
+                    FROM information_schema.tables
+                    WHERE table_schema = $1 AND table_name = $2
+                ''',
+                schema,
+                table
+            )
+        except UndefinedTableError:
+            count = 0
+        return count > 0
 
     async def update_db_schema(self):
+        """
+        Apply new migration files (sorted by name). Applied versions (file names
+        without suffix) are stored in the table schema_migration.
+        """
         async with self.pool.acquire_with_log('db.init') as db:
+            schema = 'public'
+            if match := re.search(r'search_path=([^&\?]*)(&?|$)',
+                                  DATABASE_URI, re.I):
+                schema = match.group(1)
+            # Instances started together wait for the first one
+            await db.execute('SELECT pg_advisory_lock($1);', MIGRATION_LOCK)
             try:
-                schema = 'public'
-                if match := re.search(r'search_path=([^&\?]*)(&?|$)',
-                                      DATABASE_URI, re.I):
-                    schema = match.group(1)
-                count = await db.fetchval(
-                    '''
-                        SELECT COUNT(*)
-                        FROM information_schema.tables
-                        WHERE table_schema = $1 AND table_name = $2
-                    ''',
-                    schema,
-                    'server_interface'
-                )
-            except UndefinedTableError:
-                count = 0
-            if count > 0:
-                return
-            migs = list(MIGRATION_DIR.glob('*.sql'))
-            migs.sort()
-            for file in migs:
-                logger.debug('Found db upgrade file %s', file)
-                async with db.transaction():
-                    with open(file, 'r') as f:
-                        await db.execute(f.read())
-                logger.info('Create the database schema')
+                if not await self.table_exists(db, schema, 'schema_migration'):
+                    baseline = await self.table_exists(db, schema, 'server_interface')
+                    await db.execute(
+                        '''
+                            CREATE TABLE "schema_migration" (
+                              "version" character varying(128) NOT NULL,
+                              PRIMARY KEY ("version"),
+                              "applied_at" timestamptz NOT NULL DEFAULT NOW()
+                            );
+                        '''
+                    )
+                    if baseline:
+                        # The database was created before migrations were versioned
+                        await db.execute(
+                            'INSERT INTO "schema_migration" ("version") VALUES ($1);', MIGRATION_BASELINE
+                        )
+                applied = {row['version'] for row in await db.fetch('SELECT "version" FROM "schema_migration";')}
+                migs = list(MIGRATION_DIR.glob('*.sql'))
+                migs.sort()
+                for file in migs:
+                    if file.stem in applied:
+                        continue
+                    logger.info('Apply db migration %s', file.name)
+                    sql = await asyncio.to_thread(file.read_text)
+                    try:
+                        async with db.transaction():
+                            await db.execute(sql)
+                            await db.execute(
+                                'INSERT INTO "schema_migration" ("version") VALUES ($1);', file.stem
+                            )
+                    except PostgresError as e:
+                        logger.error('Db migration %s failed: %s', file.name, e, meta={'hint': e.hint})
+                        raise
+            finally:
+                await db.execute('SELECT pg_advisory_unlock($1);', MIGRATION_LOCK)
 
     async def listener_handler(self, connection, pid, channel, payload):
         try:
@@ -142,8 +231,19 @@ class DBConnection:
                 "pid": pid
             }, exc_info=True)
 
+    async def reconnected(self):
+        if not self.pool or not self.reconnect_callbacks:
+            return
+        try:
+            async with self.pool.acquire_with_log('db.reconnect') as db:
+                for fce in self.reconnect_callbacks:
+                    await fce(db)
+        except Exception as ex:
+            logger.error('Reconnect handler failed: %s', ex, exc_info=True)
+
     async def event_listener(self):
         db: Connection = None
+        connected = False
         try:
             while not self.end:
                 try:
@@ -156,6 +256,9 @@ class DBConnection:
                     for channel in self.notifications.keys():
                         logger.debug('Register %s listener.', channel)
                         await db.add_listener(channel, self.listener_handler)
+                    if connected:
+                        await self.reconnected()
+                    connected = True
                     while not db.is_closed() and not self.end:
                         await db.execute("SELECT 1", timeout=1)
                         await asyncio.sleep(30)
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+import loggate
+
+logger = loggate.getLogger('debounce')
+
+
+class DebounceQueue:
+    """
+    Per key event queue. Events of the same key are coalesced into one
+    handler call, when no new event comes within `delay` seconds
+    (but at most `max_delay` seconds after the first event).
+    Handlers of the same key never run concurrently, different keys
+    are processed in parallel.
+    """
+
+    def __init__(self, handler: Callable[[Hashable, List[Any]], Awaitable],
+                 delay: float, max_delay: float, name: str = 'debounce'):
+        self.handler = handler
+        self.delay = delay
+        self.max_delay = max(max_delay, delay)
+        self.name = name
+        self.events: Dict[Hashable, List[Any]] = {}
+        self.first_event: Dict[Hashable, float] = {}
+        self.last_event: Dict[Hashable, float] = {}
+        self.workers: Dict[Hashable, asyncio.Task] = {}
+
+    def put(self, key: Hashable, event: Any):
+        now = asyncio.get_running_loop().time()
+        if key not in self.events:
+            self.events[key] = []
+            self.first_event[key] = now
+        self.events[key].append(event)
+        self.last_event[key] = now
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(
+                self.__worker(key), name=f'{self.name}-{key}'
+            )
+
+    def size(self, key: Hashable = None) -> int:
+        if key is not None:
+            return len(self.events.get(key, []))
+        return sum(len(it) for it in self.events.values())
+
+    async def __worker(self, key: Hashable):
+        loop = asyncio.get_running_loop()
+        try:
+            while key in self.events:
+                while (wait := min(self.last_event[key] + self.delay,
+                                   self.first_event[key] + self.max_delay) - loop.time()) > 0:
+                    await asyncio.sleep(wait)
+                events = self.events.pop(key)
+                self.first_event.pop(key)
+                self.last_event.pop(key)
+                try:
+                    await self.handler(key, events)
+                except Exception as ex:
+                    logger.error('Event handler failed: %s', ex, meta={
+                        "queue": self.name,
+                        "key": key,
+                        "events": len(events)
+                    }, exc_info=True)
+        finally:
+            self.workers.pop(key, None)
+
+    async def stop(self):
+        tasks = list(self.workers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,53 +1,149 @@
+import asyncio
 import base64
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
 import hashlib
 import io
-from ipaddress import AddressValueError, IPv4Address, collapse_addresses, ip_interface, summarize_address_range
+from ipaddress import IPv4Address, ip_interface
+import multiprocessing
 import os
 import re
 import subprocess
-from typing import List, Optional
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Hashable, Iterable, List, Optional, Tuple
 import jinja2
 import loggate
 import qrcode
 from qrcode.image.pure import PyPNGImage
+from qrcode.image.svg import SvgPathImage
 import yaml
 
-environment = jinja2.Environment(loader=jinja2.FileSystemLoader("templates/"))
+from config import BASE_DIR, get_config
+from lib import keys, metrics
+from lib.ippool import IPPool
+
+CMD_TIMEOUT = get_config('CMD_TIMEOUT', wrapper=float)
+CMD_CONCURRENCY = get_config('CMD_CONCURRENCY', wrapper=int)
+WG_KEYGEN = get_config('WG_KEYGEN', wrapper=lambda x: str(x).lower())
+QRCODE_WORKERS = get_config('QRCODE_WORKERS', wrapper=int)
+QRCODE_CACHE_SIZE = get_config('QRCODE_CACHE_SIZE', wrapper=int)
+# Format => (image factory, media type)
+QRCODE_FORMATS = {
+    'png': (PyPNGImage, 'image/png'),
+    'svg': (SvgPathImage, 'image/svg+xml'),
+}
+
+cmd_semaphore = asyncio.Semaphore(CMD_CONCURRENCY)
+process_executor: Optional[ProcessPoolExecutor] = None
+render_duration = metrics.histogram('render_seconds', 'Rendering of templates.', ('template',))
+cmd_duration = metrics.histogram(
+    'command_seconds', 'Duration of system commands (e.g. "wg set").', ('command',),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+cmd_errors = metrics.counter('command_errors_total', 'Failed or timed out system commands.', ('command',))
+environment = jinja2.Environment(loader=jinja2.FileSystemLoader(f"{BASE_DIR}templates/"))
 environment.filters['ip'] = lambda x: ip_interface(x).ip
 
 
 def render_template(template: str, **kwargs) -> str:
-    return environment.get_template(template).render(**kwargs)
+    with render_duration.time(template=template):
+        return environment.get_template(template).render(**kwargs)
+
+
+async def render_template_async(template: str, **kwargs) -> str:
+    # Templates can read files (e.g. private key), so it runs out of the event loop.
+    return await asyncio.to_thread(render_template, template, **kwargs)
 
 
 def checksum(content: str) -> str:
     return str(hashlib.md5(content.encode()).hexdigest()) if content else None
 
 
+class LRUCache:
+    """
+    In-memory cache of the last `size` values (0 = disabled).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: Hashable) -> Any:
+        if (value := self.data.get(key)) is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+qrcode_cache = LRUCache(QRCODE_CACHE_SIZE)
+
+
+async def gather_limited(aws: Iterable[Awaitable], limit: int) -> list:
+    """
+    asyncio.gather with maximal number of concurrently running awaitables.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+
 def get_yaml(filename):
     with open(filename, 'r') as fd:
         return yaml.safe_load(fd)
 
 
-def get_file_content(filename) -> str:
+def read_file(filename) -> str:
     if not os.path.exists(filename):
         return None
     with open(filename, 'r') as fd:
         return fd.read()
 
 
-def write_file(file_name: str, content: str, mode: int = 0o777):
-    desc = os.open(
-        path=file_name,
-        flags=(
-            os.O_WRONLY |
-            os.O_CREAT |
-            os.O_TRUNC
-        ),
-        mode=0o700
-    )
-    with open(desc, 'w') as fd:
-        fd.write(content)
+async def get_file_content(filename) -> str:
+    return await asyncio.to_thread(read_file, filename)
+
+
+def _write_file(file_name: str, content: str, mode: int = 0o700):
+    """
+    Atomic write, the content is written to a temporary file in the same folder,
+    it is flushed to the disk and renamed. Readers see the old or the new file.
+    """
+    folder, name = os.path.split(os.path.abspath(file_name))
+    desc, tmp_name = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=folder)
+    try:
+        with open(desc, 'w') as fd:
+            fd.write(content)
+            fd.flush()
+            os.fchmod(fd.fileno(), mode)
+            os.fsync(fd.fileno())
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    dir_desc = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(dir_desc)
+    finally:
+        os.close(dir_desc)
+
+
+async def write_file(file_name: str, content: str, mode: int = 0o700):
+    await asyncio.to_thread(_write_file, file_name, content, mode)
 
 
 def dict_bytes2str(dd):
@@ -85,104 +181,153 @@ def dicts_val(path: str, data, **kwargs):
         raise ex
 
 
-def cmd(*args, capture_output=True, ignore_error=False) -> subprocess.CompletedProcess:
-    if os.getuid() != 0:
+async def cmd(*args, capture_output=True, ignore_error=False, input: str = None,
+              sudo: bool = True, timeout: float = CMD_TIMEOUT) -> subprocess.CompletedProcess:
+    """
+    Run the command without blocking the event loop. The number of running
+    commands is limited by CMD_CONCURRENCY. It returns None, if the command fails.
+    """
+    command = ' '.join(args[:2])
+    if sudo and os.getuid() != 0:
         args = ('sudo', *args)
-    try:
-        return subprocess.run(
-            args, text=True, check=True, capture_output=capture_output
-        )
-    except subprocess.CalledProcessError as e:
+    pipe = asyncio.subprocess.PIPE if capture_output else None
+    async with cmd_semaphore:
+        start = time.perf_counter()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.PIPE if input is not None else None,
+                stdout=pipe,
+                stderr=pipe
+            )
+        except OSError as e:
+            loggate.get_logger('cmd').error(str(e), meta={"cmd": ' '.join(args)})
+            cmd_errors.inc(command=command)
+            return None
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate(input.encode() if input is not None else None),
+                timeout
+            )
+        except TimeoutError:
+            proc.kill()
+            await proc.wait()
+            loggate.get_logger('cmd').error(
+                'Command timed out after %ss', timeout, meta={"cmd": ' '.join(args)}
+            )
+            cmd_errors.inc(command=command)
+            return None
+        finally:
+            cmd_duration.observe(time.perf_counter() - start, command=command)
+    res = subprocess.CompletedProcess(
+        args, proc.returncode,
+        stdout.decode() if stdout is not None else None,
+        stderr.decode() if stderr is not None else None
+    )
+    if res.returncode != 0:
         if not ignore_error:
+            cmd_errors.inc(command=command)
             loggate.get_logger('cmd').error(
-                e.stderr, meta={"cmd": ' '.join(args)}
+                res.stderr, meta={"cmd": ' '.join(args)}
             )
-    return None
+        return None
+    return res
+
 
+async def wg_cmd(*args, input: str = None) -> str:
+    if not (res := await cmd('wg', *args, input=input, sudo=False)):
+        raise RuntimeError(f'Command wg {args[0]} failed.')
+    return res.stdout.strip()
 
-def get_wg_preshared_key() -> str:
-    return subprocess.run(
-        ('wg', 'genpsk'), capture_output=True, text=True, check=True
-    ).stdout.strip()
 
+async def native_keygen(fce: Callable, *args, executor: Optional[Executor] = None) -> Any:
+    """
+    Keys generated in the process (WG_KEYGEN=native) out of the event loop,
+    None = native generation is disabled or failed and the wg binary is used.
+    """
+    if WG_KEYGEN != 'native':
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fce, *args)
+    except Exception as e:
+        loggate.get_logger('keys').warning('Native key generation failed, the wg binary is used: %s', e)
+        return None
 
-def get_wg_private_key() -> str:
-    return subprocess.run(
-        ('wg', 'genkey'), capture_output=True, text=True, check=True
-    ).stdout.strip()
 
+async def get_wg_preshared_key() -> str:
+    return await native_keygen(keys.generate_preshared_key) or await wg_cmd('genpsk')
 
-def get_wg_public_key(private_key: str) -> str:
-    return subprocess.run(
-        ('wg', 'pubkey'), input=private_key,
-        capture_output=True, text=True, check=True
-    ).stdout.strip()
 
+async def get_wg_private_key() -> str:
+    return await native_keygen(keys.generate_private_key) or await wg_cmd('genkey')
 
-def ip_range_to_ips(ip_range: Optional[str]) -> List[IPv4Address]:
-    if not ip_range:
-        return []
-    try:
-        blocks = re.split(',|\n', ip_range)
-        nets = []
-        for range in blocks:
-            ips = [IPv4Address(ip.strip()) for ip in range.split('-')]
-            if len(ips) == 1:
-                nets.append(ips[0])
-            elif len(ips) == 2:
-                nets.extend(summarize_address_range(*ips))
-            else:
-                raise ValueError(f'Unknown format of range: {range}')
-        nets = collapse_addresses(nets)
-        ips = set()
-        for net in nets:
-            ips.add(net.network_address)
-            ips.update(net.hosts())
-            ips.add(net.broadcast_address)
-        return sorted(list(ips))
-    except AddressValueError as e:
-        raise ValueError(str(e))
+
+async def get_wg_public_key(private_key: str) -> str:
+    return await native_keygen(keys.get_public_key, private_key) or await wg_cmd('pubkey', input=private_key)
+
+
+async def get_wg_secret_pairs(count: int) -> List[Tuple[str, str]]:
+    # The Montgomery ladder holds the GIL (milliseconds per key), so more keys are generated by the process pool
+    if (res := await native_keygen(keys.generate_secret_pairs, count, executor=get_process_executor())) is not None:
+        return res
+    res = []
+    for _ in range(count):
+        private_key = await wg_cmd('genkey')
+        res.append((private_key, await wg_cmd('pubkey', input=private_key)))
+    return res
 
 
 def optimalize_ip_range(ip_range) -> str:
     if not ip_range:
         return
-    ips = ip_range_to_ips(ip_range)
-    ips_copy = set(ips)
-    res = []
-    last = None
-    start = None
-    while ips and (ip := ips.pop(0)):
-        if not ip.is_private:
+    pool = IPPool.from_range(ip_range)
+    for net in pool.networks():
+        if not net.is_private:
+            ip = next(it for it in net if not it.is_private)
             raise ValueError(f'IP {ip} is not private')
-        if last != ip - 1:
-            if start:
-                res.append(f'{start} - {last}')
-            start = ip
-        last = ip
-    if start:
-        if start != last:
-            res.append(f'{start} - {last}')
-        else:
-            res.append(f'{start}')
-    new_range = '\n'.join(res)
-    new_ips = ip_range_to_ips(new_range)
-    diff = set(new_ips).difference(set(ips_copy))
-    if diff:
-        return ip_range
+    ranges = [f'{start} - {end}' for start, end in pool.intervals()]
+    if pool and pool.starts[-1] == pool.ends[-1]:
+        ranges[-1] = str(IPv4Address(pool.starts[-1]))
+    new_range = '\n'.join(ranges)
     if len(ip_range) < len(new_range):
         return new_range
 
 
-def get_qrcode(content: str) -> io.BytesIO:
-    qr = qrcode.make(content, image_factory=PyPNGImage)
+def get_qrcode(content: str, image_format: str = 'png') -> bytes:
+    qr = qrcode.make(content, image_factory=QRCODE_FORMATS[image_format][0])
     buffer = io.BytesIO()
     qr.save(buffer)
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+
+def get_process_executor() -> Optional[ProcessPoolExecutor]:
+    """
+    Pool for CPU bound tasks (QR codes, exports), None = the default thread pool (QRCODE_WORKERS is 0).
+    """
+    global process_executor
+    if process_executor is None and QRCODE_WORKERS > 0:
+        # Fork of the process with running threads (event loop, asyncpg, to_thread) can deadlock
+        process_executor = ProcessPoolExecutor(QRCODE_WORKERS, mp_context=multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        ))
+    return process_executor
+
+
+async def get_qrcode_async(content: str, image_format: str = 'png') -> bytes:
+    """
+    QR code generated by the process pool (QRCODE_WORKERS, 0 = thread),
+    the last QRCODE_CACHE_SIZE images are cached by the checksum of the content.
+    """
+    key = (checksum(content), image_format)
+    if (image := qrcode_cache.get(key)) is not None:
+        return image
+    image = await asyncio.get_running_loop().run_in_executor(
+        get_process_executor(), get_qrcode, content, image_format
+    )
+    qrcode_cache.put(key, image)
+    return image
 
 
-def get_qrcode_based64(content: str) -> str:
-    buffer = get_qrcode(content)
-    qr_base64 = base64.b64encode(buffer.read()).decode('utf-8')
+async def get_qrcode_based64(content: str) -> str:
+    qr_base64 = base64.b64encode(await get_qrcode_async(content)).decode('utf-8')
     return f"data:image/png;base64,{qr_base64}"
@@ -0,0 +1,96 @@
+from bisect import bisect_left, bisect_right
+from ipaddress import AddressValueError, IPv4Address, IPv4Network, summarize_address_range
+import re
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+class IPPool:
+    """
+    Set of IPv4 addresses stored as sorted disjoint intervals of integers.
+    The memory does not depend on the size of ranges, only on the count of gaps.
+    """
+
+    def __init__(self, intervals: Iterable[Tuple[int, int]] = ()):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    @classmethod
+    def from_range(cls, ip_range: Optional[str]) -> 'IPPool':
+        """
+        Parse range e.g. "10.0.0.2 - 10.0.0.100, 10.0.1.1" (comma or new line separated).
+        """
+        if not ip_range:
+            return cls()
+        intervals = []
+        try:
+            for block in re.split(',|\n', ip_range):
+                ips = [int(IPv4Address(ip.strip())) for ip in block.split('-')]
+                if len(ips) == 1:
+                    intervals.append((ips[0], ips[0]))
+                elif len(ips) == 2:
+                    if ips[0] > ips[1]:
+                        raise ValueError(f'Unknown format of range: {block}')
+                    intervals.append((ips[0], ips[1]))
+                else:
+                    raise ValueError(f'Unknown format of range: {block}')
+        except AddressValueError as e:
+            raise ValueError(str(e))
+        return cls(intervals)
+
+    def __len__(self) -> int:
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def __bool__(self) -> bool:
+        return bool(self.starts)
+
+    def __contains__(self, ip: int | IPv4Address) -> bool:
+        ip = int(ip)
+        ix = bisect_right(self.starts, ip) - 1
+        return ix >= 0 and ip <= self.ends[ix]
+
+    def __iter__(self) -> Iterator[IPv4Address]:
+        for start, end in zip(self.starts, self.ends):
+            for ip in range(start, end + 1):
+                yield IPv4Address(ip)
+
+    def intervals(self) -> Iterator[Tuple[IPv4Address, IPv4Address]]:
+        for start, end in zip(self.starts, self.ends):
+            yield IPv4Address(start), IPv4Address(end)
+
+    def networks(self) -> Iterator[IPv4Network]:
+        for start, end in self.intervals():
+            yield from summarize_address_range(start, end)
+
+    def take(self, count: int) -> List[IPv4Address]:
+        res = []
+        for start, end in zip(self.starts, self.ends):
+            for ip in range(start, min(end, start + count - len(res) - 1) + 1):
+                res.append(IPv4Address(ip))
+            if len(res) >= count:
+                break
+        return res
+
+    def difference(self, ips: Iterable[int | IPv4Address]) -> 'IPPool':
+        """
+        New pool without given addresses, O(n + m log m).
+        """
+        used = sorted({int(ip) for ip in ips})
+        res = IPPool()
+        for start, end in zip(self.starts, self.ends):
+            ix = bisect_left(used, start)
+            while ix < len(used) and used[ix] <= end:
+                if used[ix] > start:
+                    res.starts.append(start)
+                    res.ends.append(used[ix] - 1)
+                start = used[ix] + 1
+                ix += 1
+            if start <= end:
+                res.starts.append(start)
+                res.ends.append(end)
+        return res
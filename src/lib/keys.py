@@ -0,0 +1,99 @@
+import base64
+import os
+from typing import List, Tuple
+
+# Curve25519 (RFC 7748) used by WireGuard
+P = 2 ** 255 - 19
+A24 = 121665
+BASE_POINT = 9
+
+
+def decode_key(key: str) -> bytes:
+    try:
+        raw = base64.b64decode(key, validate=True)
+    except ValueError:
+        raw = b''
+    if len(raw) != 32:
+        raise ValueError('Key must be 32 bytes encoded in base64.')
+    return raw
+
+
+def encode_key(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+
+def clamp(raw: bytes) -> int:
+    scalar = int.from_bytes(raw, 'little')
+    scalar &= ~7
+    scalar &= ~(128 << 8 * 31)
+    scalar |= 64 << 8 * 31
+    return scalar
+
+
+def cswap(swap: int, x_2: int, x_3: int) -> Tuple[int, int]:
+    """
+    Conditional swap without branches (swap is 0 or 1), RFC 7748 section 5.
+    """
+    dummy = -swap & (x_2 ^ x_3)
+    return x_2 ^ dummy, x_3 ^ dummy
+
+
+def x25519(scalar: int, u: int) -> int:
+    """
+    Montgomery ladder, RFC 7748 section 5.
+    """
+    x_1 = u
+    x_2, z_2 = 1, 0
+    x_3, z_3 = u, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (scalar >> t) & 1
+        swap ^= k_t
+        x_2, x_3 = cswap(swap, x_2, x_3)
+        z_2, z_3 = cswap(swap, z_2, z_3)
+        swap = k_t
+        a = (x_2 + z_2) % P
+        aa = a * a % P
+        b = (x_2 - z_2) % P
+        bb = b * b % P
+        e = (aa - bb) % P
+        c = (x_3 + z_3) % P
+        d = (x_3 - z_3) % P
+        da = d * a % P
+        cb = c * b % P
+        x_3 = (da + cb) ** 2 % P
+        z_3 = x_1 * (da - cb) ** 2 % P
+        x_2 = aa * bb % P
+        z_2 = e * (aa + A24 * e) % P
+    x_2, x_3 = cswap(swap, x_2, x_3)
+    z_2, z_3 = cswap(swap, z_2, z_3)
+    return x_2 * pow(z_2, P - 2, P) % P
+
+
+def scalar_mult(private_key: bytes, u: bytes) -> bytes:
+    """
+    Function X25519 of RFC 7748 (32 bytes little-endian inputs and output).
+    """
+    u_int = int.from_bytes(u, 'little') & ((1 << 255) - 1)
+    return x25519(clamp(private_key), u_int % P).to_bytes(32, 'little')
+
+
+def generate_private_key() -> str:
+    # The same as `wg genkey`, the key is stored clamped.
+    return encode_key(clamp(os.urandom(32)).to_bytes(32, 'little'))
+
+
+def generate_preshared_key() -> str:
+    return encode_key(os.urandom(32))
+
+
+def get_public_key(private_key: str) -> str:
+    return encode_key(scalar_mult(decode_key(private_key.strip()), BASE_POINT.to_bytes(32, 'little')))
+
+
+def generate_secret_pairs(count: int) -> List[Tuple[str, str]]:
+    res = []
+    for _ in range(count):
+        private_key = generate_private_key()
+        res.append((private_key, get_public_key(private_key)))
+    return res
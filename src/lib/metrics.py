@@ -0,0 +1,219 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+import loggate
+
+from config import get_config, to_bool
+
+METRICS = get_config('METRICS', wrapper=to_bool)
+METRICS_PORT = get_config('METRICS_PORT', wrapper=int)
+METRICS_PREFIX = 'wireguard_pg_'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    # HELP text, quotes are escaped only in label values
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value: str) -> str:
+    return _escape(value).replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Metric with labels, samples are kept in memory and exported
+    in the Prometheus text format.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(it, '')) for it in self.labels)
+
+    def remove(self, **labels):
+        self.values.pop(self._key(labels), None)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {_escape(self.documentation)}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for name, key, value in self.samples():
+            labels = self.labels + tuple('le' for _ in key[len(self.labels):])
+            lines.append(f'{name}{_format_labels(labels, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    Gauge is set directly or computed by the callback during the export,
+    the callback returns a value or a dict {label values: value}.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 callback: Callable[[], float | Dict[LabelValues, float]] = None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        if self.callback:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for key, value in values.items():
+                yield self.name, key, value
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    """
+    Histogram is observed only with METRICS=yes (observations are on hot paths).
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values => [count per bucket..., sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        if not METRICS:
+            return
+        key = self._key(labels)
+        if (data := self.values.get(key)) is None:
+            data = self.values[key] = [0] * len(self.buckets) + [0.0]
+        data[bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        if not METRICS:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float]]:
+        for key, data in self.values.items():
+            count = 0
+            for bucket, value in zip(self.buckets, data):
+                count += value
+                yield f'{self.name}_bucket', key + (_format_value(bucket),), count
+            yield f'{self.name}_sum', key, data[-1]
+            yield f'{self.name}_count', key, count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Modules can be imported more times (e.g. reload), the first metric is used
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: Sequence[str] = (), callback: Callable = None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels, callback))
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        method, path = (request.split(b'\r\n', 1)[0].split(b' ') + [b'', b''])[:2]
+        if method == b'GET' and path.split(b'?')[0] == b'/metrics':
+            status, content_type, body = '200 OK', CONTENT_TYPE, render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'Not Found'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(port: int = METRICS_PORT, host: str = '0.0.0.0') -> asyncio.Server:
+    """
+    Minimal HTTP listener with /metrics (for the mode without API).
+    """
+    server = await asyncio.start_server(handle_http, host, port)
+    loggate.getLogger('metrics').info('Metrics are available on http://%s:%s/metrics', host, port)
+    return server
@@ -0,0 +1,328 @@
+"""
+Minimal netlink client (standard library only) for the WireGuard generic netlink family
+(WG_CMD_GET_DEVICE, WG_CMD_SET_DEVICE) and rtnetlink link / address changes.
+All functions are blocking, they are called from a thread.
+"""
+from ipaddress import ip_address, ip_interface, ip_network
+import os
+import socket
+import struct
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from lib.keys import decode_key, encode_key
+from lib.wg import WGInterface, WGPeer, diff_peers
+
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+RECV_SIZE = 1 << 20
+
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+# include/uapi/linux/wireguard.h
+WG_GENL_NAME = 'wireguard'
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WG_CMD_SET_DEVICE = 1
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PRIVATE_KEY = 3
+WGDEVICE_A_PUBLIC_KEY = 4
+WGDEVICE_A_LISTEN_PORT = 6
+WGDEVICE_A_FWMARK = 7
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_FLAGS = 3
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL = 5
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGPEER_F_REMOVE_ME = 1
+WGPEER_F_REPLACE_ALLOWEDIPS = 2
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+EMPTY_KEY = bytes(32)
+
+# include/uapi/linux/rtnetlink.h
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+IFLA_MTU = 4
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_UP = 1
+
+
+def attr(attr_type: int, data: bytes) -> bytes:
+    length = 4 + len(data)
+    return struct.pack('=HH', length, attr_type) + data + b'\0' * (-length % 4)
+
+
+def nested(attr_type: int, attrs: Iterable[bytes]) -> bytes:
+    return attr(attr_type | NLA_F_NESTED, b''.join(attrs))
+
+
+def parse_attrs(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    ix = 0
+    while ix + 4 <= len(data):
+        length, attr_type = struct.unpack_from('=HH', data, ix)
+        if length < 4:
+            break
+        yield attr_type & NLA_TYPE_MASK, data[ix + 4:ix + length]
+        ix += (length + 3) & ~3
+
+
+class NetlinkSocket:
+    """
+    Netlink socket with synchronous requests, it raises OSError with errno of the kernel.
+    """
+
+    def __init__(self, protocol: int):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+        self.sock.bind((0, 0))
+        self.seq = 0
+
+    def __enter__(self) -> 'NetlinkSocket':
+        return self
+
+    def __exit__(self, *exc):
+        self.sock.close()
+
+    def request(self, msg_type: int, payload: bytes, flags: int = 0, dump: bool = False) -> List[bytes]:
+        """
+        Send the message and return bodies of responses. Dumps end by NLMSG_DONE,
+        other requests are acknowledged.
+        """
+        self.seq += 1
+        # NLM_F_DUMP shares bits with NLM_F_EXCL / NLM_F_CREATE of new requests
+        flags |= NLM_F_DUMP if dump else NLM_F_ACK
+        self.sock.send(struct.pack('=IHHII', 16 + len(payload), msg_type, flags | NLM_F_REQUEST, self.seq, 0) + payload)
+        res = []
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            ix = 0
+            while ix + 16 <= len(data):
+                length, resp_type, _, seq, _ = struct.unpack_from('=IHHII', data, ix)
+                body = data[ix + 16:ix + length]
+                ix += (length + 3) & ~3
+                if seq != self.seq:
+                    continue
+                if resp_type == NLMSG_ERROR:
+                    error = struct.unpack_from('=i', body)[0]
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return res
+                if resp_type == NLMSG_DONE:
+                    return res
+                res.append(body)
+
+
+class WireGuardNetlink(NetlinkSocket):
+
+    def __init__(self):
+        super().__init__(NETLINK_GENERIC)
+        self.family_id = self.get_family_id(WG_GENL_NAME)
+
+    def get_family_id(self, name: str) -> int:
+        payload = struct.pack('=BBH', CTRL_CMD_GETFAMILY, 1, 0) + attr(CTRL_ATTR_FAMILY_NAME, name.encode() + b'\0')
+        for body in self.request(GENL_ID_CTRL, payload):
+            for attr_type, value in parse_attrs(body[4:]):
+                if attr_type == CTRL_ATTR_FAMILY_ID:
+                    return struct.unpack_from('=H', value)[0]
+        raise OSError(f'Generic netlink family {name} does not exist.')
+
+    def genl_request(self, cmd: int, attrs: Iterable[bytes], dump: bool = False) -> List[bytes]:
+        payload = struct.pack('=BBH', cmd, WG_GENL_VERSION, 0) + b''.join(attrs)
+        return [it[4:] for it in self.request(self.family_id, payload, dump=dump)]
+
+    def get_device(self, iface: str) -> WGInterface:
+        return parse_device(self.genl_request(WG_CMD_GET_DEVICE, [attr(WGDEVICE_A_IFNAME, ifname(iface))], dump=True))
+
+    def set_device(self, iface: str, private_key: Optional[str] = None, listen_port: Optional[int] = None,
+                   fwmark: Optional[int] = None, remove: Iterable[str] = (), update: Iterable[WGPeer] = (),
+                   chunk: int = 200):
+        """
+        WG_CMD_SET_DEVICE, more peers are changed by one message (`chunk` peers per message).
+        """
+        attrs = [attr(WGDEVICE_A_IFNAME, ifname(iface))]
+        if private_key is not None:
+            attrs.append(attr(WGDEVICE_A_PRIVATE_KEY, decode_key(private_key)))
+        if listen_port is not None:
+            attrs.append(attr(WGDEVICE_A_LISTEN_PORT, struct.pack('=H', listen_port)))
+        if fwmark is not None:
+            attrs.append(attr(WGDEVICE_A_FWMARK, struct.pack('=I', fwmark)))
+        peers = [remove_peer_attrs(it) for it in remove] + [set_peer_attrs(it) for it in update]
+        if not peers:
+            self.genl_request(WG_CMD_SET_DEVICE, attrs)
+            return
+        for ix in range(0, len(peers), chunk):
+            self.genl_request(WG_CMD_SET_DEVICE, attrs + [nested(WGDEVICE_A_PEERS, peers[ix:ix + chunk])])
+            # Device attributes are set only once
+            attrs = attrs[:1]
+
+
+def ifname(iface: str) -> bytes:
+    return iface.encode() + b'\0'
+
+
+def parse_endpoint(data: bytes) -> Optional[str]:
+    family, port = struct.unpack_from('=H', data)[0], struct.unpack_from('!H', data, 2)[0]
+    if family == socket.AF_INET:
+        return f'{ip_address(data[4:8])}:{port}'
+    if family == socket.AF_INET6:
+        return f'[{ip_address(data[8:24])}]:{port}'
+    return None
+
+
+def parse_allowed_ip(data: bytes) -> str:
+    values = dict(parse_attrs(data))
+    cidr = values[WGALLOWEDIP_A_CIDR_MASK][0]
+    return str(ip_network(f'{ip_address(values[WGALLOWEDIP_A_IPADDR])}/{cidr}', strict=False))
+
+
+def parse_peer(data: bytes) -> WGPeer:
+    values = {}
+    allowed_ips = []
+    for attr_type, value in parse_attrs(data):
+        if attr_type == WGPEER_A_ALLOWEDIPS:
+            allowed_ips.extend(parse_allowed_ip(it) for _, it in parse_attrs(value))
+        else:
+            values[attr_type] = value
+    psk = values.get(WGPEER_A_PRESHARED_KEY, EMPTY_KEY)
+    handshake = values.get(WGPEER_A_LAST_HANDSHAKE_TIME)
+    return WGPeer(
+        public_key=encode_key(values[WGPEER_A_PUBLIC_KEY]),
+        preshared_key=encode_key(psk) if psk != EMPTY_KEY else None,
+        allowed_ips=frozenset(allowed_ips),
+        persistent_keepalive=struct.unpack_from('=H', values.get(WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, b'\0\0'))[0],
+        endpoint=parse_endpoint(values[WGPEER_A_ENDPOINT]) if WGPEER_A_ENDPOINT in values else None,
+        latest_handshake=struct.unpack_from('=q', handshake)[0] if handshake else 0,
+        transfer_rx=struct.unpack_from('=Q', values.get(WGPEER_A_RX_BYTES, bytes(8)))[0],
+        transfer_tx=struct.unpack_from('=Q', values.get(WGPEER_A_TX_BYTES, bytes(8)))[0],
+    )
+
+
+def parse_device(bodies: Iterable[bytes]) -> WGInterface:
+    """
+    Messages of WG_CMD_GET_DEVICE, peers of big interfaces are split to more messages.
+    """
+    device = {'private_key': None, 'public_key': None, 'listen_port': 0, 'fwmark': 0}
+    peers = {}
+    for body in bodies:
+        for attr_type, value in parse_attrs(body):
+            if attr_type == WGDEVICE_A_PRIVATE_KEY:
+                device['private_key'] = encode_key(value) if value != EMPTY_KEY else None
+            elif attr_type == WGDEVICE_A_PUBLIC_KEY:
+                device['public_key'] = encode_key(value) if value != EMPTY_KEY else None
+            elif attr_type == WGDEVICE_A_LISTEN_PORT:
+                device['listen_port'] = struct.unpack_from('=H', value)[0]
+            elif attr_type == WGDEVICE_A_FWMARK:
+                device['fwmark'] = struct.unpack_from('=I', value)[0]
+            elif attr_type == WGDEVICE_A_PEERS:
+                for _, peer_data in parse_attrs(value):
+                    peer = parse_peer(peer_data)
+                    if (current := peers.get(peer.public_key)) is not None:
+                        # The peer continues from the previous message (only its public key and allowed IPs)
+                        peer = current._replace(allowed_ips=current.allowed_ips | peer.allowed_ips)
+                    peers[peer.public_key] = peer
+    return WGInterface(peers=peers, **device)
+
+
+def remove_peer_attrs(public_key: str) -> bytes:
+    return nested(0, [
+        attr(WGPEER_A_PUBLIC_KEY, decode_key(public_key)),
+        attr(WGPEER_A_FLAGS, struct.pack('=I', WGPEER_F_REMOVE_ME)),
+    ])
+
+
+def set_peer_attrs(peer: WGPeer) -> bytes:
+    allowed_ips = []
+    for it in sorted(peer.allowed_ips):
+        net = ip_network(it, strict=False)
+        allowed_ips.append(nested(0, [
+            attr(WGALLOWEDIP_A_FAMILY, struct.pack('=H', socket.AF_INET if net.version == 4 else socket.AF_INET6)),
+            attr(WGALLOWEDIP_A_IPADDR, net.network_address.packed),
+            attr(WGALLOWEDIP_A_CIDR_MASK, struct.pack('=B', net.prefixlen)),
+        ]))
+    return nested(0, [
+        attr(WGPEER_A_PUBLIC_KEY, decode_key(peer.public_key)),
+        attr(WGPEER_A_FLAGS, struct.pack('=I', WGPEER_F_REPLACE_ALLOWEDIPS)),
+        attr(WGPEER_A_PRESHARED_KEY, decode_key(peer.preshared_key) if peer.preshared_key else EMPTY_KEY),
+        attr(WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, struct.pack('=H', peer.persistent_keepalive)),
+        nested(WGPEER_A_ALLOWEDIPS, allowed_ips),
+    ])
+
+
+def get_device(iface: str) -> WGInterface:
+    with WireGuardNetlink() as nl:
+        return nl.get_device(iface)
+
+
+def get_devices(ifaces: Iterable[str]) -> dict:
+    """
+    Devices by one socket, missing interfaces are skipped.
+    """
+    res = {}
+    with WireGuardNetlink() as nl:
+        for iface in ifaces:
+            try:
+                res[iface] = nl.get_device(iface)
+            except OSError:
+                continue
+    return res
+
+
+def set_device(iface: str, **kwargs):
+    with WireGuardNetlink() as nl:
+        nl.set_device(iface, **kwargs)
+
+
+def sync_device(iface: str, config: WGInterface, chunk: int = 200):
+    """
+    The same as `wg syncconf`, only differences of peers are applied (endpoints are kept).
+    """
+    with WireGuardNetlink() as nl:
+        remove, update = diff_peers(config.peers.values(), nl.get_device(iface).peers)
+        nl.set_device(
+            iface, private_key=config.private_key, listen_port=config.listen_port or None, fwmark=config.fwmark,
+            remove=remove, update=update, chunk=chunk
+        )
+
+
+def set_link_mtu(iface: str, mtu: int):
+    """
+    The same as `ip link set mtu <mtu> up dev <iface>`.
+    """
+    payload = struct.pack('=BxHiII', socket.AF_UNSPEC, 0, socket.if_nametoindex(iface), IFF_UP, IFF_UP)
+    with NetlinkSocket(NETLINK_ROUTE) as nl:
+        nl.request(RTM_NEWLINK, payload + attr(IFLA_MTU, struct.pack('=I', mtu)))
+
+
+def change_address(iface: str, address: str, add: bool = True):
+    """
+    The same as `ip address add|del <address> dev <iface>`.
+    """
+    addr = ip_interface(address)
+    family = socket.AF_INET if addr.version == 4 else socket.AF_INET6
+    payload = struct.pack('=BBBBI', family, addr.network.prefixlen, 0, 0, socket.if_nametoindex(iface)) \
+        + attr(IFA_LOCAL, addr.ip.packed) + attr(IFA_ADDRESS, addr.ip.packed)
+    with NetlinkSocket(NETLINK_ROUTE) as nl:
+        if add:
+            nl.request(RTM_NEWADDR, payload, NLM_F_CREATE | NLM_F_EXCL)
+        else:
+            nl.request(RTM_DELADDR, payload)
@@ -0,0 +1,230 @@
+import asyncio
+from ipaddress import ip_network
+import os
+import re
+from tempfile import TemporaryDirectory
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+import loggate
+
+from config import get_config
+from lib import keys
+from lib.helper import cmd
+
+# Maximal number of peers changed by one `wg set` command
+WIREGUARD_SET_CHUNK = get_config('WIREGUARD_SET_CHUNK', wrapper=int)
+NONE = '(none)'
+
+logger = loggate.getLogger('wg')
+
+
+class WGPeer(NamedTuple):
+    public_key: str
+    preshared_key: Optional[str] = None
+    allowed_ips: FrozenSet[str] = frozenset()
+    persistent_keepalive: int = 0
+    endpoint: Optional[str] = None
+    latest_handshake: int = 0
+    transfer_rx: int = 0
+    transfer_tx: int = 0
+
+    def is_wg_equal(self, other: 'WGPeer') -> bool:
+        """
+        The same setting (runtime values as endpoint or transfer are ignored).
+        """
+        return self.public_key == other.public_key \
+            and self.preshared_key == other.preshared_key \
+            and self.allowed_ips == other.allowed_ips \
+            and self.persistent_keepalive == other.persistent_keepalive
+
+
+class WGInterface(NamedTuple):
+    private_key: Optional[str]
+    public_key: Optional[str]
+    listen_port: int
+    fwmark: int
+    peers: Dict[str, WGPeer]
+
+
+def normalize_allowed_ips(allowed_ips: Optional[str]) -> FrozenSet[str]:
+    """
+    Allowed IPs (comma or new line separated) in the form of the kernel, e.g. "10.0.0.2" => "10.0.0.2/32".
+    """
+    if not allowed_ips or allowed_ips == NONE:
+        return frozenset()
+    return frozenset(
+        str(ip_network(it.strip(), strict=False)) for it in re.split(',|\n', allowed_ips) if it.strip()
+    )
+
+
+def _parse_interface(line: List[str]) -> WGInterface:
+    private_key, public_key, listen_port, fwmark = line
+    return WGInterface(
+        private_key=None if private_key == NONE else private_key,
+        public_key=None if public_key == NONE else public_key,
+        listen_port=int(listen_port),
+        fwmark=0 if fwmark == 'off' else int(fwmark, 0),
+        peers={}
+    )
+
+
+def _parse_peer(line: List[str]) -> WGPeer:
+    key, psk, endpoint, allowed_ips, handshake, rx, tx, keepalive = line
+    return WGPeer(
+        public_key=key,
+        preshared_key=None if psk == NONE else psk,
+        allowed_ips=normalize_allowed_ips(allowed_ips),
+        persistent_keepalive=0 if keepalive == 'off' else int(keepalive),
+        endpoint=None if endpoint == NONE else endpoint,
+        latest_handshake=int(handshake),
+        transfer_rx=int(rx),
+        transfer_tx=int(tx),
+    )
+
+
+def parse_dump(content: str) -> WGInterface:
+    """
+    Parse output of `wg show <iface> dump` (tab separated, the first line is the interface).
+    """
+    lines = [it.split('\t') for it in content.splitlines() if it]
+    if not lines or len(lines[0]) != 4:
+        raise ValueError('Unknown format of wg dump.')
+    iface = _parse_interface(lines[0])
+    for line in lines[1:]:
+        if len(line) != 8:
+            raise ValueError('Unknown format of wg dump.')
+        peer = _parse_peer(line)
+        iface.peers[peer.public_key] = peer
+    return iface
+
+
+def parse_dump_all(content: str) -> Dict[str, WGInterface]:
+    """
+    Parse output of `wg show all dump`, every line starts with the interface name.
+    """
+    res = {}
+    for line in content.splitlines():
+        if not line:
+            continue
+        name, *line = line.split('\t')
+        if len(line) == 4:
+            res[name] = _parse_interface(line)
+        elif len(line) == 8 and name in res:
+            peer = _parse_peer(line)
+            res[name].peers[peer.public_key] = peer
+        else:
+            raise ValueError('Unknown format of wg dump.')
+    return res
+
+
+async def get_dump(iface: str) -> Optional[WGInterface]:
+    """
+    The current state of the interface in the kernel, None if the interface does not exist.
+    """
+    res = await cmd('wg', 'show', iface, 'dump', ignore_error=True)
+    if not res:
+        return None
+    try:
+        return parse_dump(res.stdout)
+    except ValueError as e:
+        logger.error('Problem with parsing of wg dump: %s', e, meta={"iface": iface})
+        return None
+
+
+async def get_dump_all() -> Dict[str, WGInterface]:
+    """
+    The current state of all wireguard interfaces by one command.
+    """
+    res = await cmd('wg', 'show', 'all', 'dump')
+    if not res:
+        return {}
+    try:
+        return parse_dump_all(res.stdout)
+    except ValueError as e:
+        logger.error('Problem with parsing of wg dump: %s', e)
+        return {}
+
+
+def parse_config(content: str) -> Tuple[WGInterface, List[str]]:
+    """
+    Parse the configuration file (wg-quick format), it returns the interface and its addresses.
+    """
+    device = {'private_key': None, 'listen_port': 0, 'fwmark': 0}
+    addresses, peers, peer = [], {}, None
+    for line in content.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line.lower() == '[peer]':
+            peer = {'allowed_ips': frozenset()}
+            continue
+        if '=' not in line:
+            continue
+        key, value = (it.strip() for it in line.split('=', 1))
+        key = key.lower()
+        if peer is None:
+            if key == 'privatekey':
+                device['private_key'] = value
+            elif key == 'listenport':
+                device['listen_port'] = int(value)
+            elif key == 'fwmark':
+                device['fwmark'] = 0 if value == 'off' else int(value, 0)
+            elif key == 'address':
+                addresses.extend(it.strip() for it in value.split(',') if it.strip())
+        elif key == 'publickey':
+            peer['public_key'] = value
+            peers[value] = peer
+        elif key == 'presharedkey':
+            peer['preshared_key'] = value
+        elif key == 'allowedips':
+            peer['allowed_ips'] = peer['allowed_ips'] | normalize_allowed_ips(value)
+        elif key == 'persistentkeepalive':
+            peer['persistent_keepalive'] = 0 if value == 'off' else int(value)
+    iface = WGInterface(
+        public_key=keys.get_public_key(device['private_key']) if device['private_key'] else None,
+        peers={key: WGPeer(**it) for key, it in peers.items()},
+        **device
+    )
+    return iface, addresses
+
+
+def diff_peers(desired: Iterable[WGPeer], actual: Dict[str, WGPeer]) -> Tuple[List[str], List[WGPeer]]:
+    """
+    Minimal changes to get the desired peers: public keys to remove and peers to set.
+    """
+    to_set = []
+    keys = set()
+    for peer in desired:
+        keys.add(peer.public_key)
+        current = actual.get(peer.public_key)
+        if not current or not peer.is_wg_equal(current):
+            to_set.append(peer)
+    return [it for it in actual.keys() if it not in keys], to_set
+
+
+def _write_psk_files(folder: str, peers: List[WGPeer]) -> Dict[str, str]:
+    res = {}
+    for ix, peer in enumerate(peers):
+        if peer.preshared_key:
+            res[peer.public_key] = os.path.join(folder, f'{ix}.psk')
+            with open(os.open(res[peer.public_key], os.O_WRONLY | os.O_CREAT, 0o600), 'w') as fd:
+                fd.write(peer.preshared_key)
+    return res
+
+
+async def set_peers(iface: str, remove: List[str], update: List[WGPeer]) -> bool:
+    """
+    Apply changes of peers by `wg set`, more peers are changed by one command.
+    """
+    with TemporaryDirectory() as folder:
+        psk_files = await asyncio.to_thread(_write_psk_files, folder, update)
+        changes = [('peer', key, 'remove') for key in remove]
+        for peer in update:
+            changes.append((
+                'peer', peer.public_key,
+                'allowed-ips', ','.join(sorted(peer.allowed_ips)),
+                'preshared-key', psk_files.get(peer.public_key, '/dev/null'),
+                'persistent-keepalive', str(peer.persistent_keepalive or 'off'),
+            ))
+        for ix in range(0, len(changes), WIREGUARD_SET_CHUNK):
+            args = [arg for change in changes[ix:ix + WIREGUARD_SET_CHUNK] for arg in change]
+            if not await cmd('wg', 'set', iface, *args):
+                return False
+    return True
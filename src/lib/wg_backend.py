@@ -0,0 +1,298 @@
+from abc import ABC, abstractmethod
+import asyncio
+from pathlib import Path
+import socket
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, List, Optional, Set
+import loggate
+
+from config import get_config
+from lib import netlink
+from lib.helper import cmd, read_file, write_file
+from lib.wg import WIREGUARD_SET_CHUNK, WGInterface, WGPeer, get_dump, get_dump_all, parse_config, set_peers
+
+WIREGUARD_BACKEND = get_config('WIREGUARD_BACKEND', wrapper=lambda x: str(x).lower())
+
+logger = loggate.getLogger('wg')
+
+
+class WGBackend(ABC):
+    """
+    Kernel operations of WGServer. Methods return False (or None), if the operation fails.
+    The backend is selected by WIREGUARD_BACKEND.
+    """
+    name = ''
+
+    @abstractmethod
+    async def interface_exists(self, iface: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def interface_up(self, conf_file: Path) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def interface_down(self, conf_file: Path) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_dump(self, iface: str) -> Optional[WGInterface]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_dump_all(self, ifaces: Iterable[str]) -> Dict[str, WGInterface]:
+        """
+        State of interfaces, other wireguard interfaces can be also returned.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_peers(self, iface: str, remove: List[str], update: List[WGPeer]) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_device(self, iface: str, listen_port: Optional[int] = None, fwmark: Optional[int] = None,
+                         private_key: Optional[str] = None) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_mtu(self, iface: str, mtu: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_address(self, iface: str, address: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def del_address(self, iface: str, address: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def syncconf(self, iface: str, content: str) -> bool:
+        """
+        Replace the device setting and peers by the configuration (`wg syncconf` format).
+        """
+        raise NotImplementedError
+
+
+class SubprocessBackend(WGBackend):
+    """
+    Commands wg, ip and wg-quick.
+    """
+    name = 'subprocess'
+
+    async def interface_exists(self, iface: str) -> bool:
+        res = await cmd('ip', 'link', 'show', iface, ignore_error=True)
+        return bool(res) and res.returncode == 0
+
+    async def interface_up(self, conf_file: Path) -> bool:
+        return bool(await cmd('wg-quick', 'up', str(conf_file)))
+
+    async def interface_down(self, conf_file: Path) -> bool:
+        return bool(await cmd('wg-quick', 'down', str(conf_file)))
+
+    async def get_dump(self, iface: str) -> Optional[WGInterface]:
+        return await get_dump(iface)
+
+    async def get_dump_all(self, ifaces: Iterable[str]) -> Dict[str, WGInterface]:
+        return await get_dump_all()
+
+    async def set_peers(self, iface: str, remove: List[str], update: List[WGPeer]) -> bool:
+        return await set_peers(iface, remove, update)
+
+    async def set_device(self, iface: str, listen_port: Optional[int] = None, fwmark: Optional[int] = None,
+                         private_key: Optional[str] = None) -> bool:
+        args = []
+        if listen_port is not None:
+            args.extend(('listen-port', str(listen_port)))
+        if fwmark is not None:
+            args.extend(('fwmark', str(fwmark or 'off')))
+        with NamedTemporaryFile('w') as tmp_fd:
+            if private_key is not None:
+                await write_file(tmp_fd.name, private_key)
+                args.extend(('private-key', tmp_fd.name))
+            return not args or bool(await cmd('wg', 'set', iface, *args))
+
+    async def set_mtu(self, iface: str, mtu: int) -> bool:
+        return bool(await cmd('ip', 'link', 'set', 'mtu', str(mtu), 'up', 'dev', iface))
+
+    async def add_address(self, iface: str, address: str) -> bool:
+        return bool(await cmd('ip', 'address', 'add', address, 'dev', iface))
+
+    async def del_address(self, iface: str, address: str) -> bool:
+        return bool(await cmd('ip', 'address', 'del', address, 'dev', iface))
+
+    async def syncconf(self, iface: str, content: str) -> bool:
+        with NamedTemporaryFile('w') as tmp_fd:
+            await write_file(tmp_fd.name, content)
+            return bool(await cmd('wg', 'syncconf', iface, tmp_fd.name))
+
+
+class NetlinkBackend(SubprocessBackend):
+    """
+    WireGuard generic netlink and rtnetlink in the process (without fork/exec and temporary files),
+    more peers are changed by one message. Operations fall back to commands, if netlink fails
+    (e.g. missing CAP_NET_ADMIN). Interfaces are started by wg-quick (PreUp, PostUp, routes, DNS).
+    """
+    name = 'netlink'
+
+    async def __call(self, operation: str, fallback, fce, *args):
+        try:
+            return await asyncio.to_thread(fce, *args)
+        except (OSError, ValueError) as e:
+            logger.warning('Netlink operation %s failed (%s), the command is used.', operation, e)
+            return await fallback()
+
+    async def interface_exists(self, iface: str) -> bool:
+        try:
+            socket.if_nametoindex(iface)
+        except OSError:
+            return False
+        return True
+
+    async def get_dump(self, iface: str) -> Optional[WGInterface]:
+        if not await self.interface_exists(iface):
+            return None
+        return await self.__call(
+            'get_dump', lambda: super(NetlinkBackend, self).get_dump(iface), netlink.get_device, iface
+        )
+
+    async def get_dump_all(self, ifaces: Iterable[str]) -> Dict[str, WGInterface]:
+        ifaces = list(ifaces)
+        return await self.__call(
+            'get_dump_all', lambda: super(NetlinkBackend, self).get_dump_all(ifaces), netlink.get_devices, ifaces
+        )
+
+    async def __set_device(self, fallback, iface: str, **kwargs) -> bool:
+        return await self.__call('set_device', fallback, lambda: netlink.set_device(iface, **kwargs) or True)
+
+    async def set_peers(self, iface: str, remove: List[str], update: List[WGPeer]) -> bool:
+        return await self.__set_device(
+            lambda: super(NetlinkBackend, self).set_peers(iface, remove, update),
+            iface, remove=remove, update=update, chunk=WIREGUARD_SET_CHUNK
+        )
+
+    async def set_device(self, iface: str, listen_port: Optional[int] = None, fwmark: Optional[int] = None,
+                         private_key: Optional[str] = None) -> bool:
+        return await self.__set_device(
+            lambda: super(NetlinkBackend, self).set_device(iface, listen_port, fwmark, private_key),
+            iface, listen_port=listen_port, fwmark=fwmark, private_key=private_key
+        )
+
+    async def set_mtu(self, iface: str, mtu: int) -> bool:
+        return await self.__call(
+            'set_mtu', lambda: super(NetlinkBackend, self).set_mtu(iface, mtu),
+            lambda: netlink.set_link_mtu(iface, mtu) or True
+        )
+
+    async def add_address(self, iface: str, address: str) -> bool:
+        return await self.__call(
+            'add_address', lambda: super(NetlinkBackend, self).add_address(iface, address),
+            lambda: netlink.change_address(iface, address, add=True) or True
+        )
+
+    async def del_address(self, iface: str, address: str) -> bool:
+        return await self.__call(
+            'del_address', lambda: super(NetlinkBackend, self).del_address(iface, address),
+            lambda: netlink.change_address(iface, address, add=False) or True
+        )
+
+    async def syncconf(self, iface: str, content: str) -> bool:
+        # Content which is not parsed (ValueError) is applied by `wg syncconf`
+        return await self.__call(
+            'syncconf', lambda: super(NetlinkBackend, self).syncconf(iface, content),
+            lambda: netlink.sync_device(iface, parse_config(content)[0], WIREGUARD_SET_CHUNK) or True
+        )
+
+
+class FakeBackend(WGBackend):
+    """
+    In-memory kernel for tests and development without wireguard.
+    """
+    name = 'fake'
+
+    def __init__(self):
+        self.interfaces: Dict[str, WGInterface] = {}
+        self.addresses: Dict[str, Set[str]] = {}
+        self.mtu: Dict[str, int] = {}
+
+    async def interface_exists(self, iface: str) -> bool:
+        return iface in self.interfaces
+
+    async def interface_up(self, conf_file: Path) -> bool:
+        if (content := await asyncio.to_thread(read_file, conf_file)) is None:
+            return False
+        iface, addresses = parse_config(content)
+        self.interfaces[Path(conf_file).stem] = iface
+        self.addresses[Path(conf_file).stem] = set(addresses)
+        return True
+
+    async def interface_down(self, conf_file: Path) -> bool:
+        self.addresses.pop(Path(conf_file).stem, None)
+        self.mtu.pop(Path(conf_file).stem, None)
+        return self.interfaces.pop(Path(conf_file).stem, None) is not None
+
+    async def get_dump(self, iface: str) -> Optional[WGInterface]:
+        if (device := self.interfaces.get(iface)) is None:
+            return None
+        return device._replace(peers=dict(device.peers))
+
+    async def get_dump_all(self, ifaces: Iterable[str]) -> Dict[str, WGInterface]:
+        return {it: await self.get_dump(it) for it in self.interfaces}
+
+    async def set_peers(self, iface: str, remove: List[str], update: List[WGPeer]) -> bool:
+        if (device := self.interfaces.get(iface)) is None:
+            return False
+        for key in remove:
+            device.peers.pop(key, None)
+        for peer in update:
+            device.peers[peer.public_key] = peer
+        return True
+
+    async def set_device(self, iface: str, listen_port: Optional[int] = None, fwmark: Optional[int] = None,
+                         private_key: Optional[str] = None) -> bool:
+        if (device := self.interfaces.get(iface)) is None:
+            return False
+        changes = {'listen_port': listen_port, 'fwmark': fwmark, 'private_key': private_key}
+        self.interfaces[iface] = device._replace(**{key: val for key, val in changes.items() if val is not None})
+        return True
+
+    async def set_mtu(self, iface: str, mtu: int) -> bool:
+        if iface not in self.interfaces:
+            return False
+        self.mtu[iface] = mtu
+        return True
+
+    async def add_address(self, iface: str, address: str) -> bool:
+        if iface not in self.interfaces or address in self.addresses[iface]:
+            return False
+        self.addresses[iface].add(address)
+        return True
+
+    async def del_address(self, iface: str, address: str) -> bool:
+        if address not in self.addresses.get(iface, ()):
+            return False
+        self.addresses[iface].discard(address)
+        return True
+
+    async def syncconf(self, iface: str, content: str) -> bool:
+        if iface not in self.interfaces:
+            return False
+        self.interfaces[iface], _ = parse_config(content)
+        return True
+
+
+BACKENDS = {
+    SubprocessBackend.name: SubprocessBackend,
+    NetlinkBackend.name: NetlinkBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def get_backend(name: str = WIREGUARD_BACKEND) -> WGBackend:
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown wireguard backend {name} (available: {", ".join(BACKENDS)}).')
+    if name == NetlinkBackend.name and not hasattr(socket, 'AF_NETLINK'):
+        logger.warning('Netlink is not supported on this platform, the subprocess backend is used.')
+        name = SubprocessBackend.name
+    return BACKENDS[name]()
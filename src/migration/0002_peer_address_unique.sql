@@ -0,0 +1,24 @@
+-- Databases created before versioned migrations can already have the constraint
+DO $$
+DECLARE
+    conflicts text;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'client_peer_interface_id_address') THEN
+        -- Duplicate addresses have to be resolved by hand, the constraint cannot be created
+        SELECT string_agg(format('interface %s, address %s: peers %s', "interface_id", "address", "ids"), '; ')
+        INTO conflicts
+        FROM (
+            SELECT "interface_id", "address", string_agg("id"::text, ', ' ORDER BY "id") AS "ids"
+            FROM "client_peer"
+            GROUP BY "interface_id", "address"
+            HAVING count(*) > 1
+        ) AS "duplicate";
+        IF conflicts IS NOT NULL THEN
+            RAISE EXCEPTION 'Peers share the same address: %', conflicts
+                USING HINT = 'Change or delete the conflicting peers and restart the application.';
+        END IF;
+        ALTER TABLE "client_peer"
+        ADD CONSTRAINT "client_peer_interface_id_address" UNIQUE ("interface_id", "address");
+    END IF;
+END;
+$$;
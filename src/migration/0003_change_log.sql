@@ -0,0 +1,55 @@
+CREATE TABLE IF NOT EXISTS "change_log" (
+  "id" bigserial NOT NULL,
+  PRIMARY KEY ("id"),
+  "table_name" character varying(64) NOT NULL,
+  "operation" character varying(8) NOT NULL,
+  "row_id" integer NOT NULL,
+  "interface_id" integer NULL,
+  "old_interface_id" integer NULL,
+  "old_public_key" character varying(256) NULL,
+  "old_enabled" boolean NULL,
+  "created_at" timestamptz NOT NULL DEFAULT NOW()
+);
+COMMENT ON TABLE "change_log" IS 'Changes of interfaces and peers, it is used when wireguard_pg.change_log = on';
+CREATE INDEX IF NOT EXISTS "change_log_created_at" ON "change_log" ("created_at");
+
+
+-- The change log is enabled by: ALTER DATABASE <db> SET wireguard_pg.change_log = 'on';
+CREATE OR REPLACE FUNCTION notify_data_change()
+RETURNS TRIGGER AS $$
+DECLARE
+table_name TEXT := TG_TABLE_NAME;
+payload JSON;
+log_id BIGINT;
+log_interface_id INTEGER;
+BEGIN
+    IF coalesce(current_setting('wireguard_pg.change_log', true), '') = 'on' THEN
+        IF TG_TABLE_NAME = 'client_peer' THEN
+            log_interface_id := coalesce(NEW.interface_id, OLD.interface_id);
+            INSERT INTO "change_log" ("table_name", "operation", "row_id", "interface_id",
+                                      "old_interface_id", "old_public_key", "old_enabled")
+            VALUES (TG_TABLE_NAME, TG_OP, coalesce(NEW.id, OLD.id), NEW.interface_id,
+                    OLD.interface_id, OLD.public_key, OLD.enabled)
+            RETURNING "id" INTO log_id;
+        ELSE
+            log_interface_id := coalesce(NEW.id, OLD.id);
+            INSERT INTO "change_log" ("table_name", "operation", "row_id", "interface_id",
+                                      "old_interface_id", "old_enabled")
+            VALUES (TG_TABLE_NAME, TG_OP, coalesce(NEW.id, OLD.id), NEW.id,
+                    OLD.id, OLD.enabled)
+            RETURNING "id" INTO log_id;
+        END IF;
+        PERFORM pg_notify('change_log', json_build_object(
+            'id', log_id,
+            'interface_id', log_interface_id
+        )::TEXT);
+    ELSE
+        payload := json_build_object(
+            'old', row_to_json(OLD),
+            'new', row_to_json(NEW)
+        );
+        PERFORM pg_notify(table_name, payload::TEXT);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,86 @@
+ALTER TABLE "change_log"
+ADD COLUMN IF NOT EXISTS "server_name" character varying(64) NULL,
+ADD COLUMN IF NOT EXISTS "old_server_name" character varying(64) NULL;
+CREATE INDEX IF NOT EXISTS "change_log_server_name" ON "change_log" ("server_name", "id");
+CREATE INDEX IF NOT EXISTS "change_log_old_server_name" ON "change_log" ("old_server_name", "id");
+
+
+-- Name of notification channel of the server (the channel name is limited to 63 bytes)
+CREATE OR REPLACE FUNCTION wireguard_channel(prefix TEXT, server_name TEXT)
+RETURNS TEXT AS $$
+    SELECT CASE
+        WHEN octet_length(prefix || '.' || server_name) < 64 THEN prefix || '.' || server_name
+        ELSE prefix || '.' || md5(server_name)
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Notifications are sent only to channels of affected servers (e.g. client_peer.default).
+-- The global channels (server_interface, client_peer, change_log) are used by: ALTER DATABASE <db> SET wireguard_pg.global_notify = 'on';
+CREATE OR REPLACE FUNCTION notify_data_change()
+RETURNS TRIGGER AS $$
+DECLARE
+channel_prefix TEXT := TG_TABLE_NAME;
+payload TEXT;
+log_id BIGINT;
+log_interface_id INTEGER;
+new_server TEXT;
+old_server TEXT;
+server TEXT;
+BEGIN
+    IF TG_TABLE_NAME = 'client_peer' THEN
+        log_interface_id := coalesce(NEW.interface_id, OLD.interface_id);
+        SELECT "server_name" INTO new_server FROM "server_interface" WHERE "id" = NEW.interface_id;
+        IF OLD.interface_id IS NOT DISTINCT FROM NEW.interface_id THEN
+            old_server := new_server;
+        ELSE
+            SELECT "server_name" INTO old_server FROM "server_interface" WHERE "id" = OLD.interface_id;
+        END IF;
+    ELSE
+        log_interface_id := coalesce(NEW.id, OLD.id);
+        new_server := NEW.server_name;
+        old_server := OLD.server_name;
+    END IF;
+
+    IF coalesce(current_setting('wireguard_pg.change_log', true), '') = 'on' THEN
+        channel_prefix := 'change_log';
+        IF TG_TABLE_NAME = 'client_peer' THEN
+            INSERT INTO "change_log" ("table_name", "operation", "row_id", "interface_id",
+                                      "old_interface_id", "old_public_key", "old_enabled",
+                                      "server_name", "old_server_name")
+            VALUES (TG_TABLE_NAME, TG_OP, coalesce(NEW.id, OLD.id), NEW.interface_id,
+                    OLD.interface_id, OLD.public_key, OLD.enabled,
+                    new_server, old_server)
+            RETURNING "id" INTO log_id;
+        ELSE
+            INSERT INTO "change_log" ("table_name", "operation", "row_id", "interface_id",
+                                      "old_interface_id", "old_enabled",
+                                      "server_name", "old_server_name")
+            VALUES (TG_TABLE_NAME, TG_OP, coalesce(NEW.id, OLD.id), NEW.id,
+                    OLD.id, OLD.enabled,
+                    new_server, old_server)
+            RETURNING "id" INTO log_id;
+        END IF;
+        payload := json_build_object(
+            'id', log_id,
+            'interface_id', log_interface_id
+        )::TEXT;
+    ELSE
+        payload := json_build_object(
+            'old', row_to_json(OLD),
+            'new', row_to_json(NEW)
+        )::TEXT;
+    END IF;
+
+    IF coalesce(current_setting('wireguard_pg.global_notify', true), '') = 'on' THEN
+        PERFORM pg_notify(channel_prefix, payload);
+    END IF;
+
+    FOR server IN
+        SELECT DISTINCT it FROM unnest(ARRAY[new_server, old_server]) it WHERE it IS NOT NULL
+    LOOP
+        PERFORM pg_notify(wireguard_channel(channel_prefix, server), payload);
+    END LOOP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
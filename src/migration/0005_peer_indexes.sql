@@ -0,0 +1,30 @@
+-- Peers of an interface are also found by the unique index (interface_id, address),
+-- e.g. for ON DELETE CASCADE or used addresses.
+
+-- Active peers of interfaces (WGServer)
+CREATE INDEX IF NOT EXISTS "client_peer_interface_id_enabled" ON "client_peer" ("interface_id", "id") WHERE "enabled";
+
+-- A public key can be used only once on the interface
+DO $$
+DECLARE
+    conflicts text;
+BEGIN
+    -- Duplicate public keys have to be resolved by hand, the index cannot be created
+    SELECT string_agg(format('interface %s, public key %s: peers %s', "interface_id", "public_key", "ids"), '; ')
+    INTO conflicts
+    FROM (
+        SELECT "interface_id", "public_key", string_agg("id"::text, ', ' ORDER BY "id") AS "ids"
+        FROM "client_peer"
+        GROUP BY "interface_id", "public_key"
+        HAVING count(*) > 1
+    ) AS "duplicate";
+    IF conflicts IS NOT NULL THEN
+        RAISE EXCEPTION 'Peers share the same public key: %', conflicts
+            USING HINT = 'Change or delete the conflicting peers and restart the application.';
+    END IF;
+END;
+$$;
+CREATE UNIQUE INDEX IF NOT EXISTS "client_peer_interface_id_public_key" ON "client_peer" ("interface_id", "public_key");
+
+-- Last changes of peers (resynchronization after reconnect)
+CREATE INDEX IF NOT EXISTS "client_peer_interface_id_updated_at" ON "client_peer" ("interface_id", "updated_at");
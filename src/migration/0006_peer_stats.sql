@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS "peer_stats" (
+  "id" integer NOT NULL,
+  PRIMARY KEY ("id"),
+  "interface_id" integer NOT NULL,
+  "endpoint" character varying(64) NULL,
+  "latest_handshake" timestamptz NULL,
+  "transfer_rx" bigint NOT NULL DEFAULT 0,
+  "transfer_tx" bigint NOT NULL DEFAULT 0,
+  "updated_at" timestamptz NOT NULL DEFAULT NOW()
+);
+COMMENT ON TABLE "peer_stats" IS 'Runtime state of peers collected from wg show (id is the id of client_peer)';
+
+ALTER TABLE "peer_stats"
+ADD FOREIGN KEY ("id") REFERENCES "client_peer" ("id") ON DELETE CASCADE ON UPDATE NO ACTION;
+
+CREATE INDEX IF NOT EXISTS "peer_stats_interface_id_latest_handshake" ON "peer_stats" ("interface_id", "latest_handshake");
@@ -0,0 +1,10 @@
+-- Changes of the client template (e.g. DNS or endpoint) are not visible on server_interface,
+-- the version of the client configuration is derived from updated_at of the peer, interface and template.
+ALTER TABLE "server_template" ADD COLUMN IF NOT EXISTS "updated_at" timestamptz NOT NULL DEFAULT NOW();
+
+DROP TRIGGER IF EXISTS trigger_template_set_updated_at ON server_template;
+
+CREATE TRIGGER trigger_template_set_updated_at
+BEFORE UPDATE ON server_template
+FOR EACH ROW
+EXECUTE FUNCTION set_updated_at();
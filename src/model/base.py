@@ -1,7 +1,8 @@
+from functools import lru_cache
 import json
 import asyncpg
 from fastapi import HTTPException, status, Depends, Query
-from typing import TypeVar, Optional, List
+from typing import Any, AsyncIterator, Dict, TypeVar, Optional, List, Tuple
 from pydantic import BaseModel
 from asyncpg import Connection, Record
 
@@ -41,6 +42,43 @@ def query_params(params: CommonQueryParams = Depends()):
     return params.dict()
 
 
+class CursorQueryParams(BaseModel):
+    """
+    Keyset pagination, `after` is the id of the last object of the previous page.
+    """
+    after: Optional[int] = Query(None, ge=0)
+    limit: int = Query(100, ge=1, le=1000)
+
+
+class Filters:
+    """
+    Builder of the WHERE condition with positional arguments.
+    """
+
+    def __init__(self):
+        self.conditions: List[str] = []
+        self.args: list = []
+
+    def add(self, condition: str, value: Any) -> 'Filters':
+        """
+        Add condition with placeholder {} (e.g. 'f."enabled" = {}'), None value is skipped.
+        """
+        if value is not None:
+            self.args.append(value)
+            self.conditions.append(condition.format(f'${len(self.args)}'))
+        return self
+
+    def prefix(self, column: str, value: Optional[str]) -> 'Filters':
+        if value:
+            value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            self.add(f'{column} LIKE {{}}', f'{value}%')
+        return self
+
+    @property
+    def query(self) -> str:
+        return ' AND '.join(self.conditions) or '1=1'
+
+
 # Get Pydantic type
 G = TypeVar('G', bound=BasePModel)      # Full pydantic object
 C = TypeVar('C', bound=BaseModel)       # Create pydantic object
@@ -66,10 +104,32 @@ class BaseDBModel:
             DBConnection.register_startup(handler)
 
     @staticmethod
-    def get_object(cls, row: Record):
+    def get_object(cls, row: Record, trusted: bool = False):
         # We need to remove duplicate couloms from record (e.g. id from two tables)
+        if trusted:
+            # Rows of the database are valid, the validation is skipped
+            return cls.model_construct(**dict(row.items()))
         return cls(**dict(row.items()))
 
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def get_select_sql(cls, query: str, sort_by: str = '', sub_columns: str = '', sub_sql: str = '',
+                       limit_ix: int = 0, offset_ix: int = 0) -> str:
+        """
+        Statement text is cached per (model, query shape). Values are always passed
+        as arguments, so the same shape has the same text and asyncpg reuses
+        its prepared statement.
+        """
+        db_table = getattr(cls.Meta, 'db_view', getattr(cls.Meta, 'db_table', ''))
+        sql = f'SELECT f.* {sub_columns} FROM "{db_table}" f {sub_sql} WHERE {query}'
+        if sort_by:
+            sql += f' ORDER BY {sort_by}'
+        if limit_ix:
+            sql += f' LIMIT ${limit_ix}'
+        if offset_ix:
+            sql += f' OFFSET ${offset_ix}'
+        return sql + ';'
+
     @classmethod
     async def get(cls, db: Connection, query: str | int | G, *args, **kwargs
                   ) -> Optional[G]:
@@ -78,7 +138,7 @@ class BaseDBModel:
         _sub_sql = kwargs.pop('_sub_sql', getattr(_cls.Meta, 'sub_sql', ''))
         _sub_columns = kwargs.pop('_sub_columns', getattr(_cls.Meta, 'sub_columns', ''))
         _pydantic_class = kwargs.pop('_pydantic_class', getattr(_cls.Meta, 'PYDANTIC_CLASS', _cls.Meta.PYDANTIC_CLASS))
-        _db_table = getattr(_cls.Meta, 'db_view', getattr(_cls.Meta, 'db_table', ''))
+        _trusted = kwargs.pop('_trusted', False)
         if isinstance(query, _pydantic_class):
             return query
         if isinstance(query, int) and len(args) == 0:
@@ -86,10 +146,10 @@ class BaseDBModel:
             query = 'f."id"=$1'
 
         if row := await db.fetchrow(
-            f'SELECT f.* {_sub_columns} FROM "{_db_table}" f {_sub_sql} WHERE {query}',
+            _cls.get_select_sql(query, '', _sub_columns, _sub_sql),
             *args
         ):
-            return cls.get_object(_pydantic_class, row)
+            return cls.get_object(_pydantic_class, row, _trusted)
         elif not _raise:
             return None
         else:
@@ -104,23 +164,54 @@ class BaseDBModel:
         _sub_sql = kwargs.pop('_sub_sql', getattr(_cls.Meta, 'sub_sql', ''))
         _sub_columns = kwargs.pop('_sub_columns', getattr(_cls.Meta, 'sub_columns', ''))
         _pydantic_class = kwargs.pop('_pydantic_class', getattr(_cls.Meta, 'PYDANTIC_CLASS', object))
-        _db_table = getattr(_cls.Meta, 'db_view', getattr(_cls.Meta, 'db_table', ''))
+        _trusted = kwargs.pop('_trusted', False)
         if not sort_by and hasattr(_cls.Meta, 'DEFAULT_SORT_BY'):
             sort_by = getattr(_cls.Meta, 'DEFAULT_SORT_BY')
-        if sort_by:
-            sort_by = f'ORDER BY {sort_by}'
-        _post_sql = ' '
+        limit_ix, offset_ix = (0, 0)
         if limit:
-            _post_sql += f' LIMIT {limit}'
+            args = (*args, limit)
+            limit_ix = len(args)
         if offset:
-            _post_sql += f' OFFSET {offset}'
+            args = (*args, offset)
+            offset_ix = len(args)
 
         rows = await db.fetch(
-            f'SELECT f.* {_sub_columns} FROM "{_db_table}" f {_sub_sql} '
-            f'WHERE {query} {sort_by}{_post_sql};',
+            _cls.get_select_sql(query, sort_by, _sub_columns, _sub_sql, limit_ix, offset_ix),
             *args
         )
-        return [cls.get_object(_pydantic_class, row) for row in rows]
+        return [cls.get_object(_pydantic_class, row, _trusted) for row in rows]
+
+    @classmethod
+    async def gets_after(cls, db: Connection, query='1=1', *args, after: int = None,
+                         limit: int = 0, **kwargs) -> List[G]:
+        """
+        Keyset pagination, objects sorted by id greater than `after`.
+        """
+        if after is not None:
+            args = (*args, after)
+            query = f'({query}) AND f."id" > ${len(args)}'
+        return await cls.gets(db, query, *args, limit=limit, sort_by='f."id"', **kwargs)
+
+    @classmethod
+    async def iterate(cls, db: Connection, query='1=1', *args, sort_by='', prefetch: int = 1000,
+                      **kwargs) -> AsyncIterator[G]:
+        """
+        Objects read by the server-side cursor, the memory does not depend on the number of rows.
+        """
+        _cls = kwargs.pop('_cls', cls)
+        _sub_sql = kwargs.pop('_sub_sql', getattr(_cls.Meta, 'sub_sql', ''))
+        _sub_columns = kwargs.pop('_sub_columns', getattr(_cls.Meta, 'sub_columns', ''))
+        _pydantic_class = kwargs.pop('_pydantic_class', getattr(_cls.Meta, 'PYDANTIC_CLASS', object))
+        _trusted = kwargs.pop('_trusted', False)
+        if not sort_by and hasattr(_cls.Meta, 'DEFAULT_SORT_BY'):
+            sort_by = getattr(_cls.Meta, 'DEFAULT_SORT_BY')
+        # Cursors exist only inside of a transaction
+        async with db.transaction(readonly=True):
+            async for row in db.cursor(
+                _cls.get_select_sql(query, sort_by, _sub_columns, _sub_sql),
+                *args, prefetch=prefetch
+            ):
+                yield cls.get_object(_pydantic_class, row, _trusted)
 
     @classmethod
     def json_encoder(obj):
@@ -152,8 +243,8 @@ class BaseDBModel:
         try:
             if not kwargs.get('_drain'):
                 await db.execute(
-                    f'UPDATE "{_cls.Meta.db_table}" SET {",".join(columns)} WHERE id = {obj.id}',
-                    *values
+                    f'UPDATE "{_cls.Meta.db_table}" SET {",".join(columns)} WHERE id = ${len(values) + 1}',
+                    *values, obj.id
                 )
         except asyncpg.exceptions.IntegrityConstraintViolationError as e:
             raise ConstrainError(str(e))
@@ -218,6 +309,83 @@ class BaseDBModel:
         if hasattr(_cls, 'post_delete'):
             await _cls.post_delete(db, obj, **kwargs)
 
+    @classmethod
+    def get_bulk_values(cls, objs: List[BaseModel]) -> Tuple[List[str], List[list]]:
+        """
+        Columns and values (one list per column) of objects for multi-row queries.
+        Types of columns are defined by Meta.COLUMN_TYPES.
+        """
+        columns = [key for key in cls.Meta.COLUMN_TYPES.keys() if key != 'id']
+        values = [[getattr(obj, key) for obj in objs] for key in columns]
+        return columns, values
+
+    @classmethod
+    async def create_many(cls, db: Connection, creates: List[C], **kwargs) -> List[G]:
+        """
+        Insert objects by one multi-row query.
+        """
+        _cls = kwargs.pop('_cls', cls)
+        if not creates:
+            return []
+        org_creates = creates
+        if hasattr(_cls, 'pre_create_many') and (pre := await _cls.pre_create_many(db, creates, **kwargs)):
+            creates = pre
+        columns, values = _cls.get_bulk_values(creates)
+        names = ','.join(f'"{it}"' for it in columns)
+        arrays = ','.join(f'${ix + 1}::{_cls.Meta.COLUMN_TYPES[it]}[]' for ix, it in enumerate(columns))
+        try:
+            rows = await db.fetch(
+                f'INSERT INTO "{_cls.Meta.db_table}" ({names}) '
+                f'SELECT * FROM unnest({arrays}) RETURNING *;',
+                *values
+            )
+        except asyncpg.exceptions.IntegrityConstraintViolationError as e:
+            raise ConstrainError(str(e))
+        data = [dict(**row) for row in rows]
+        if hasattr(_cls, 'post_create_many') and (post := await _cls.post_create_many(db, data, org_creates, **kwargs)):
+            return post
+        return [_cls.Meta.PYDANTIC_CLASS(**it) for it in data]
+
+    @classmethod
+    async def update_many(cls, db: Connection, updates: Dict[int, U], **kwargs) -> List[G]:
+        """
+        Update objects (id => update) by one multi-row query. All columns are updated.
+        """
+        _cls = kwargs.pop('_cls', cls)
+        if not updates:
+            return []
+        if hasattr(_cls, 'pre_update_many') and (pre := await _cls.pre_update_many(db, updates, **kwargs)):
+            updates = pre
+        columns, values = _cls.get_bulk_values(list(updates.values()))
+        names = ','.join(f'"{it}"' for it in columns)
+        sets = ','.join(f'"{it}" = u."{it}"' for it in columns)
+        arrays = ','.join(f'${ix + 2}::{_cls.Meta.COLUMN_TYPES[it]}[]' for ix, it in enumerate(columns))
+        try:
+            rows = await db.fetch(
+                f'UPDATE "{_cls.Meta.db_table}" f SET {sets} '
+                f'FROM unnest($1::int[],{arrays}) AS u("id",{names}) '
+                'WHERE f."id" = u."id" RETURNING f.*;',
+                list(updates.keys()),
+                *values
+            )
+        except asyncpg.exceptions.IntegrityConstraintViolationError as e:
+            raise ConstrainError(str(e))
+        if len(rows) != len(updates):
+            missing = set(updates.keys()).difference(row['id'] for row in rows)
+            raise ObjectNotFound(f'Objects {_cls.__name__} not found: {sorted(missing)}')
+        return [cls.get_object(_cls.Meta.PYDANTIC_CLASS, row) for row in rows]
+
+    @classmethod
+    async def delete_many(cls, db: Connection, ids: List[int], **kwargs):
+        _cls = kwargs.pop('_cls', cls)
+        rows = await db.fetch(
+            f'DELETE FROM "{_cls.Meta.db_table}" WHERE id = ANY($1::int[]) RETURNING id;',
+            ids
+        )
+        if len(rows) != len(set(ids)):
+            missing = set(ids).difference(row['id'] for row in rows)
+            raise ObjectNotFound(f'Objects {_cls.__name__} not found: {sorted(missing)}')
+
     @classmethod
     def convert_object(cls, obj, toClass, **kwargs) -> BaseModel:
         # We need to remove duplicate couloms from record (e.g. id from two tables)
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+from asyncpg import Connection
+from pydantic import Field
+from model.base import BaseDBModel, BasePModel
+
+
+class ChangeLog(BasePModel):
+    table_name: str
+    operation: str
+    row_id: int
+    interface_id: Optional[int] = Field(None)
+    old_interface_id: Optional[int] = Field(None)
+    old_public_key: Optional[str] = Field(None)
+    old_enabled: Optional[bool] = Field(None)
+    server_name: Optional[str] = Field(None)
+    old_server_name: Optional[str] = Field(None)
+    created_at: datetime
+
+
+class ChangeLogDB(BaseDBModel):
+    class Meta:
+        db_table = 'change_log'
+        PYDANTIC_CLASS = ChangeLog
+        DEFAULT_SORT_BY: str = 'id'
+
+    @classmethod
+    async def get_last_id(cls, db: Connection) -> int:
+        return await db.fetchval('SELECT COALESCE(MAX("id"), 0) FROM "change_log";')
+
+    @classmethod
+    async def get_ids(cls, db: Connection, last_id: int, missing: List[int], limit: int) -> List[int]:
+        """
+        Ids of records of all servers newer than `last_id` or in `missing` (sorted).
+        """
+        rows = await db.fetch(
+            'SELECT "id" FROM "change_log" WHERE "id" > $1 OR "id" = ANY($2::bigint[]) ORDER BY "id" LIMIT $3;',
+            last_id, missing, limit
+        )
+        return [row['id'] for row in rows]
+
+    @classmethod
+    async def prune(cls, db: Connection, retention: timedelta):
+        await db.execute(
+            'DELETE FROM "change_log" WHERE "created_at" < NOW() - $1::interval;',
+            retention
+        )
@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+import io
+import re
+import tarfile
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+import zipfile
+from asyncpg import Connection
+
+from config import get_config
+from lib.helper import get_process_executor, get_qrcode, render_template
+from model.interface import Interface
+from model.peer import Peer, PeerDB
+
+EXPORT_CHUNK = get_config('EXPORT_CHUNK', wrapper=int)
+EXPORT_CONCURRENCY = get_config('EXPORT_CONCURRENCY', wrapper=int)
+# Format => media type
+ARCHIVE_FORMATS = {
+    'zip': 'application/zip',
+    'tar': 'application/x-tar',
+    'tar.gz': 'application/gzip',
+}
+
+# (file name, content)
+ArchiveFile = Tuple[str, bytes]
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Write-only stream, the written data are taken by `pop` (archives are not seekable).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ArchiveWriter:
+    """
+    Incremental ZIP or tar archive, every call returns the next part of the archive.
+    """
+
+    def __init__(self, archive_format: str = 'zip'):
+        self.buffer = _StreamBuffer()
+        if archive_format == 'zip':
+            self.archive = zipfile.ZipFile(self.buffer, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            mode = 'w|gz' if archive_format == 'tar.gz' else 'w|'
+            self.archive = tarfile.open(fileobj=self.buffer, mode=mode)
+
+    def add(self, files: List[ArchiveFile]) -> bytes:
+        for name, content in files:
+            if isinstance(self.archive, zipfile.ZipFile):
+                self.archive.writestr(name, content)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mtime = int(time.time())
+                info.mode = 0o600
+                self.archive.addfile(info, io.BytesIO(content))
+        return self.buffer.pop()
+
+    def close(self) -> bytes:
+        self.archive.close()
+        return self.buffer.pop()
+
+
+def get_file_name(peer: Peer) -> str:
+    return f'{re.sub(r"[^0-9A-Za-z._-]+", "_", peer.name)}-{peer.id}'
+
+
+def render_client_files(interface: Interface, peers: List[Peer], qrcode: bool = False) -> List[ArchiveFile]:
+    """
+    Client configurations (and QR codes) of peers, it runs in the worker pool.
+    """
+    res = []
+    folder = interface.interface_name
+    for peer in peers:
+        config = render_template('client.conf.j2', interface=interface, peer=peer)
+        res.append((f'{folder}/{get_file_name(peer)}.conf', config.encode()))
+        if qrcode:
+            res.append((f'{folder}/{get_file_name(peer)}.png', get_qrcode(config)))
+    return res
+
+
+async def export_client_configs(db: Connection, interface: Interface, archive_format: str = 'zip',
+                                qrcode: bool = False, enabled: Optional[bool] = None) -> AsyncIterator[bytes]:
+    """
+    Archive of client configurations of the interface. Peers are read by the cursor and rendered
+    by the worker pool in chunks of EXPORT_CHUNK peers, at most EXPORT_CONCURRENCY chunks
+    are processed at once, so the memory does not depend on the number of peers.
+    The private keys are not stored, the configurations have a placeholder.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_process_executor()
+    archive = ArchiveWriter(archive_format)
+    pending = deque()
+    query, args = 'f."interface_id" = $1', [interface.id]
+    if enabled is not None:
+        query, args = f'{query} AND f."enabled" = $2', [interface.id, enabled]
+
+    async def write() -> bytes:
+        return await asyncio.to_thread(archive.add, await pending.popleft())
+
+    chunk = []
+    async for peer in PeerDB.iterate(db, query, *args, sort_by='f."id"', prefetch=EXPORT_CHUNK * EXPORT_CONCURRENCY):
+        chunk.append(peer)
+        if len(chunk) < EXPORT_CHUNK:
+            continue
+        pending.append(loop.run_in_executor(executor, render_client_files, interface, chunk, qrcode))
+        chunk = []
+        if len(pending) >= EXPORT_CONCURRENCY:
+            yield await write()
+    if chunk:
+        pending.append(loop.run_in_executor(executor, render_client_files, interface, chunk, qrcode))
+    while pending:
+        yield await write()
+    yield await asyncio.to_thread(archive.close)
@@ -1,10 +1,11 @@
-from ipaddress import IPv4Address, IPv4Interface, ip_interface
+from ipaddress import IPv4Address, ip_interface
 from typing import List, Optional
 from datetime import datetime
 from asyncpg import Connection
 import loggate
 from pydantic import BaseModel, Field, model_validator
-from lib.helper import get_file_content, get_wg_private_key, get_wg_public_key, ip_range_to_ips, optimalize_ip_range
+from lib.helper import get_wg_private_key, get_wg_public_key, optimalize_ip_range, read_file
+from lib.ippool import IPPool
 from model.base import BaseDBModel
 
 
@@ -36,7 +37,7 @@ class InterfaceSimpleUpdate(BaseModel):
 
     def get_private_key(self):
         if self.private_key.startswith('file://'):
-            return get_file_content(self.private_key.replace('file://', '')).strip()
+            return read_file(self.private_key.replace('file://', '')).strip()
         return self.private_key
 
 
@@ -97,20 +98,18 @@ class InterfaceUpdate(InterfaceSimpleUpdate, InterfaceTemplateUpdate):
 
 
 class InterfaceCreate(InterfaceUpdate):
+    # Missing keys are generated by InterfaceDB.pre_create
+    public_key: Optional[str] = Field(None, max_length=255)
 
     @model_validator(mode='before')
     @classmethod
     def check_keys(cls, data) -> dict:
-        if not data.get('private_key'):
-            data['private_key'] = get_wg_private_key()
-        elif data['private_key'].startswith('file://') and not data.get('public_key'):
+        if (data.get('private_key') or '').startswith('file://') and not data.get('public_key'):
             raise InterfaceError(
                 'If the private key is placed in local file %s, '
                 'the public key is required.',
                 data['private_key']
             )
-        if not data.get('public_key'):
-            data['public_key'] = get_wg_public_key(data['private_key'])
 
         if data.get('ip_range') and (ip_range := optimalize_ip_range(data['ip_range'])):
             # Optimalize IP range
@@ -130,7 +129,8 @@ class InterfaceDB(BaseDBModel):
         PYDANTIC_CLASS = Interface
         DEFAULT_SORT_BY: str = 'f.id'
         sub_sql = 'LEFT JOIN "server_template" st USING("id")'
-        sub_columns = ',st.*'
+        # Explicit columns, "id" and "updated_at" of the template must not overwrite the interface
+        sub_columns = ''.join(f',st."{it}"' for it in InterfaceTemplateUpdate.model_fields)
 
     @classmethod
     async def pre_update(cls, db: Connection, interface: Interface, update: InterfaceUpdate, **kwargs):
@@ -140,6 +140,10 @@ class InterfaceDB(BaseDBModel):
 
     @classmethod
     async def pre_create(cls, db: Connection, create: InterfaceCreate, **kwargs):
+        if not create.private_key:
+            create.private_key = await get_wg_private_key()
+        if not create.public_key:
+            create.public_key = await get_wg_public_key(create.private_key)
         return cls.convert_object(create, InterfaceSimpleUpdate)
 
     @classmethod
@@ -154,19 +158,26 @@ class InterfaceDB(BaseDBModel):
             'SELECT "address" FROM "client_peer" WHERE "interface_id" = $1;',
             interface_id
         )
-        return [ip_interface(it['address']).ip for it in rows]
+        # Blank lines of the address are skipped
+        return [
+            ip for it in rows for line in (it['address'] or '').splitlines()
+            if line.strip() and (ip := ip_interface(line.strip()).ip).version == 4
+        ]
 
     @classmethod
-    async def get_free_ips(cls, db: Connection, interface: Interface) -> List[IPv4Interface]:
-        if not interface.ip_range:
-            return
-        ips = set(ip_range_to_ips(interface.ip_range))
-        used_ips = set()
+    async def get_free_ip_pool(cls, db: Connection, interface: Interface) -> IPPool:
+        pool = IPPool.from_range(interface.ip_range)
+        used_ips = []
         if hasattr(interface, 'id'):
-            used_ips = set(await cls.get_used_ips(db, interface.id))
+            used_ips = await cls.get_used_ips(db, interface.id)
         if interface.address:
             for ip in interface.address.splitlines():
-                used_ips.add(ip_interface(ip).ip)
-        ips = list(ips.difference(used_ips))
-        ips.sort()
-        return ips
+                if ip.strip():
+                    used_ips.append(ip_interface(ip.strip()).ip)
+        return pool.difference(it for it in used_ips if it.version == 4)
+
+    @classmethod
+    async def get_free_ips(cls, db: Connection, interface: Interface, limit: int = 1) -> List[IPv4Address]:
+        if not interface.ip_range:
+            return
+        return (await cls.get_free_ip_pool(db, interface)).take(limit)
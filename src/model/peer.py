@@ -1,10 +1,13 @@
+import asyncio
+from collections import defaultdict
 from ipaddress import ip_interface
-from typing import Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 from asyncpg import Connection
-from pydantic import BaseModel, Field, model_validator
-from lib.helper import get_qrcode_based64, get_wg_private_key, get_wg_public_key, render_template
-from model.base import BaseDBModel
+from pydantic import BaseModel, Field
+from lib.helper import checksum, get_qrcode_based64, get_wg_private_key, get_wg_public_key, get_wg_secret_pairs, \
+    render_template, render_template_async
+from model.base import BaseDBModel, ConstrainError
 from model.interface import InterfaceDB
 
 
@@ -25,16 +28,9 @@ class PeerCreate(PeerUpdate):
 
 
 class PeerCreatePrivateKey(PeerCreate):
+    # Missing keys are generated by PeerDB.pre_create
     private_key: Optional[str] = Field(None)
 
-    @model_validator(mode='before')
-    @classmethod
-    def check_keys(cls, data) -> dict:
-        if not data.get('public_key'):
-            data['private_key'] = get_wg_private_key()
-            data['public_key'] = get_wg_public_key(data['private_key'])
-        return data
-
 
 class PeerCreated(PeerUpdate):
     id: int
@@ -54,35 +50,145 @@ class PeerDB(BaseDBModel):
         db_table = 'client_peer'
         PYDANTIC_CLASS = Peer
         DEFAULT_SORT_BY: str = 'id'
+        ADDRESS_LOCK: int = 0x5747     # key of advisory lock (pair with interface id)
+        COLUMN_TYPES: dict = {
+            'interface_id': 'int',
+            'name': 'varchar',
+            'description': 'varchar',
+            'public_key': 'varchar',
+            'preshared_key': 'varchar',
+            'allowed_ips': 'text',
+            'address': 'varchar',
+            'enabled': 'bool',
+        }
+
+    @classmethod
+    async def allocate_addresses(cls, db: Connection, interface_id: int, count: int = 1,
+                                 exclude: List[str] = None) -> List[str]:
+        """
+        Find free addresses of the interface. It has to be called in the transaction.
+        The advisory lock is held till the end of the transaction, so parallel
+        allocations on the same interface (also from other instances) wait
+        until the address is stored.
+        """
+        exclude = set(exclude or [])
+        await db.execute('SELECT pg_advisory_xact_lock($1, $2);', cls.Meta.ADDRESS_LOCK, interface_id)
+        iface = await InterfaceDB.get(db, interface_id)
+        ips = await InterfaceDB.get_free_ips(db, iface, count + len(exclude)) or []
+        return [addr for it in ips if (addr := str(ip_interface(it))) not in exclude][:count]
+
+    @classmethod
+    async def allocate_missing_addresses(cls, db: Connection, peers: List[PeerUpdate]):
+        """
+        Set free addresses to peers without address, one allocation per interface.
+        """
+        missing = defaultdict(list)
+        used = defaultdict(list)
+        for peer in peers:
+            if peer.address:
+                peer.address = str(ip_interface(peer.address))
+                used[peer.interface_id].append(peer.address)
+            else:
+                missing[peer.interface_id].append(peer)
+        for interface_id in sorted(missing.keys()):
+            ips = await cls.allocate_addresses(db, interface_id, len(missing[interface_id]), used[interface_id])
+            if len(ips) < len(missing[interface_id]):
+                raise ConstrainError(f'Interface {interface_id} has not enough free addresses.')
+            for peer, ip in zip(missing[interface_id], ips):
+                peer.address = ip
 
     @classmethod
     async def pre_update(cls, db: Connection,
                          peer: Peer, update: PeerUpdate, **kwargs):
         if not update.address:
-            iface = await InterfaceDB.get(db, update.interface_id)
-            if ips := await InterfaceDB.get_free_ips(db, iface):
+            if ips := await cls.allocate_addresses(db, update.interface_id):
                 update.address = ips.pop(0)
         update.address = str(ip_interface(update.address))
 
     @classmethod
     async def pre_create(cls, db: Connection,
                          create: PeerCreatePrivateKey, **kwargs):
+        if not create.public_key:
+            create.private_key = await get_wg_private_key()
+            create.public_key = await get_wg_public_key(create.private_key)
         if not create.address:
-            iface = await InterfaceDB.get(db, create.interface_id)
-            if ips := await InterfaceDB.get_free_ips(db, iface):
+            if ips := await cls.allocate_addresses(db, create.interface_id):
                 create.address = ips.pop(0)
         create.address = str(ip_interface(create.address))
         return cls.convert_object(create, PeerCreate)
 
     @classmethod
-    async def post_create(cls, db: Connection, data: dict, create: PeerCreatePrivateKey, **kwargs):
-        iface = await InterfaceDB.get(db, create.interface_id)
-        print(create)
-        peer: PeerCreated = cls.convert_object(create, PeerCreated, **data)
-        peer.client_config = render_template(
+    async def get_client_config(cls, db: Connection, peer: Peer | PeerCreated) -> str:
+        """
+        Configuration of the client, the private key is not stored, so it has a placeholder for existing peers.
+        """
+        return await render_template_async(
             'client.conf.j2',
-            interface=iface,
+            interface=await InterfaceDB.get(db, peer.interface_id, _raise=True),
             peer=peer
         )
-        peer.qrcode = get_qrcode_based64(peer.client_config)
+
+    @classmethod
+    async def get_client_config_etag(cls, db: Connection, peer_id: int) -> Optional[str]:
+        """
+        Strong ETag of the client configuration derived from updated_at of the peer, interface and template
+        (one indexed lookup, the configuration is not rendered). None, if the peer does not exist.
+        """
+        row = await db.fetchrow(
+            '''
+                SELECT p."updated_at", i."updated_at", t."updated_at"
+                FROM "client_peer" p
+                    JOIN "server_interface" i ON i."id" = p."interface_id"
+                    LEFT JOIN "server_template" t ON t."id" = p."interface_id"
+                WHERE p."id" = $1;
+            ''',
+            peer_id
+        )
+        if not row:
+            return None
+        version = ':'.join(str(it.timestamp()) if it else '' for it in row)
+        return f'"{checksum(f"{peer_id}:{version}")}"'
+
+    @classmethod
+    async def post_create(cls, db: Connection, data: dict, create: PeerCreatePrivateKey, **kwargs):
+        peer: PeerCreated = cls.convert_object(create, PeerCreated, **data)
+        peer.client_config = await cls.get_client_config(db, peer)
+        if kwargs.get('_qrcode', True):
+            peer.qrcode = await get_qrcode_based64(peer.client_config)
         return peer
+
+    @classmethod
+    async def pre_create_many(cls, db: Connection, creates: List[PeerCreatePrivateKey], **kwargs):
+        missing = [it for it in creates if not it.public_key]
+        for create, (private_key, public_key) in zip(missing, await get_wg_secret_pairs(len(missing))):
+            create.private_key = private_key
+            create.public_key = public_key
+        await cls.allocate_missing_addresses(db, creates)
+        return creates
+
+    @classmethod
+    async def post_create_many(cls, db: Connection, data: List[dict], creates: List[PeerCreatePrivateKey], **kwargs):
+        ifaces = {
+            iface.id: iface
+            for iface in await InterfaceDB.gets(db, 'f.id = ANY($1::int[])', list({it['interface_id'] for it in data}))
+        }
+        creates = {(it.interface_id, it.address): it for it in creates}
+        peers: List[PeerCreated] = [
+            cls.convert_object(creates[(it['interface_id'], it['address'])], PeerCreated, **it)
+            for it in data
+        ]
+
+        def render():
+            for peer in peers:
+                peer.client_config = render_template(
+                    'client.conf.j2',
+                    interface=ifaces[peer.interface_id],
+                    peer=peer
+                )
+        await asyncio.to_thread(render)
+        return peers
+
+    @classmethod
+    async def pre_update_many(cls, db: Connection, updates: Dict[int, PeerUpdate], **kwargs):
+        await cls.allocate_missing_addresses(db, list(updates.values()))
+        return updates
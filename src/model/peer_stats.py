@@ -0,0 +1,51 @@
+from datetime import datetime
+from typing import List, Optional, Tuple
+from asyncpg import Connection
+from pydantic import Field
+from model.base import BaseDBModel, BasePModel
+
+
+class PeerStats(BasePModel):
+    # id of the peer
+    interface_id: int
+    endpoint: Optional[str] = Field(None)
+    latest_handshake: Optional[datetime] = Field(None)
+    transfer_rx: int = Field(0)
+    transfer_tx: int = Field(0)
+    updated_at: datetime
+
+
+class PeerStatsDB(BaseDBModel):
+    class Meta:
+        db_table = 'peer_stats'
+        PYDANTIC_CLASS = PeerStats
+        DEFAULT_SORT_BY: str = 'id'
+
+    @classmethod
+    async def upsert_many(cls, db: Connection, rows: List[Tuple[int, int, Optional[str], int, int, int]]):
+        """
+        Store stats by one multi-row query, rows are tuples
+        (peer id, interface id, endpoint, latest handshake (unix time), rx bytes, tx bytes).
+        Stats of deleted peers are skipped.
+        """
+        if not rows:
+            return
+        await db.execute(
+            '''
+                INSERT INTO "peer_stats" ("id", "interface_id", "endpoint", "latest_handshake",
+                                          "transfer_rx", "transfer_tx", "updated_at")
+                SELECT u."id", u."interface_id", u."endpoint", to_timestamp(NULLIF(u."latest_handshake", 0)),
+                       u."transfer_rx", u."transfer_tx", NOW()
+                FROM unnest($1::int[], $2::int[], $3::varchar[], $4::bigint[], $5::bigint[], $6::bigint[])
+                    AS u("id", "interface_id", "endpoint", "latest_handshake", "transfer_rx", "transfer_tx")
+                WHERE EXISTS (SELECT 1 FROM "client_peer" p WHERE p."id" = u."id")
+                ON CONFLICT ("id") DO UPDATE SET
+                    "interface_id" = EXCLUDED."interface_id",
+                    "endpoint" = EXCLUDED."endpoint",
+                    "latest_handshake" = EXCLUDED."latest_handshake",
+                    "transfer_rx" = EXCLUDED."transfer_rx",
+                    "transfer_tx" = EXCLUDED."transfer_tx",
+                    "updated_at" = EXCLUDED."updated_at";
+            ''',
+            *(list(it) for it in zip(*rows))
+        )
@@ -1,22 +1,67 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import hashlib
+from ipaddress import ip_interface
 import json
 import os
+import re
+import time
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from asyncpg import Connection
 from loggate import getLogger
 
-from config import get_config
+from config import get_config, to_bool
+from lib import metrics
 from lib.db import DBConnection, db_logger
-from lib.helper import checksum, cmd, get_file_content, render_template, write_file
+from lib.debounce import DebounceQueue
+from lib.helper import checksum, gather_limited, get_file_content, write_file
+from lib.wg import WGInterface, diff_peers
+from lib.wg_backend import WGBackend, get_backend
+from model.change_log import ChangeLog, ChangeLogDB
 from model.interface import InterfaceSimple, InterfaceSimpleDB
-from model.peer import PeerDB
+from model.peer_stats import PeerStatsDB
+from model.server_state import InterfaceState, PeerState, load_peer_states
 
 
 WIREGUARD_CONFIG_FOLDER = get_config('WIREGUARD_CONFIG_FOLDER', wrapper=Path)
+WIREGUARD_RECONCILE_INTERVAL = get_config('WIREGUARD_RECONCILE_INTERVAL', wrapper=float)
+WIREGUARD_DRIFT_INTERVAL = get_config('WIREGUARD_DRIFT_INTERVAL', wrapper=float)
+WIREGUARD_EVENT_DELAY = get_config('WIREGUARD_EVENT_DELAY', wrapper=float)
+WIREGUARD_EVENT_MAX_DELAY = get_config('WIREGUARD_EVENT_MAX_DELAY', wrapper=float)
+WIREGUARD_INCREMENTAL_LIMIT = get_config('WIREGUARD_INCREMENTAL_LIMIT', wrapper=int)
+WIREGUARD_STARTUP_CONCURRENCY = get_config('WIREGUARD_STARTUP_CONCURRENCY', wrapper=int)
+WIREGUARD_WRITE_DELAY = get_config('WIREGUARD_WRITE_DELAY', wrapper=float)
+WIREGUARD_STATS_INTERVAL = get_config('WIREGUARD_STATS_INTERVAL', wrapper=float)
+WIREGUARD_STATS_FLUSH_INTERVAL = get_config('WIREGUARD_STATS_FLUSH_INTERVAL', wrapper=float)
+WIREGUARD_STATS_BATCH = get_config('WIREGUARD_STATS_BATCH', wrapper=int)
+WIREGUARD_DEFAULT_MTU = get_config('WIREGUARD_DEFAULT_MTU', wrapper=int)
+CHANGE_LOG = get_config('CHANGE_LOG', wrapper=to_bool)
+CHANGE_LOG_BATCH = get_config('CHANGE_LOG_BATCH', wrapper=int)
+CHANGE_LOG_RETENTION = get_config('CHANGE_LOG_RETENTION', wrapper=lambda x: timedelta(hours=float(x)))
+CHANGE_LOG_GAP_TIMEOUT = get_config('CHANGE_LOG_GAP_TIMEOUT', wrapper=float)
+# Transactions are committed later than their updated_at is set
+RESYNC_MARGIN = timedelta(minutes=1)
+# Log records can be committed out of order of their ids, records before the start are read again
+CHANGE_LOG_LOOKBACK = 100
+# Attributes applied only by wg-quick, their change restarts the interface
+RESTART_ATTRIBUTES = ('dns', 'table', 'pre_up', 'post_up', 'pre_down', 'post_down')
 
 logger = getLogger('wgserver')
 
+event_lag = metrics.histogram(
+    'event_lag_seconds', 'Time from the change of the row (updated_at) to the applied kernel state.', ('table',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+events_total = metrics.counter('events_total', 'Processed events of interfaces.', ('type',))
+reconcile_total = metrics.counter(
+    'reconcile_total', 'Synchronizations of interfaces by result '
+    '(in_sync, repaired, syncconf, started).', ('result',)
+)
+interface_starts = metrics.counter('interface_starts_total', 'Starts and restarts by wg-quick.', ('interface',))
+
 
 class WGServer:
 
@@ -25,87 +70,482 @@ class WGServer:
         return os.path.basename(path).replace('.conf', '') if str(path).endswith('.conf') else path
 
     @staticmethod
-    def get_config_from_iface(iface: str | Path, path: Path = WIREGUARD_CONFIG_FOLDER) -> Path:
+    def get_config_from_iface(iface: str | Path, path: Path = None) -> Path:
         if str(iface).endswith('.conf'):
             return iface
-        return path.joinpath(f'{iface}.conf')
+        return (path or WIREGUARD_CONFIG_FOLDER).joinpath(f'{iface}.conf')
 
     @staticmethod
     def get_local_config_files() -> List[Path]:
         WIREGUARD_CONFIG_FOLDER.mkdir(parents=True, exist_ok=True)
         return WIREGUARD_CONFIG_FOLDER.glob('*.conf')
 
-    def __init__(self, server_name: str) -> None:
+    @staticmethod
+    def get_addresses(address: str) -> List[str]:
+        return [str(ip_interface(it.strip())) for it in re.split(',|\n', address or '') if it.strip()]
+
+    @staticmethod
+    def get_channel(prefix: str, server_name: str) -> str:
+        """
+        Notification channel of the server, the same as SQL function wireguard_channel.
+        """
+        channel = f'{prefix}.{server_name}'
+        if len(channel.encode()) < 64:
+            return channel
+        return f'{prefix}.{hashlib.md5(server_name.encode()).hexdigest()}'
+
+    def __init__(self, server_name: str, backend: WGBackend = None) -> None:
         self.server_name = server_name
-        self.interface_ids = set()
-        DBConnection.register_notification('server_interface', self.notification_interface)
-        DBConnection.register_notification('client_peer', self.notification_peer)
+        # Kernel operations (subprocess, netlink or fake)
+        self.backend = backend or get_backend()
+        # Desired state of managed interfaces, maintained from notifications
+        self.interfaces: Dict[int, InterfaceState] = {}
+        self.last_change: datetime = None   # high-water mark of seen changes
+        self.db_conn: DBConnection = None
+        self.reconcile_task: asyncio.Task = None
+        self.drift_task: asyncio.Task = None
+        self.queue = DebounceQueue(
+            self.process_events, WIREGUARD_EVENT_DELAY, WIREGUARD_EVENT_MAX_DELAY, 'wg-events'
+        )
+        self.change_log_id = 0      # last read record of change log
+        # Skipped ids (not committed yet or rolled back) => time of the detection
+        self.change_log_missing: Dict[int, float] = {}
+        self.change_log_event = asyncio.Event()
+        self.change_log_task: asyncio.Task = None
+        # peer id => (interface id, endpoint, latest handshake, rx bytes, tx bytes)
+        self.stats: Dict[int, Tuple[int, Optional[str], int, int, int]] = {}
+        self.stats_changed = set()
+        self.stats_task: asyncio.Task = None
+        self.write_task: asyncio.Task = None
+        # Configuration file => lock, writes of the same file are serialized
+        self.write_locks: Dict[Path, asyncio.Lock] = defaultdict(asyncio.Lock)
+        metrics.gauge('event_queue_size', 'Events waiting in the queue.').callback = self.queue.size
+        metrics.gauge('peers', 'Active peers of managed interfaces.', ('interface',)).callback = lambda: {
+            (state.interface.interface_name,): len(state) for state in self.interfaces.values()
+        }
+        # Triggers send notifications only to channels of affected servers
+        if CHANGE_LOG:
+            DBConnection.register_notification(
+                self.get_channel('change_log', server_name), self.notification_change_log
+            )
+            DBConnection.register_reconnect(self.notification_change_log)
+        else:
+            DBConnection.register_notification(
+                self.get_channel('server_interface', server_name), self.notification_interface
+            )
+            DBConnection.register_notification(
+                self.get_channel('client_peer', server_name), self.notification_peer
+            )
+            DBConnection.register_reconnect(self.resync)
 
-    def is_interface_exist(self, iface: str):
-        iface = self.get_iface_from_config(iface)
-        res = cmd('ip', 'link', 'show', iface, ignore_error=True)
-        return res and res.returncode == 0
+    async def is_interface_exist(self, iface: str):
+        return await self.backend.interface_exists(self.get_iface_from_config(iface))
 
-    def interface_down(self, iface):
-        if self.is_interface_exist(iface):
+    async def interface_down(self, iface):
+        if await self.is_interface_exist(iface):
             iface = self.get_config_from_iface(iface)
             logger.info('Stop interface %s', iface)
-            res = cmd('wg-quick', 'down', str(iface))
-            if not res or res.returncode != 0:
+            if not await self.backend.interface_down(iface):
                 logger.warning('Problem with stopping interface.')
 
-    def interface_up(self, iface, force: bool = False):
-        if self.is_interface_exist(iface) and not force:
+    async def interface_up(self, iface, force: bool = False):
+        if await self.is_interface_exist(iface) and not force:
             return
         iface = self.get_config_from_iface(iface)
-        self.interface_down(iface)
+        await self.interface_down(iface)
         logger.info('Start interface %s', iface)
-        res = cmd('wg-quick', 'up', str(iface))
-        if not res or res.returncode != 0:
+        interface_starts.inc(interface=self.get_iface_from_config(iface))
+        if not await self.backend.interface_up(iface):
             logger.warning('Problem with starting interface %s.', iface)
 
+    @asynccontextmanager
+    async def __acquire(self, name: str = 'server'):
+        async with self.db_conn.pool.acquire() as db, db_logger(name, db):
+            yield db
+
     async def start_server(self, db_conn: DBConnection):
         logger.info('Starting Wireguard server')
+        self.db_conn = db_conn
+        force_update = set()
+        managed: Dict[Path, InterfaceState] = {}
         if db_conn.pool:
-            conf_files = {it: checksum(get_file_content(it)) for it in self.get_local_config_files()}
-            force_update = set()
-
+            local_files = list(self.get_local_config_files())
+            contents = await asyncio.gather(*(get_file_content(it) for it in local_files))
+            conf_files = {it: checksum(content) for it, content in zip(local_files, contents)}
             async with db_conn.pool.acquire() as db, db_logger('server', db):
+                self.last_change = await db.fetchval('SELECT NOW();')
+                if CHANGE_LOG:
+                    self.change_log_id = max(await ChangeLogDB.get_last_id(db) - CHANGE_LOG_LOOKBACK, 0)
                 ifaces = await InterfaceSimpleDB.gets(
-                    db, 'server_name=$1 AND enabled=true', self.server_name, _pydantic_class=InterfaceSimple
+                    db, 'server_name=$1 AND enabled=true', self.server_name,
+                    _pydantic_class=InterfaceSimple, _trusted=True
                 )
-                for iface in ifaces:
-                    # Create / update configuration files
-                    self.interface_ids.add(iface.id)
-                    peers = await PeerDB.gets(
-                        db, 'interface_id=$1 AND enabled=true', iface.id
-                    )
-                    conf_file = self.get_config_from_iface(iface.interface_name)
-                    content = render_template(
-                        'interface_full.conf.j2',
-                        interface=iface,
-                        peers=peers
-                    )
-                    if checksum(content) != conf_files.get(conf_file):
-                        logger.debug('Update config for %s', iface.interface_name)
-                        write_file(conf_file, content, 0o700)
-                        force_update.add(conf_file)
-                    if conf_file in conf_files:
-                        conf_files.pop(conf_file)
-                for conf in conf_files.keys():
-                    # Remove old configuration files
-                    self.__remove_interface(conf)
-
-        for conf in self.get_local_config_files():
+                # All peers of all interfaces by one query
+                states = {it.id: InterfaceState(it) for it in ifaces}
+                for peer in await load_peer_states(db, list(states.keys())):
+                    states[peer.interface_id].add(peer)
+
+            async def update_config(state: InterfaceState):
+                # Create / update configuration files
+                self.interfaces[state.id] = state
+                conf_file = self.get_config_from_iface(state.interface.interface_name)
+                managed[conf_file] = state
+                state.checksum = conf_files.get(conf_file)
+                if await self.__write_config(state):
+                    logger.debug('Update config for %s', state.interface.interface_name)
+                    force_update.add(conf_file)
+                if conf_file in conf_files:
+                    conf_files.pop(conf_file)
+            await gather_limited((update_config(it) for it in states.values()), WIREGUARD_STARTUP_CONCURRENCY)
+            # Remove old configuration files
+            await gather_limited((self.__remove_interface(it) for it in conf_files.keys()),
+                                 WIREGUARD_STARTUP_CONCURRENCY)
+
+        async def load_config(conf: Path):
             # Start available configuration files
+            state = managed.get(conf)
+            if state is not None and conf not in force_update and await self.is_interface_exist(conf):
+                # The interface is running, only differences of peers are applied
+                await self.__sync_interface(state)
+                return
             logger.info('Load %s', conf)
-            self.interface_up(conf, conf in force_update)
+            await self.interface_up(conf, conf in force_update)
+        await gather_limited((load_config(it) for it in self.get_local_config_files()),
+                             WIREGUARD_STARTUP_CONCURRENCY)
+
+        if WIREGUARD_RECONCILE_INTERVAL > 0:
+            self.reconcile_task = asyncio.create_task(self.reconcile_loop(), name='wg-reconcile')
+        if WIREGUARD_DRIFT_INTERVAL > 0:
+            self.drift_task = asyncio.create_task(
+                self.reconcile_loop('drift', WIREGUARD_DRIFT_INTERVAL), name='wg-drift'
+            )
+        if CHANGE_LOG:
+            self.change_log_task = asyncio.create_task(self.change_log_loop(), name='wg-change-log')
+            self.change_log_event.set()
+        if WIREGUARD_WRITE_DELAY > 0:
+            self.write_task = asyncio.create_task(self.write_loop(), name='wg-write')
+        if WIREGUARD_STATS_INTERVAL > 0:
+            self.stats_task = asyncio.create_task(self.stats_loop(), name='wg-stats')
 
     async def stop_server(self, db_conn: DBConnection):
+        if self.reconcile_task:
+            self.reconcile_task.cancel()
+        if self.drift_task:
+            self.drift_task.cancel()
+        if self.change_log_task:
+            self.change_log_task.cancel()
+        if self.stats_task:
+            self.stats_task.cancel()
+            try:
+                await self.flush_stats()
+            except Exception as ex:
+                logger.warning('Stats of peers were not stored: %s', ex)
+        await self.queue.stop()
+        if self.write_task:
+            # Workers of the queue are stopped, so files are written after the last change
+            self.write_task.cancel()
+            try:
+                await self.write_configs()
+            except Exception as ex:
+                logger.warning('Configuration files were not written: %s', ex)
         logger.info('The application is stopped. Wireguard interfaces are still running.')
 
-    def __remove_interface(self, iface: str | Path):
-        self.interface_down(iface)
+    async def reconcile_loop(self, event: str = 'reconcile', interval: float = WIREGUARD_RECONCILE_INTERVAL):
+        """
+        Periodic synchronization of all managed interfaces. The event `reconcile`
+        validates the in-memory state against the database and keeps the configuration
+        files up to date, the event `drift` only repairs the kernel state from memory.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for iface_id in list(self.interfaces.keys()):
+                self.queue.put(iface_id, (event, {}, {}))
+
+    async def write_loop(self):
+        """
+        Write-behind of configuration files, changes of peers are applied by `wg set`
+        immediately and files are written at most once per WIREGUARD_WRITE_DELAY seconds.
+        Files are written by the event queue, so they are serialized with other events of the interface.
+        """
+        while True:
+            await asyncio.sleep(WIREGUARD_WRITE_DELAY)
+            for state in list(self.interfaces.values()):
+                if state.dirty:
+                    self.queue.put(state.id, ('write', {}, {}))
+
+    async def write_configs(self):
+        """
+        Write all not up to date files at once (on stop), WIREGUARD_STARTUP_CONCURRENCY files in parallel.
+        """
+        states = [it for it in self.interfaces.values() if it.dirty]
+        await gather_limited((self.__write_config(it) for it in states), WIREGUARD_STARTUP_CONCURRENCY)
+
+    async def __write_config(self, state: InterfaceState) -> bool:
+        """
+        Write the configuration file of the interface, if its content was changed.
+        Writes of the same file are serialized, so an older rendering never replaces a newer one.
+        """
+        conf_file = self.get_config_from_iface(state.interface.interface_name)
+        async with self.write_locks[conf_file]:
+            # Changes during the rendering set the flag again (peers are taken before the first await)
+            state.dirty = False
+            content = await state.render('interface_full.conf.j2')
+            content_checksum = checksum(content)
+            if state.checksum is None:
+                state.checksum = checksum(await get_file_content(conf_file))
+            if content_checksum == state.checksum:
+                return False
+            await write_file(conf_file, content, 0o700)
+            state.checksum = content_checksum
+            return True
+
+    async def stats_loop(self):
+        """
+        Read runtime state of all peers by one `wg show all dump` every WIREGUARD_STATS_INTERVAL
+        seconds. Only changed peers are stored to the database every WIREGUARD_STATS_FLUSH_INTERVAL.
+        """
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(WIREGUARD_STATS_INTERVAL)
+            try:
+                self.collect_stats(await self.backend.get_dump_all(
+                    state.interface.interface_name for state in self.interfaces.values()
+                ))
+                if self.stats_changed and time.monotonic() - last_flush >= WIREGUARD_STATS_FLUSH_INTERVAL:
+                    await self.flush_stats()
+                    last_flush = time.monotonic()
+            except Exception as ex:
+                logger.error('Collecting of peer stats failed: %s', ex, exc_info=True)
+
+    def collect_stats(self, dumps: Dict[str, WGInterface]):
+        stats = {}
+        for state in self.interfaces.values():
+            if (dump := dumps.get(state.interface.interface_name)) is None:
+                continue
+            for key, peer in dump.peers.items():
+                if (record := state.by_key.get(key)) is None:
+                    continue
+                stats[record.id] = value = (
+                    state.id, peer.endpoint, peer.latest_handshake, peer.transfer_rx, peer.transfer_tx
+                )
+                if self.stats.get(record.id) != value:
+                    self.stats_changed.add(record.id)
+        self.stats = stats
+
+    async def flush_stats(self):
+        if not self.stats_changed or not self.db_conn or not self.db_conn.pool:
+            return
+        ids = [it for it in self.stats_changed if it in self.stats]
+        self.stats_changed = set()
+        try:
+            async with self.__acquire('server.stats') as db:
+                while ids:
+                    batch = ids[:WIREGUARD_STATS_BATCH]
+                    await PeerStatsDB.upsert_many(db, [(it, *self.stats[it]) for it in batch])
+                    # Only not stored peers are left for the retry
+                    del ids[:WIREGUARD_STATS_BATCH]
+        except Exception:
+            # Not stored peers are stored next time
+            self.stats_changed.update(ids)
+            raise
+
+    async def notification_change_log(self, *args):
+        # Records are read in batches by change_log_loop
+        self.change_log_event.set()
+
+    async def change_log_loop(self):
+        """
+        Consume the change log table in batches (CHANGE_LOG=yes). Ids skipped by
+        transactions committed out of order are read again until CHANGE_LOG_GAP_TIMEOUT.
+        """
+        last_prune = 0
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.change_log_event.wait(), CHANGE_LOG_GAP_TIMEOUT if self.change_log_missing else None
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.change_log_event.clear()
+            if not self.db_conn or not self.db_conn.pool:
+                continue
+            try:
+                async with self.db_conn.pool.acquire() as db, db_logger('server.change_log', db):
+                    while ids := await ChangeLogDB.get_ids(
+                        db, self.change_log_id, list(self.change_log_missing), CHANGE_LOG_BATCH
+                    ):
+                        records = await ChangeLogDB.gets(
+                            db, 'id = ANY($1::bigint[]) AND (server_name = $2 OR old_server_name = $2)',
+                            ids, self.server_name, _trusted=True
+                        )
+                        if records:
+                            await self.__process_change_log(db, records)
+                        self.track_change_log(ids)
+                    self.expire_change_log()
+                    if CHANGE_LOG_RETENTION and time.monotonic() - last_prune > 3600:
+                        await ChangeLogDB.prune(db, CHANGE_LOG_RETENTION)
+                        last_prune = time.monotonic()
+            except Exception as ex:
+                logger.error('Processing of change log failed: %s', ex, exc_info=True)
+
+    def track_change_log(self, ids: List[int]):
+        """
+        Move the last read id and remember skipped ids (sorted `ids` were read).
+        """
+        now = time.monotonic()
+        for it in ids:
+            self.change_log_missing.pop(it, None)
+        found = set(ids)
+        for it in range(self.change_log_id + 1, ids[-1]):
+            if it not in found:
+                self.change_log_missing[it] = now
+        self.change_log_id = max(self.change_log_id, ids[-1])
+
+    def expire_change_log(self):
+        # Rolled back transactions never fill their ids
+        limit = time.monotonic() - CHANGE_LOG_GAP_TIMEOUT
+        expired = [it for it, detected in self.change_log_missing.items() if detected <= limit]
+        for it in expired:
+            del self.change_log_missing[it]
+        if expired:
+            logger.debug('Skipped change log records were not committed: %s', expired)
+
+    async def __process_change_log(self, db: Connection, records: List[ChangeLog]):
+        """
+        Convert change log records to events. Current rows are loaded
+        from the database, the old state is taken from the record.
+        """
+        peer_ids = [it.row_id for it in records if it.table_name == 'client_peer']
+        iface_ids = [it.row_id for it in records if it.table_name == 'server_interface']
+        peers = {}
+        if peer_ids:
+            rows = await db.fetch('SELECT * FROM "client_peer" WHERE "id" = ANY($1::int[]);', peer_ids)
+            peers = {row['id']: dict(row.items()) for row in rows}
+        ifaces = {}
+        if iface_ids:
+            rows = await db.fetch('SELECT * FROM "server_interface" WHERE "id" = ANY($1::int[]);', iface_ids)
+            ifaces = {row['id']: dict(row.items()) for row in rows}
+        for record in records:
+            if record.table_name == 'server_interface':
+                old = self.interfaces.get(record.row_id)
+                new_row = ifaces.get(record.row_id) or {}
+                if old is not None or new_row.get('server_name') == self.server_name:
+                    self.queue.put(record.row_id, (
+                        'server_interface', old.interface.model_dump() if old is not None else {}, new_row
+                    ))
+            else:
+                old_row = {}
+                if record.old_interface_id:
+                    old_row = {
+                        'id': record.row_id,
+                        'interface_id': record.old_interface_id,
+                        'public_key': record.old_public_key,
+                        'enabled': record.old_enabled,
+                    }
+                new_row = peers.get(record.row_id) or {}
+                for iface_id in {record.old_interface_id, new_row.get('interface_id')}:
+                    if iface_id in self.interfaces:
+                        self.queue.put(iface_id, ('client_peer', old_row, new_row))
+
+    def __track_change(self, row: dict):
+        if updated_at := row.get('updated_at'):
+            updated_at = datetime.fromisoformat(updated_at)
+            if not self.last_change or updated_at > self.last_change:
+                self.last_change = updated_at
+
+    async def resync(self, db: Connection):
+        """
+        Catch up changes missed while the listener was disconnected. Only
+        interfaces changed since the last seen change are reconciled.
+        Deleted peers are detected by the number of cached peers.
+        """
+        since = self.last_change - RESYNC_MARGIN if self.last_change else None
+        self.last_change = await db.fetchval('SELECT NOW();')
+        logger.info('Resynchronization of changes since %s', since)
+        ifaces = await InterfaceSimpleDB.gets(
+            db, 'server_name=$1 OR id = ANY($2::int[])', self.server_name, list(self.interfaces.keys()),
+            _pydantic_class=InterfaceSimple, _trusted=True
+        )
+        found = set()
+        for iface in ifaces:
+            found.add(iface.id)
+            old = self.interfaces.get(iface.id)
+            if old is not None and old.interface.updated_at == iface.updated_at:
+                continue
+            if old is not None or (iface.server_name == self.server_name and iface.enabled):
+                self.queue.put(iface.id, (
+                    'server_interface',
+                    old.interface.model_dump(mode='json') if old is not None else {},
+                    iface.model_dump(mode='json')
+                ))
+        for iface_id in set(self.interfaces.keys()).difference(found):
+            # Deleted interface
+            self.queue.put(iface_id, (
+                'server_interface', self.interfaces[iface_id].interface.model_dump(mode='json'), {}
+            ))
+
+        rows = await db.fetch(
+            '''
+                SELECT "interface_id",
+                       COUNT(*) FILTER (WHERE "enabled") AS "count",
+                       MAX("updated_at") AS "updated_at"
+                FROM "client_peer"
+                WHERE "interface_id" = ANY($1::int[])
+                GROUP BY "interface_id";
+            ''',
+            list(self.interfaces.keys())
+        )
+        stats = {row['interface_id']: row for row in rows}
+        for iface_id, state in list(self.interfaces.items()):
+            row = stats.get(iface_id)
+            if not since or (row['count'] if row else 0) != len(state) \
+                    or (row and row['updated_at'] > since):
+                self.queue.put(iface_id, ('reconcile', {}, {}))
+
+    async def process_events(self, iface_id: int, events: list):
+        """
+        Process coalesced events of one interface. Events are tuples
+        (channel, old_row, new_row). Peer events are applied from
+        the notification payloads without any SQL query.
+        """
+        if not self.db_conn or not self.db_conn.pool:
+            return
+        peer_events = []
+        full_sync = False
+        repair = False
+        write = False
+        for channel, old_row, new_row in events:
+            events_total.inc(type=channel)
+            if channel == 'server_interface':
+                await self.__update_interface(old_row, new_row)
+            elif channel == 'reconcile':
+                full_sync = True
+            elif channel == 'drift':
+                repair = True
+            elif channel == 'write':
+                write = True
+            else:
+                peer_events.append((old_row, new_row))
+        if full_sync:
+            # Peers are reloaded from the database
+            await self.__reconcile(iface_id)
+        elif peer_events:
+            await self.__update_peer(iface_id, peer_events)
+        elif repair and (state := self.interfaces.get(iface_id)) is not None:
+            await self.__sync_interface(state)
+        if write and (state := self.interfaces.get(iface_id)) is not None and state.dirty:
+            await self.__write_config(state)
+        if not metrics.METRICS:
+            return
+        now = datetime.now(timezone.utc)
+        for channel, _, new_row in events:
+            if updated_at := new_row.get('updated_at'):
+                if isinstance(updated_at, str):
+                    updated_at = datetime.fromisoformat(updated_at)
+                event_lag.observe((now - updated_at).total_seconds(), table=channel)
+
+    async def __remove_interface(self, iface: str | Path):
+        await self.interface_down(iface)
         conf_file = self.get_config_from_iface(iface)
         conf_file.unlink(True)
         logger.info('Interface %s was deleted.', iface)
@@ -115,6 +555,10 @@ class WGServer:
         payload = json.loads(payload)
         new_row = payload.get('new') or {}
         old_row = payload.get('old') or {}
+        self.__track_change(new_row or old_row)
+        self.queue.put(new_row.get('id') or old_row.get('id'), ('server_interface', old_row, new_row))
+
+    async def __update_interface(self, old_row: dict, new_row: dict):
         new_enabled = new_row.get('enabled')
         new_server_name = new_row.get('server_name')
         old_server_name = old_row.get('server_name')
@@ -125,68 +569,189 @@ class WGServer:
             old_interface_name = old_row.get('interface_name')
             if old_interface_name and iface.interface_name != old_interface_name:
                 # Rename interface
-                self.__remove_interface(old_interface_name)
-            peers = await PeerDB.gets(db, 'interface_id=$1 AND enabled=true', iface.id)
-            conf_file = self.get_config_from_iface(iface.interface_name)
-            content = render_template(
-                'interface_full.conf.j2',
-                interface=iface,
-                peers=peers
-            )
-            if checksum(content) != checksum(get_file_content(conf_file)):
+                await self.__remove_interface(old_interface_name)
+            state = self.interfaces.get(iface.id)
+            old_iface = None
+            if state is not None:
+                old_iface = state.interface
+                state.interface = iface
+                if old_iface.interface_name != iface.interface_name:
+                    state.checksum = None
+            else:
+                async with self.__acquire() as db:
+                    state = InterfaceState(iface, await load_peer_states(db, [iface.id]))
+            if await self.__write_config(state):
                 logger.debug('Update config for %s', iface.interface_name)
-                write_file(conf_file, content, 0o700)
-                self.interface_up(iface.interface_name, True)
-            self.interface_ids.add(iface.id)
+                if old_iface and old_iface.interface_name == iface.interface_name \
+                        and await self.is_interface_exist(iface.interface_name) \
+                        and await self.__apply_interface(old_iface, iface):
+                    logger.info('Interface %s was updated without restart.', iface.interface_name)
+                else:
+                    await self.interface_up(iface.interface_name, True)
+            self.interfaces[iface.id] = state
 
         if (new_server_name != old_server_name or not new_enabled) \
                 and old_server_name == self.server_name:
             # Delete, Move or Disabled
-            if old_row['id'] in self.interface_ids:
-                self.interface_ids.remove(old_row['id'])
-            self.__remove_interface(old_row.get('interface_name'))
-
-    async def __update_peer(self, db: Connection, iface_id: int):
-        iface = await InterfaceSimpleDB.get(
-            db,
-            'id = $1 AND server_name = $2 AND enabled=true ',
-            iface_id, self.server_name
-        )
+            self.interfaces.pop(old_row['id'], None)
+            await self.__remove_interface(old_row.get('interface_name'))
+
+    async def __apply_interface(self, old: InterfaceSimple, new: InterfaceSimple) -> bool:
+        """
+        Apply changed attributes to the running interface (`wg set`, `ip link`, `ip address`),
+        so tunnels are not dropped. It returns False, if the interface has to be restarted.
+        """
+        if any(getattr(old, it) != getattr(new, it) for it in RESTART_ATTRIBUTES):
+            return False
+        name = new.interface_name
+        private_key = await asyncio.to_thread(new.get_private_key)
+        if not await self.backend.set_device(
+            name,
+            listen_port=new.listen_port if old.listen_port != new.listen_port else None,
+            fwmark=(new.fw_mark or 0) if old.fw_mark != new.fw_mark else None,
+            private_key=private_key if private_key != await asyncio.to_thread(old.get_private_key) else None
+        ):
+            return False
+        if old.mtu != new.mtu:
+            # Without the default, wg-quick computes MTU of the removed value on restart
+            mtu = new.mtu or WIREGUARD_DEFAULT_MTU
+            if not mtu or not await self.backend.set_mtu(name, mtu):
+                return False
+        old_addresses = self.get_addresses(old.address)
+        new_addresses = self.get_addresses(new.address)
+        for address in old_addresses:
+            if address not in new_addresses and not await self.backend.del_address(name, address):
+                return False
+        for address in new_addresses:
+            if address not in old_addresses and not await self.backend.add_address(name, address):
+                return False
+        return True
+
+    async def __apply_diff(self, state: InterfaceState, dump: WGInterface) -> bool:
+        """
+        Compare peers of the kernel (`wg show dump`) with the in-memory state
+        and apply only differences. The comparison of large interfaces runs in a thread.
+        """
+        peers = list(state.peers.values())
+        remove, update = await asyncio.to_thread(diff_peers, (it.to_wg() for it in peers), dump.peers)
+        if not remove and not update:
+            reconcile_total.inc(result='in_sync')
+            return True
+        logger.info('Repair peers of %s (removed: %s, set: %s)',
+                    state.interface.interface_name, len(remove), len(update))
+        if not await self.backend.set_peers(state.interface.interface_name, remove, update):
+            return False
+        reconcile_total.inc(result='repaired')
+        return True
+
+    async def __syncconf(self, state: InterfaceState):
+        iface = state.interface
+        reconcile_total.inc(result='syncconf')
+        content = await state.render('interface_update.conf.j2')
+        if not await self.backend.syncconf(iface.interface_name, content):
+            logger.warning(
+                'Problem updating interface %s.', iface.interface_name
+            )
+
+    async def __sync_interface(self, state: InterfaceState):
+        """
+        Apply the in-memory state to the interface. The kernel state is read once
+        by `wg show dump` and only differences are applied (`wg syncconf` is
+        the fallback). The configuration file is rendered only if it is not up to date.
+        """
+        iface = state.interface
+        conf_file = self.get_config_from_iface(iface.interface_name)
+        dump = await self.backend.get_dump(iface.interface_name)
+        if (dump is None or state.dirty) and await self.__write_config(state):
+            logger.info('Update config for %s', iface.interface_name)
+        if dump is None:
+            if not await self.is_interface_exist(iface.interface_name):
+                reconcile_total.inc(result='started')
+                await self.interface_up(conf_file)
+                return
+            await self.__syncconf(state)
+        elif not await self.__apply_diff(state, dump):
+            await self.__syncconf(state)
+
+    async def __reconcile(self, iface_id: int):
+        """
+        Validate the in-memory state of the interface against the database
+        and synchronize the interface.
+        """
+        state = self.interfaces.get(iface_id)
+        if state is None:
+            return
+        async with self.__acquire('server.reconcile') as db:
+            iface = await InterfaceSimpleDB.get(
+                db, 'id = $1 AND server_name = $2 AND enabled=true', iface_id, self.server_name,
+                _pydantic_class=InterfaceSimple, _trusted=True
+            )
+            peers = await load_peer_states(db, [iface_id]) if iface else []
         if not iface:
+            # Missed delete, move or disable
+            await self.__update_interface(state.interface.model_dump(mode='json'), {})
             return
-        peers = await PeerDB.gets(
-            db, 'interface_id=$1 AND enabled=true', iface.id
-        )
-        logger.info('Update config for %s', iface.interface_name)
-        content = render_template(
-            'interface_update.conf.j2',
-            interface=iface,
-            peers=peers
-        )
-        with NamedTemporaryFile('w') as tmp_fd:
-            tmp_fd.write(content)
-            tmp_fd.flush()
-            res = cmd('wg', 'syncconf', iface.interface_name, tmp_fd.name)
-            if not res or res.returncode != 0:
-                logger.warning(
-                    'Problem updating interface %s.', iface.interface_name
-                )
-        conf_file = self.get_config_from_iface(iface.interface_name)
-        content = render_template(
-            'interface_full.conf.j2',
-            interface=iface,
-            peers=peers
-        )
-        if checksum(content) != checksum(get_file_content(conf_file)):
-            write_file(conf_file, content, 0o700)
-        if not self.is_interface_exist(iface.interface_name):
-            self.interface_up(conf_file)
+        dirty, written = state.dirty, state.checksum
+        if len(peers) != len(state) or any(state.peers.get(it.id) != it for it in peers):
+            logger.warning('In-memory state of %s differs from the database.', iface.interface_name)
+            dirty = True
+        # Unchanged records are kept with their rendered blocks
+        peers = [it if (old := state.peers.get(it.id)) != it else old for it in peers]
+        self.interfaces[iface_id] = state = InterfaceState(state.interface, peers)
+        state.dirty = dirty
+        state.checksum = written
+        if iface.updated_at != state.interface.updated_at:
+            await self.__update_interface(
+                state.interface.model_dump(mode='json'), iface.model_dump(mode='json')
+            )
+        await self.__sync_interface(self.interfaces.get(iface_id, state))
+
+    async def __update_peer(self, iface_id: int, events: list):
+        """
+        Update the in-memory state by peer events and apply them to the interface.
+        """
+        state = self.interfaces.get(iface_id)
+        if state is None:
+            return
+        changes = []
+        for old_row, new_row in events:
+            peer_id = new_row.get('id') or old_row.get('id')
+            new = None
+            if new_row.get('enabled') and new_row.get('interface_id') == iface_id:
+                new = PeerState.from_row(new_row)
+            old = state.add(new) if new else state.remove(peer_id)
+            if old or new:
+                changes.append((old, new))
+        if not changes:
+            return
+        state.dirty = True
+        if len(changes) <= WIREGUARD_INCREMENTAL_LIMIT:
+            # Public keys changed for the wireguard, the final state is applied
+            keys = set()
+            for old, new in changes:
+                if old and new and old.is_wg_equal(new):
+                    continue
+                keys.update(it.public_key for it in (old, new) if it)
+            remove = [it for it in keys if it not in state.by_key]
+            update = [state.by_key[it].to_wg() for it in keys if it in state.by_key]
+            if not remove and not update:
+                return
+            logger.info('Update peers of %s (removed: %s, set: %s)',
+                        state.interface.interface_name, len(remove), len(update))
+            if await self.backend.set_peers(state.interface.interface_name, remove, update):
+                if WIREGUARD_WRITE_DELAY <= 0:
+                    await self.__write_config(state)
+                # Otherwise the configuration file is written by the write-behind loop.
+                return
+        await self.__sync_interface(state)
 
     async def notification_peer(self, db: Connection, channel, payload):
         logger.debug('Peer DB event: %s', payload)
         payload = json.loads(payload)
-        old_iface_id = (payload.get('old') or {}).get('interface_id')
-        iface_id = (payload.get('new') or {}).get('interface_id') or old_iface_id
-        if old_iface_id and iface_id != old_iface_id:
-            await self.__update_peer(db, old_iface_id)
-        await self.__update_peer(db, iface_id)
+        old_row = payload.get('old') or {}
+        new_row = payload.get('new') or {}
+        self.__track_change(new_row or old_row)
+        for iface_id in {old_row.get('interface_id'), new_row.get('interface_id')}:
+            # A new interface loads its peers itself
+            if iface_id in self.interfaces:
+                self.queue.put(iface_id, ('client_peer', old_row, new_row))
@@ -0,0 +1,162 @@
+import asyncio
+from typing import Dict, Iterable, List, Mapping, Optional
+from asyncpg import Connection
+from lib.helper import render_template
+from lib.wg import WGPeer, normalize_allowed_ips
+from model.interface import InterfaceSimple
+
+# Columns of client_peer used for the wireguard configuration
+PEER_STATE_COLUMNS = ('id', 'interface_id', 'name', 'address', 'public_key', 'preshared_key', 'allowed_ips')
+# Template of the interface => template of one [Peer] block
+PEER_TEMPLATES = {
+    'interface_full.conf.j2': 'peer_full.conf.j2',
+    'interface_update.conf.j2': 'peer_update.conf.j2',
+}
+
+
+class PeerState:
+    """
+    Compact in-memory record of one active peer (about 5x smaller than the pydantic model).
+    Every change of the row creates a new record, so rendered blocks and the wireguard peer
+    are cached on the record.
+    """
+    __slots__ = PEER_STATE_COLUMNS + ('blocks', 'wg')
+
+    def __init__(self, id: int, interface_id: int, name: str, address: str, public_key: str,
+                 preshared_key: Optional[str] = None, allowed_ips: Optional[str] = None):
+        self.id = id
+        self.interface_id = interface_id
+        self.name = name
+        self.address = address
+        self.public_key = public_key
+        self.preshared_key = preshared_key
+        self.allowed_ips = allowed_ips
+        self.blocks: Optional[Dict[str, str]] = None
+        self.wg: Optional[WGPeer] = None
+
+    @classmethod
+    def from_row(cls, row: Mapping) -> 'PeerState':
+        """
+        Create the record from a notification payload, dict or asyncpg record.
+        """
+        return cls(**{key: row.get(key) for key in PEER_STATE_COLUMNS})
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PeerState):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in PEER_STATE_COLUMNS)
+
+    def __repr__(self) -> str:
+        return f'PeerState(id={self.id}, interface_id={self.interface_id}, name={self.name!r})'
+
+    def get_allowed_ips(self) -> str:
+        """
+        Allowed IPs in the format of `wg set`.
+        """
+        if not self.allowed_ips:
+            return self.address
+        return ','.join(it.strip() for it in self.allowed_ips.splitlines() if it.strip())
+
+    def is_wg_equal(self, other: 'PeerState') -> bool:
+        """
+        The peer has the same wireguard setting (name or address can differ).
+        """
+        return self.public_key == other.public_key \
+            and self.preshared_key == other.preshared_key \
+            and self.get_allowed_ips() == other.get_allowed_ips()
+
+    def get_block(self, template: str) -> str:
+        """
+        Rendered [Peer] block of the configuration file (cached).
+        """
+        if self.blocks is None:
+            self.blocks = {}
+        if (block := self.blocks.get(template)) is None:
+            block = self.blocks[template] = render_template(template, peer=self)
+        return block
+
+    def to_wg(self) -> WGPeer:
+        """
+        Wireguard peer of the record (cached).
+        """
+        if self.wg is None:
+            # client_peer has no keepalive (only client_persistent_keepalive of the client side)
+            self.wg = WGPeer(
+                public_key=self.public_key,
+                preshared_key=self.preshared_key or None,
+                allowed_ips=normalize_allowed_ips(self.get_allowed_ips())
+            )
+        return self.wg
+
+
+class InterfaceState:
+    """
+    Desired state of one managed interface with its active peers,
+    indexed by peer id and public key. The flag `dirty` means
+    the configuration file is not up to date, `checksum` is of the written file.
+    """
+    __slots__ = ('interface', 'peers', 'by_key', 'dirty', 'checksum')
+
+    def __init__(self, interface: InterfaceSimple, peers: Iterable[PeerState] = ()):
+        self.interface = interface
+        self.peers: Dict[int, PeerState] = {}
+        self.by_key: Dict[str, PeerState] = {}
+        self.dirty = False
+        self.checksum: Optional[str] = None
+        for peer in peers:
+            self.add(peer)
+
+    @property
+    def id(self) -> int:
+        return self.interface.id
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def add(self, peer: PeerState) -> Optional[PeerState]:
+        """
+        Add or replace the peer, it returns the previous record.
+        """
+        old = self.remove(peer.id)
+        self.peers[peer.id] = peer
+        self.by_key[peer.public_key] = peer
+        return old
+
+    def remove(self, peer_id: int) -> Optional[PeerState]:
+        peer = self.peers.pop(peer_id, None)
+        if peer and self.by_key.get(peer.public_key) is peer:
+            self.by_key.pop(peer.public_key)
+        return peer
+
+    def get_peers(self) -> List[PeerState]:
+        """
+        Peers sorted by id (the order of the configuration file).
+        """
+        return sorted(self.peers.values(), key=lambda it: it.id)
+
+    async def render(self, template: str) -> str:
+        """
+        Configuration of the interface, the header is rendered by `template` and
+        [Peer] blocks are assembled from the cache (only new or changed peers are rendered).
+        """
+        interface, peers = self.interface, self.get_peers()
+        peer_template = PEER_TEMPLATES[template]
+
+        def render() -> str:
+            header = render_template(template, interface=interface, peers=())
+            return header + ''.join(peer.get_block(peer_template) for peer in peers)
+        # Templates can read files (e.g. private key), so it runs out of the event loop.
+        return await asyncio.to_thread(render)
+
+
+async def load_peer_states(db: Connection, interface_ids: List[int]) -> List[PeerState]:
+    """
+    Active peers of interfaces, only columns used by the wireguard (without pydantic validation).
+    """
+    columns = ', '.join(f'"{it}"' for it in PEER_STATE_COLUMNS)
+    rows = await db.fetch(
+        f'SELECT {columns} FROM "client_peer" '
+        'WHERE "interface_id" = ANY($1::int[]) AND "enabled" ORDER BY "interface_id", "id";',
+        interface_ids
+    )
+    return [PeerState(*row) for row in rows]
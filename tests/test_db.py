@@ -0,0 +1,41 @@
+import logging
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+from lib import db, metrics
+
+
+class QueryLoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock(spec=['name', 'isEnabledFor', 'error', 'debug'])
+        self.logger.isEnabledFor.return_value = False
+        self.query_logger = db.QueryLogger(self.logger)
+
+    def query(self, exception: Exception = None):
+        return SimpleNamespace(query='SELECT 1;', args=(), elapsed=0.01, exception=exception)
+
+    def test_failed_query_is_logged(self):
+        with mock.patch.object(metrics, 'METRICS', False):
+            self.query_logger.process(self.query(ValueError('error')))
+            self.query_logger.process(self.query())
+        self.logger.error.assert_called_once()
+        self.logger.debug.assert_not_called()
+
+    def test_debug(self):
+        self.logger.isEnabledFor.side_effect = lambda level: level == logging.DEBUG
+        query_logger = db.QueryLogger(self.logger)
+        with mock.patch.object(metrics, 'METRICS', False):
+            query_logger.process(self.query())
+        self.logger.debug.assert_called_once()
+
+
+class DBLoggerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_attached_without_debug_and_metrics(self):
+        conn = mock.Mock(spec=['add_query_logger', 'remove_query_logger'])
+        with mock.patch.object(metrics, 'METRICS', False):
+            async with db.DBConnection.db_logger('test.db', conn):
+                conn.add_query_logger.assert_called_once()
+        conn.remove_query_logger.assert_called_once()
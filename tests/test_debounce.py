@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+
+from lib.debounce import DebounceQueue
+
+
+class DebounceQueueTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.calls = []
+        self.queue = DebounceQueue(self.handler, delay=0.05, max_delay=0.2, name='test')
+
+    async def asyncTearDown(self):
+        await self.queue.stop()
+
+    async def handler(self, key, events):
+        self.calls.append((key, events))
+        if 'fail' in events:
+            raise RuntimeError('handler failed')
+
+    async def wait_idle(self, timeout: float = 2):
+        async with asyncio.timeout(timeout):
+            while self.queue.workers:
+                await asyncio.sleep(0.01)
+
+    async def test_burst_is_coalesced(self):
+        for ix in range(5):
+            self.queue.put('wg0', ix)
+        self.queue.put('wg1', 'a')
+        self.assertEqual(self.queue.size(), 6)
+        self.assertEqual(self.queue.size('wg0'), 5)
+        await self.wait_idle()
+        self.assertCountEqual(self.calls, [('wg0', [0, 1, 2, 3, 4]), ('wg1', ['a'])])
+        self.assertEqual(self.queue.size(), 0)
+
+    async def test_max_delay(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        # A new event comes before the delay expires, only max_delay flushes the events
+        while not self.calls and loop.time() - start < 1:
+            self.queue.put('wg0', loop.time())
+            await asyncio.sleep(0.02)
+        self.assertTrue(self.calls)
+        self.assertLess(loop.time() - start, 0.2 + 0.1)
+        self.assertGreater(len(self.calls[0][1]), 1)
+        await self.wait_idle()
+
+    async def test_handler_error_keeps_worker(self):
+        workers = []
+
+        async def handler(key, events):
+            self.calls.append((key, events))
+            workers.append(asyncio.current_task())
+            if events == ['fail']:
+                # The next event comes while the handler is running
+                self.queue.put(key, 'next')
+                raise RuntimeError('handler failed')
+
+        self.queue.handler = handler
+        self.queue.put('wg0', 'fail')
+        await self.wait_idle()
+        self.assertEqual(self.calls, [('wg0', ['fail']), ('wg0', ['next'])])
+        self.assertIs(workers[0], workers[1])
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from lib import helper
+from lib.helper import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # The read value is the most recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        cache.put('a', 4)
+        cache.put('d', 5)
+        self.assertEqual(list(cache.data.items()), [('a', 4), ('d', 5)])
+        self.assertEqual(len(cache), 2)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class QRCodeTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(helper, 'QRCODE_WORKERS', 1),
+            mock.patch.object(helper, 'process_executor', None),
+            mock.patch.object(helper, 'qrcode_cache', LRUCache(2)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        if helper.process_executor:
+            helper.process_executor.shutdown()
+
+    def test_process_pool(self):
+        executor = helper.get_process_executor()
+        self.assertIs(helper.get_process_executor(), executor)
+        self.assertIn(executor._mp_context.get_start_method(), ('forkserver', 'spawn'))
+        image = asyncio.run(helper.get_qrcode_async('[Interface]\n'))
+        self.assertTrue(image.startswith(b'\x89PNG'))
+        self.assertEqual(image, helper.get_qrcode('[Interface]\n'))
+        svg = asyncio.run(helper.get_qrcode_async('[Interface]\n', 'svg'))
+        self.assertIn(b'<svg', svg)
+
+    def test_cache(self):
+        with mock.patch.object(helper, 'get_process_executor', wraps=helper.get_process_executor) as executor:
+            first = asyncio.run(helper.get_qrcode_async('peer'))
+            self.assertEqual(asyncio.run(helper.get_qrcode_async('peer')), first)
+            self.assertEqual(executor.call_count, 1)
+            asyncio.run(helper.get_qrcode_async('other'))
+            asyncio.run(helper.get_qrcode_async('third'))
+            # The first image was evicted (cache of 2 images)
+            asyncio.run(helper.get_qrcode_async('peer'))
+            self.assertEqual(executor.call_count, 4)
+        self.assertEqual(len(helper.qrcode_cache), 2)
+
+    def test_thread(self):
+        with mock.patch.object(helper, 'QRCODE_WORKERS', 0):
+            self.assertIsNone(helper.get_process_executor())
+            self.assertTrue(asyncio.run(helper.get_qrcode_async('peer')).startswith(b'\x89PNG'))
@@ -0,0 +1,161 @@
+from ipaddress import AddressValueError, IPv4Address, collapse_addresses, summarize_address_range
+import re
+from types import SimpleNamespace
+import unittest
+
+from lib.helper import optimalize_ip_range
+from lib.ippool import IPPool
+from model.interface import InterfaceDB
+
+
+def ip(value: str) -> int:
+    return int(IPv4Address(value))
+
+
+def baseline_ip_range_to_ips(ip_range):
+    # Original implementation (every address is materialized)
+    if not ip_range:
+        return []
+    try:
+        nets = []
+        for block in re.split(',|\n', ip_range):
+            ips = [IPv4Address(it.strip()) for it in block.split('-')]
+            if len(ips) == 1:
+                nets.append(ips[0])
+            elif len(ips) == 2:
+                nets.extend(summarize_address_range(*ips))
+            else:
+                raise ValueError(f'Unknown format of range: {block}')
+        res = set()
+        for net in collapse_addresses(nets):
+            res.add(net.network_address)
+            res.update(net.hosts())
+            res.add(net.broadcast_address)
+        return sorted(res)
+    except AddressValueError as e:
+        raise ValueError(str(e))
+
+
+def baseline_optimalize_ip_range(ip_range):
+    if not ip_range:
+        return
+    ips = baseline_ip_range_to_ips(ip_range)
+    res = []
+    last = None
+    start = None
+    while ips and (it := ips.pop(0)):
+        if not it.is_private:
+            raise ValueError(f'IP {it} is not private')
+        if last != it - 1:
+            if start:
+                res.append(f'{start} - {last}')
+            start = it
+        last = it
+    if start:
+        if start != last:
+            res.append(f'{start} - {last}')
+        else:
+            res.append(f'{start}')
+    new_range = '\n'.join(res)
+    if len(ip_range) < len(new_range):
+        return new_range
+
+
+class IPPoolTest(unittest.TestCase):
+
+    def assertIntervals(self, pool: IPPool, intervals):
+        self.assertEqual([(str(start), str(end)) for start, end in pool.intervals()], intervals)
+
+    def test_merge(self):
+        pool = IPPool([(ip('10.0.0.20'), ip('10.0.0.30')), (ip('10.0.0.1'), ip('10.0.0.5')),
+                       (ip('10.0.0.6'), ip('10.0.0.8')), (ip('10.0.0.25'), ip('10.0.0.40')),
+                       (ip('10.0.0.22'), ip('10.0.0.23'))])
+        self.assertIntervals(pool, [('10.0.0.1', '10.0.0.8'), ('10.0.0.20', '10.0.0.40')])
+        self.assertEqual(len(pool), 8 + 21)
+
+    def test_from_range(self):
+        pool = IPPool.from_range('10.0.1.1, 10.0.0.10 - 10.0.0.20\n10.0.0.21-10.0.0.30,10.0.0.5')
+        self.assertIntervals(pool, [('10.0.0.5', '10.0.0.5'), ('10.0.0.10', '10.0.0.30'), ('10.0.1.1', '10.0.1.1')])
+        self.assertFalse(IPPool.from_range(None))
+        self.assertFalse(IPPool.from_range(''))
+        for ip_range in ('10.0.0.5 - 10.0.0.1', '10.0.0.1 - 10.0.0.2 - 10.0.0.3', '10.0.0.256', 'abc'):
+            with self.assertRaises(ValueError):
+                IPPool.from_range(ip_range)
+
+    def test_contains(self):
+        pool = IPPool.from_range('10.0.0.10 - 10.0.0.20, 10.0.0.30')
+        for it in ('10.0.0.10', '10.0.0.15', '10.0.0.20', '10.0.0.30'):
+            self.assertIn(IPv4Address(it), pool)
+        for it in ('10.0.0.9', '10.0.0.21', '10.0.0.29', '10.0.0.31'):
+            self.assertNotIn(IPv4Address(it), pool)
+
+    def test_difference(self):
+        pool = IPPool.from_range('10.0.0.10 - 10.0.0.20, 10.0.0.30 - 10.0.0.31')
+        cases = [
+            ([], [('10.0.0.10', '10.0.0.20'), ('10.0.0.30', '10.0.0.31')]),
+            (['10.0.0.1', '10.0.0.25', '10.0.0.40'], [('10.0.0.10', '10.0.0.20'), ('10.0.0.30', '10.0.0.31')]),
+            (['10.0.0.10', '10.0.0.20'], [('10.0.0.11', '10.0.0.19'), ('10.0.0.30', '10.0.0.31')]),
+            (['10.0.0.15', '10.0.0.16', '10.0.0.15'],
+             [('10.0.0.10', '10.0.0.14'), ('10.0.0.17', '10.0.0.20'), ('10.0.0.30', '10.0.0.31')]),
+            (['10.0.0.30', '10.0.0.31'], [('10.0.0.10', '10.0.0.20')]),
+            ([f'10.0.0.{it}' for it in range(0, 40)], []),
+        ]
+        for used, intervals in cases:
+            res = pool.difference(IPv4Address(it) for it in used)
+            self.assertIntervals(res, intervals)
+            self.assertEqual(list(res), [it for it in pool if str(it) not in used])
+        # The original pool is not changed
+        self.assertEqual(len(pool), 13)
+
+    def test_take(self):
+        pool = IPPool.from_range('10.0.0.10 - 10.0.0.11, 10.0.0.20 - 10.0.0.22')
+        self.assertEqual([str(it) for it in pool.take(1)], ['10.0.0.10'])
+        self.assertEqual([str(it) for it in pool.take(3)], ['10.0.0.10', '10.0.0.11', '10.0.0.20'])
+        self.assertEqual(len(pool.take(10)), 5)
+        self.assertEqual(IPPool().take(1), [])
+
+    def test_networks(self):
+        pool = IPPool.from_range('10.0.0.0 - 10.0.0.255, 10.0.1.0 - 10.0.1.2')
+        self.assertEqual([str(it) for it in pool.networks()], ['10.0.0.0/24', '10.0.1.0/31', '10.0.1.2/32'])
+
+
+class OptimalizeIPRangeTest(unittest.TestCase):
+
+    def test_baseline_parity(self):
+        ranges = [
+            None,
+            '',
+            '10.0.0.1',
+            '10.0.0.1 - 10.0.0.10',
+            '10.0.0.1-10.0.0.10',
+            '10.0.0.5, 10.0.0.1 - 10.0.0.4',
+            '10.0.0.1,10.0.0.2,10.0.0.3,10.0.0.4',
+            '10.0.0.1 - 10.0.0.5\n10.0.0.3 - 10.0.0.9\n10.0.0.20',
+            '10.0.0.20, 10.0.0.1-10.0.0.2',
+            '192.168.0.10 - 192.168.1.20,172.16.0.1',
+            '10.0.0.1 - 10.0.0.2, 10.0.0.4, 10.0.0.6 - 10.0.0.7',
+        ]
+        for ip_range in ranges:
+            self.assertEqual(optimalize_ip_range(ip_range), baseline_optimalize_ip_range(ip_range), ip_range)
+
+    def test_errors(self):
+        for ip_range in ('8.8.8.8', '10.0.0.1, 8.8.8.0 - 8.8.8.10', '10.0.0.5 - 10.0.0.1', 'abc'):
+            with self.assertRaises(ValueError) as error:
+                optimalize_ip_range(ip_range)
+            with self.assertRaises(ValueError) as baseline_error:
+                baseline_optimalize_ip_range(ip_range)
+            if 'private' in str(baseline_error.exception):
+                self.assertEqual(str(error.exception), str(baseline_error.exception))
+
+
+class FreeIPPoolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_blank_address_lines(self):
+        class DB:
+            async def fetch(self, query: str, *args):
+                return [{'address': '10.0.0.2/32\n\n  \n'}, {'address': ' \n10.0.0.4/32\nfd00::4/128'}, {'address': ''}]
+
+        interface = SimpleNamespace(id=1, ip_range='10.0.0.1 - 10.0.0.6', address='10.0.0.1/24\n ')
+        self.assertEqual([str(it) for it in await InterfaceDB.get_used_ips(DB(), 1)], ['10.0.0.2', '10.0.0.4'])
+        self.assertEqual([str(it) for it in await InterfaceDB.get_free_ips(DB(), interface, 5)],
+                         ['10.0.0.3', '10.0.0.5', '10.0.0.6'])
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from lib import helper, keys
+from lib.helper import get_wg_private_key, get_wg_public_key, get_wg_secret_pairs
+
+# Implementation of the wg binary in tests (native functions are replaced by failing mocks)
+generate_private_key, get_public_key = keys.generate_private_key, keys.get_public_key
+
+
+class X25519Test(unittest.TestCase):
+
+    def test_rfc7748_vectors(self):
+        # RFC 7748 section 5.2
+        vectors = [
+            ('a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4',
+             'e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c',
+             'c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552'),
+            ('4b66e9d4d1b4673c5ad22691957d6af5c11b6421e0ea01d42ca4169e7918ba0d',
+             'e5210f12786811d3f4b7959d0538ae2c31dbe7106fc03c3efc4cd549c715a493',
+             '95cbde9476e8907d7aade45cb4b873f88b595a68799fa152e6f8f7647aac7957'),
+        ]
+        for scalar, u, result in vectors:
+            self.assertEqual(keys.scalar_mult(bytes.fromhex(scalar), bytes.fromhex(u)).hex(), result)
+
+    def test_rfc7748_iteration(self):
+        # RFC 7748 section 5.2, one iteration
+        base = (9).to_bytes(32, 'little')
+        self.assertEqual(keys.scalar_mult(base, base).hex(),
+                         '422c8e7a6227d7bca1350b3e2bb7279f7897b87bb6854b783c60e80311ae3079')
+
+    def test_rfc7748_diffie_hellman(self):
+        # RFC 7748 section 6.1
+        alice = bytes.fromhex('77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a')
+        bob = bytes.fromhex('5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb')
+        alice_public = keys.get_public_key(keys.encode_key(alice))
+        bob_public = keys.get_public_key(keys.encode_key(bob))
+        self.assertEqual(keys.decode_key(alice_public).hex(),
+                         '8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a')
+        self.assertEqual(keys.decode_key(bob_public).hex(),
+                         'de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f')
+        shared = '4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742'
+        self.assertEqual(keys.scalar_mult(alice, keys.decode_key(bob_public)).hex(), shared)
+        self.assertEqual(keys.scalar_mult(bob, keys.decode_key(alice_public)).hex(), shared)
+
+    def test_cswap(self):
+        self.assertEqual(keys.cswap(0, 3, 5), (3, 5))
+        self.assertEqual(keys.cswap(1, 3, 5), (5, 3))
+
+    def test_generate_private_key(self):
+        raw = keys.decode_key(keys.generate_private_key())
+        # Clamped as `wg genkey`
+        self.assertEqual(raw[0] & 7, 0)
+        self.assertEqual(raw[31] & 0xc0, 0x40)
+        self.assertEqual(len(keys.decode_key(keys.generate_preshared_key())), 32)
+
+    def test_decode_key(self):
+        for key in ('', 'abc', keys.encode_key(b'x' * 31)):
+            with self.assertRaises(ValueError):
+                keys.decode_key(key)
+
+
+class NativeKeygenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+        patches = [
+            mock.patch.object(helper, 'QRCODE_WORKERS', 1),
+            mock.patch.object(helper, 'process_executor', None),
+            mock.patch.object(helper, 'wg_cmd', self.wg_cmd),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        if helper.process_executor:
+            helper.process_executor.shutdown()
+
+    async def wg_cmd(self, *args, input: str = None) -> str:
+        self.commands.append(args[0])
+        if args[0] == 'pubkey':
+            return get_public_key(input)
+        return generate_private_key()
+
+    def test_secret_pairs(self):
+        # Generated by the process pool
+        pairs = asyncio.run(get_wg_secret_pairs(3))
+        self.assertIsNotNone(helper.process_executor)
+        self.assertEqual(len({it for it, _ in pairs}), 3)
+        for private_key, public_key in pairs:
+            self.assertEqual(keys.get_public_key(private_key), public_key)
+            self.assertEqual(asyncio.run(get_wg_public_key(private_key)), public_key)
+        self.assertEqual(self.commands, [])
+
+    def test_fallback(self):
+        with mock.patch.object(helper.keys, 'get_public_key', side_effect=ValueError('failed')), \
+                mock.patch.object(helper, 'get_process_executor', return_value=None), \
+                mock.patch.object(helper.keys, 'generate_private_key', side_effect=OSError('no entropy')):
+            private_key = asyncio.run(get_wg_private_key())
+            public_key = asyncio.run(get_wg_public_key(private_key))
+            self.assertEqual(len(asyncio.run(get_wg_secret_pairs(2))), 2)
+        self.assertEqual(public_key, keys.get_public_key(private_key))
+        self.assertEqual(self.commands, ['genkey', 'pubkey', 'genkey', 'pubkey', 'genkey', 'pubkey'])
+
+    def test_wg_binary(self):
+        with mock.patch.object(helper, 'WG_KEYGEN', 'wg'):
+            private_key = asyncio.run(get_wg_private_key())
+            asyncio.run(get_wg_public_key(private_key))
+        self.assertEqual(self.commands, ['genkey', 'pubkey'])
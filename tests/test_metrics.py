@@ -0,0 +1,29 @@
+import unittest
+from unittest import mock
+
+from lib import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_escape(self):
+        counter = metrics.Counter('test_total', 'Value "a"\\b\nc', ('name',))
+        counter.inc(name='x"y\\z\n')
+        self.assertEqual(counter.render(), [
+            '# HELP wireguard_pg_test_total Value "a"\\\\b\\nc',
+            '# TYPE wireguard_pg_test_total counter',
+            'wireguard_pg_test_total{name="x\\"y\\\\z\\n"} 1',
+        ])
+
+    def test_histogram_disabled(self):
+        histogram = metrics.Histogram('test_seconds', 'Duration.', buckets=(1,))
+        with mock.patch.object(metrics, 'METRICS', False):
+            histogram.observe(0.5)
+            with histogram.time():
+                pass
+        self.assertEqual(histogram.values, {})
+        with mock.patch.object(metrics, 'METRICS', True):
+            histogram.observe(0.5)
+            with histogram.time():
+                pass
+        self.assertEqual(histogram.values[()][0], 2)
@@ -0,0 +1,192 @@
+import socket
+import struct
+import unittest
+from unittest import mock
+
+from lib import netlink
+from lib.keys import decode_key
+from lib.netlink import attr, nested, parse_attrs, parse_device, parse_peer, remove_peer_attrs, set_peer_attrs
+from lib.wg import WGPeer
+from lib.wg_backend import NetlinkBackend, SubprocessBackend
+
+PRIVATE_KEY = 'yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk='
+PUBLIC_KEY = 'HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw='
+PEER1 = 'xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg='
+PEER2 = 'TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0='
+PSK = 'FpCyhws9cxwWoV4xELtfJvjJN+zQVRPISllRWgeopVE='
+
+
+def allowed_ip_attrs(network: str) -> bytes:
+    address, cidr = network.split('/')
+    packed = socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+    return nested(0, [
+        attr(netlink.WGALLOWEDIP_A_FAMILY, struct.pack('=H', socket.AF_INET6 if ':' in address else socket.AF_INET)),
+        attr(netlink.WGALLOWEDIP_A_IPADDR, packed),
+        attr(netlink.WGALLOWEDIP_A_CIDR_MASK, struct.pack('=B', int(cidr))),
+    ])
+
+
+def kernel_peer(public_key: str, allowed_ips: list, full: bool = True) -> bytes:
+    """
+    Peer of WG_CMD_GET_DEVICE, a continuation of the peer has only the public key and allowed IPs.
+    """
+    attrs = [attr(netlink.WGPEER_A_PUBLIC_KEY, decode_key(public_key))]
+    if full:
+        endpoint = struct.pack('=H', socket.AF_INET) + struct.pack('!H', 51820) + socket.inet_aton('192.0.2.1')
+        attrs += [
+            attr(netlink.WGPEER_A_PRESHARED_KEY, decode_key(PSK)),
+            attr(netlink.WGPEER_A_ENDPOINT, endpoint + bytes(8)),
+            attr(netlink.WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, struct.pack('=H', 25)),
+            attr(netlink.WGPEER_A_LAST_HANDSHAKE_TIME, struct.pack('=qq', 1700000000, 5)),
+            attr(netlink.WGPEER_A_RX_BYTES, struct.pack('=Q', 1024)),
+            attr(netlink.WGPEER_A_TX_BYTES, struct.pack('=Q', 2048)),
+        ]
+    attrs.append(nested(netlink.WGPEER_A_ALLOWEDIPS, [allowed_ip_attrs(it) for it in allowed_ips]))
+    return nested(0, attrs)
+
+
+class AttributesTest(unittest.TestCase):
+
+    def test_attr_padding(self):
+        data = attr(1, b'abcde') + attr(2, b'') + nested(3, [attr(4, struct.pack('=H', 7))])
+        self.assertEqual(len(data) % 4, 0)
+        values = list(parse_attrs(data))
+        self.assertEqual(values[:2], [(1, b'abcde'), (2, b'')])
+        # The nested flag is not a part of the type
+        self.assertEqual(values[2][0], 3)
+        self.assertEqual(list(parse_attrs(values[2][1])), [(4, struct.pack('=H', 7))])
+
+    def test_parse_attrs_truncated(self):
+        self.assertEqual(list(parse_attrs(b'\0\0\0\0' + attr(1, b'a'))), [])
+        self.assertEqual(list(parse_attrs(attr(1, b'a')[:3])), [])
+
+    def test_peer_round_trip(self):
+        peers = [
+            WGPeer(PEER1, PSK, frozenset({'10.0.0.2/32', '192.168.0.0/24', 'fd00::/64'}), 25),
+            WGPeer(PEER2),
+        ]
+        for peer in peers:
+            (_, data), = parse_attrs(set_peer_attrs(peer))
+            self.assertEqual(parse_peer(data), peer)
+
+    def test_remove_peer(self):
+        (_, data), = parse_attrs(remove_peer_attrs(PEER1))
+        values = dict(parse_attrs(data))
+        self.assertEqual(values[netlink.WGPEER_A_PUBLIC_KEY], decode_key(PEER1))
+        self.assertEqual(values[netlink.WGPEER_A_FLAGS], struct.pack('=I', netlink.WGPEER_F_REMOVE_ME))
+
+    def test_parse_endpoint(self):
+        ipv4 = struct.pack('=H', socket.AF_INET) + struct.pack('!H', 51820) + socket.inet_aton('192.0.2.1') + bytes(8)
+        ipv6 = struct.pack('=H', socket.AF_INET6) + struct.pack('!H', 443) + bytes(4) \
+            + socket.inet_pton(socket.AF_INET6, '2001:db8::1') + bytes(4)
+        self.assertEqual(netlink.parse_endpoint(ipv4), '192.0.2.1:51820')
+        self.assertEqual(netlink.parse_endpoint(ipv6), '[2001:db8::1]:443')
+        self.assertIsNone(netlink.parse_endpoint(bytes(16)))
+
+
+class ParseDeviceTest(unittest.TestCase):
+
+    def test_split_dump(self):
+        device = [
+            attr(netlink.WGDEVICE_A_IFNAME, b'wg0\0'),
+            attr(netlink.WGDEVICE_A_PRIVATE_KEY, decode_key(PRIVATE_KEY)),
+            attr(netlink.WGDEVICE_A_PUBLIC_KEY, decode_key(PUBLIC_KEY)),
+            attr(netlink.WGDEVICE_A_LISTEN_PORT, struct.pack('=H', 51820)),
+            attr(netlink.WGDEVICE_A_FWMARK, struct.pack('=I', 16)),
+        ]
+        messages = [
+            b''.join(device) + nested(netlink.WGDEVICE_A_PEERS, [
+                kernel_peer(PEER1, ['10.0.0.2/32', '10.0.1.0/24']),
+            ]),
+            # Allowed IPs of the first peer continue in the next message
+            attr(netlink.WGDEVICE_A_IFNAME, b'wg0\0') + nested(netlink.WGDEVICE_A_PEERS, [
+                kernel_peer(PEER1, ['10.0.2.0/24', 'fd00::/64'], full=False),
+                kernel_peer(PEER2, ['10.0.0.3/32']),
+            ]),
+            attr(netlink.WGDEVICE_A_IFNAME, b'wg0\0') + nested(netlink.WGDEVICE_A_PEERS, [
+                kernel_peer(PEER2, ['10.0.0.4/32'], full=False),
+            ]),
+        ]
+        iface = parse_device(messages)
+        self.assertEqual((iface.private_key, iface.public_key, iface.listen_port, iface.fwmark),
+                         (PRIVATE_KEY, PUBLIC_KEY, 51820, 16))
+        self.assertEqual(list(iface.peers), [PEER1, PEER2])
+        self.assertEqual(iface.peers[PEER1], WGPeer(
+            public_key=PEER1,
+            preshared_key=PSK,
+            allowed_ips=frozenset({'10.0.0.2/32', '10.0.1.0/24', '10.0.2.0/24', 'fd00::/64'}),
+            persistent_keepalive=25,
+            endpoint='192.0.2.1:51820',
+            latest_handshake=1700000000,
+            transfer_rx=1024,
+            transfer_tx=2048,
+        ))
+        self.assertEqual(iface.peers[PEER2].allowed_ips, frozenset({'10.0.0.3/32', '10.0.0.4/32'}))
+        self.assertEqual(iface.peers[PEER2].transfer_tx, 2048)
+
+    def test_empty_device(self):
+        iface = parse_device([attr(netlink.WGDEVICE_A_PRIVATE_KEY, bytes(32))])
+        self.assertEqual((iface.private_key, iface.public_key, iface.listen_port, iface.peers), (None, None, 0, {}))
+
+
+class FakeSocket:
+
+    def __init__(self, error: int = 0):
+        self.error = error
+        self.sent = []
+
+    def send(self, data: bytes):
+        self.sent.append(data)
+
+    def recv(self, size: int) -> bytes:
+        _, _, _, seq, _ = struct.unpack_from('=IHHII', self.sent[-1])
+        return struct.pack('=IHHII', 20 + 16, netlink.NLMSG_ERROR, 0, seq, 0) \
+            + struct.pack('=i', -self.error) + self.sent[-1][:16]
+
+
+class NetlinkSocketTest(unittest.TestCase):
+
+    def get_socket(self, error: int = 0) -> netlink.NetlinkSocket:
+        nl = netlink.NetlinkSocket.__new__(netlink.NetlinkSocket)
+        nl.sock, nl.seq = FakeSocket(error), 0
+        return nl
+
+    def test_request_flags(self):
+        nl = self.get_socket()
+        self.assertEqual(nl.request(netlink.RTM_NEWADDR, b'', netlink.NLM_F_CREATE | netlink.NLM_F_EXCL), [])
+        _, _, flags, _, _ = struct.unpack_from('=IHHII', nl.sock.sent[-1])
+        # The acknowledgement is requested also with flags sharing bits with NLM_F_DUMP
+        self.assertEqual(flags, netlink.NLM_F_REQUEST | netlink.NLM_F_ACK | netlink.NLM_F_CREATE | netlink.NLM_F_EXCL)
+
+    def test_request_error(self):
+        nl = self.get_socket(error=17)
+        with self.assertRaises(FileExistsError):
+            nl.request(netlink.RTM_NEWADDR, b'')
+
+    def test_set_device_chunks(self):
+        nl = netlink.WireGuardNetlink.__new__(netlink.WireGuardNetlink)
+        messages = []
+        nl.genl_request = lambda cmd, attrs, dump=False: messages.append(list(parse_attrs(b''.join(attrs))))
+        update = [WGPeer(PEER1, allowed_ips=frozenset({'10.0.0.2/32'})), WGPeer(PEER2)]
+        nl.set_device('wg0', listen_port=51820, remove=[PUBLIC_KEY], update=update, chunk=2)
+        self.assertEqual(len(messages), 2)
+        # Device attributes are only in the first message
+        self.assertEqual([it for it, _ in messages[0]], [
+            netlink.WGDEVICE_A_IFNAME, netlink.WGDEVICE_A_LISTEN_PORT, netlink.WGDEVICE_A_PEERS
+        ])
+        self.assertEqual([it for it, _ in messages[1]], [netlink.WGDEVICE_A_IFNAME, netlink.WGDEVICE_A_PEERS])
+        self.assertEqual(len(list(parse_attrs(messages[0][-1][1]))), 2)
+        (_, peer), = parse_attrs(messages[1][-1][1])
+        self.assertEqual(parse_peer(peer), update[1])
+
+
+class NetlinkBackendTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_syncconf_fallback(self):
+        syncconf = mock.AsyncMock(return_value=True)
+        with mock.patch.object(SubprocessBackend, 'syncconf', syncconf), \
+                mock.patch.object(netlink, 'sync_device') as sync_device:
+            # Invalid content is applied by the command
+            self.assertTrue(await NetlinkBackend().syncconf('wg0', '[Interface]\nPrivateKey = invalid\n'))
+        sync_device.assert_not_called()
+        syncconf.assert_awaited_once_with('wg0', '[Interface]\nPrivateKey = invalid\n')
@@ -0,0 +1,417 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from typing import Dict, List
+import unittest
+from unittest import mock
+
+from lib import keys
+from lib.wg import WGPeer
+from lib.wg_backend import FakeBackend, WGBackend, get_backend
+from model import server
+from model.interface import InterfaceSimple
+from model.server import WGServer
+from model.server_state import PEER_STATE_COLUMNS, PeerState
+
+SERVER_NAME = 'test'
+
+
+class FakeDB:
+
+    async def fetchval(self, query: str, *args):
+        return datetime.now(timezone.utc)
+
+    def add_query_logger(self, callback):
+        pass
+
+    def remove_query_logger(self, callback):
+        pass
+
+
+class FakePool:
+
+    def __init__(self, db: FakeDB):
+        self.db = db
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.db
+
+
+class FlushStatsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = WGServer('test', FakeBackend())
+        self.server.db_conn = SimpleNamespace(pool=FakePool(FakeDB()))
+        self.server.stats = {it: (1, None, 0, it, it) for it in range(12)}
+        self.server.stats_changed = set(range(12))
+        self.batches = []
+
+    async def upsert_many(self, db, rows):
+        if len(self.batches) == self.fail_batch:
+            raise ConnectionError('connection lost')
+        self.batches.append([it[0] for it in rows])
+
+    async def flush(self):
+        with mock.patch.object(server, 'WIREGUARD_STATS_BATCH', 5), \
+                mock.patch.object(server.PeerStatsDB, 'upsert_many', self.upsert_many):
+            await self.server.flush_stats()
+
+    async def test_batches(self):
+        self.fail_batch = None
+        await self.flush()
+        self.assertEqual([len(it) for it in self.batches], [5, 5, 2])
+        self.assertEqual(sorted(it for batch in self.batches for it in batch), list(range(12)))
+        self.assertEqual(self.server.stats_changed, set())
+
+    async def test_failed_batch(self):
+        self.fail_batch = 1
+        with self.assertRaises(ConnectionError):
+            await self.flush()
+        self.assertEqual(len(self.batches), 1)
+        # Not stored peers are stored next time
+        self.assertEqual(self.server.stats_changed, set(range(12)).difference(self.batches[0]))
+        self.fail_batch = None
+        await self.flush()
+        self.assertEqual(sorted(it for batch in self.batches for it in batch), list(range(12)))
+
+
+class ChangeLogGapTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = WGServer('test', FakeBackend())
+        self.server.db_conn = SimpleNamespace(pool=FakePool(FakeDB()))
+        self.committed = set()
+        self.read = []
+
+    async def get_ids(self, db, last_id: int, missing: List[int], limit: int) -> List[int]:
+        return sorted(it for it in self.committed if it > last_id or it in missing)[:limit]
+
+    async def gets(self, db, query: str, ids: List[int], *args, **kwargs) -> list:
+        self.read.append(ids)
+        # Records of other servers
+        return []
+
+    async def consume(self, timeout: float = 300):
+        with mock.patch.object(server, 'CHANGE_LOG_BATCH', 3), \
+                mock.patch.object(server, 'CHANGE_LOG_GAP_TIMEOUT', timeout), \
+                mock.patch.object(server, 'CHANGE_LOG_RETENTION', None), \
+                mock.patch.object(server.ChangeLogDB, 'get_ids', self.get_ids), \
+                mock.patch.object(server.ChangeLogDB, 'gets', self.gets):
+            task = asyncio.create_task(self.server.change_log_loop())
+            self.server.change_log_event.set()
+            await asyncio.sleep(0.01)
+            task.cancel()
+
+    async def test_late_commit(self):
+        self.committed = {1, 2, 4, 5, 7}
+        await self.consume()
+        self.assertEqual(self.read, [[1, 2, 4], [5, 7]])
+        self.assertEqual(set(self.server.change_log_missing), {3, 6})
+        # The transaction with the lower id is committed later
+        self.committed.add(3)
+        self.read = []
+        await self.consume()
+        self.assertEqual(self.read, [[3]])
+        self.assertEqual(set(self.server.change_log_missing), {6})
+        self.assertEqual(self.server.change_log_id, 7)
+
+    async def test_expired_gap(self):
+        self.committed = {1, 3}
+        await self.consume(timeout=0)
+        self.assertEqual(self.read, [[1, 3]])
+        # Rolled back transactions are not read forever
+        self.assertEqual(self.server.change_log_missing, {})
+
+
+class ServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    WGServer with the in-memory kernel (FakeBackend), rows of the database are kept in dicts.
+    """
+    settings = {
+        'WIREGUARD_EVENT_DELAY': 0.01,
+        'WIREGUARD_EVENT_MAX_DELAY': 0.05,
+        'WIREGUARD_RECONCILE_INTERVAL': 0,
+        'WIREGUARD_DRIFT_INTERVAL': 0,
+        'WIREGUARD_WRITE_DELAY': 0,
+        'WIREGUARD_STATS_INTERVAL': 0,
+    }
+
+    async def asyncSetUp(self):
+        folder = TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        self.interfaces: Dict[int, InterfaceSimple] = {}
+        self.peers: Dict[int, dict] = {}
+        patches = [
+            mock.patch.object(server, 'WIREGUARD_CONFIG_FOLDER', self.folder),
+            mock.patch.object(server.InterfaceSimpleDB, 'gets', self.get_interfaces),
+            mock.patch.object(server.InterfaceSimpleDB, 'get', self.get_interface),
+            mock.patch.object(server, 'load_peer_states', self.load_peer_states),
+        ] + [mock.patch.object(server, key, value) for key, value in self.settings.items()]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.backend = FakeBackend()
+        self.server = WGServer(SERVER_NAME, self.backend)
+        self.db_conn = SimpleNamespace(pool=FakePool(FakeDB()))
+
+    async def asyncTearDown(self):
+        await self.server.stop_server(self.db_conn)
+
+    async def get_interfaces(self, db, query: str, *args, **kwargs) -> List[InterfaceSimple]:
+        return [it for it in self.interfaces.values() if it.server_name == SERVER_NAME and it.enabled]
+
+    async def get_interface(self, db, query: str, iface_id: int, *args, **kwargs) -> InterfaceSimple:
+        if (iface := self.interfaces.get(iface_id)) and iface.server_name == SERVER_NAME and iface.enabled:
+            return iface
+
+    async def load_peer_states(self, db, interface_ids: List[int]) -> List[PeerState]:
+        return [
+            PeerState.from_row(it) for it in sorted(self.peers.values(), key=lambda it: it['id'])
+            if it['interface_id'] in interface_ids and it['enabled']
+        ]
+
+    def add_interface(self, iface_id: int = 1, name: str = 'wg0', **kwargs) -> InterfaceSimple:
+        self.interfaces[iface_id] = iface = InterfaceSimple(**{
+            'id': iface_id,
+            'server_name': SERVER_NAME,
+            'interface_name': name,
+            'private_key': keys.generate_private_key(),
+            'listen_port': 51820 + iface_id,
+            'address': f'10.{iface_id}.0.1/24',
+            # Columns are timestamptz
+            'updated_at': datetime.now(timezone.utc),
+            'created_at': datetime.now(timezone.utc),
+            **kwargs
+        })
+        return iface
+
+    def add_peer(self, peer_id: int, iface_id: int = 1, **kwargs) -> dict:
+        self.peers[peer_id] = row = {
+            'id': peer_id,
+            'interface_id': iface_id,
+            'name': f'peer{peer_id}',
+            'address': f'10.{iface_id}.{peer_id // 250}.{peer_id % 250 + 2}/32',
+            'public_key': keys.get_public_key(keys.generate_private_key()),
+            'preshared_key': None,
+            'allowed_ips': None,
+            'enabled': True,
+            **kwargs
+        }
+        return row
+
+    async def notify_peer(self, old: dict = None, new: dict = None):
+        """
+        Notification of the trigger, the new row is stored to the database.
+        """
+        if new:
+            self.peers[new['id']] = new
+        elif old:
+            self.peers.pop(old['id'], None)
+        payload = {
+            'old': {key: old[key] for key in PEER_STATE_COLUMNS + ('enabled',)} if old else None,
+            'new': new,
+        }
+        await self.server.notification_peer(None, 'client_peer', json.dumps(payload))
+
+    async def wait_events(self, timeout: float = 5):
+        async with asyncio.timeout(timeout):
+            while self.server.queue.workers:
+                await asyncio.sleep(0.01)
+
+    def kernel_peers(self, name: str = 'wg0') -> Dict[str, frozenset]:
+        return {key: it.allowed_ips for key, it in self.backend.interfaces[name].peers.items()}
+
+    def config_peers(self, name: str = 'wg0') -> List[str]:
+        content = (self.folder / f'{name}.conf').read_text()
+        return [line.split('=', 1)[1].strip() for line in content.splitlines() if line.startswith('PublicKey')]
+
+    def db_peers(self, iface_id: int = 1) -> Dict[str, frozenset]:
+        states = [
+            PeerState.from_row(it) for it in self.peers.values() if it['interface_id'] == iface_id and it['enabled']
+        ]
+        return {it.public_key: it.to_wg().allowed_ips for it in states}
+
+
+class WriteConfigTest(ServerTestCase):
+    settings = {**ServerTestCase.settings, 'WIREGUARD_WRITE_DELAY': 0.02}
+
+    async def test_writes_are_serialized(self):
+        self.add_interface()
+        for peer_id in range(1, 4):
+            self.add_peer(peer_id)
+        await self.server.start_server(self.db_conn)
+        writing, overlaps = set(), []
+        write_file = server.write_file
+
+        async def slow_write_file(file, content, mode):
+            if file in writing:
+                overlaps.append(file)
+            writing.add(file)
+            await asyncio.sleep(0.01)
+            try:
+                await write_file(file, content, mode)
+            finally:
+                writing.discard(file)
+
+        with mock.patch.object(server, 'write_file', slow_write_file):
+            for peer_id in range(4, 20):
+                await self.notify_peer(new=self.add_peer(peer_id))
+                # Writes of the stop and of the write-behind loop run at once
+                await asyncio.gather(self.server.write_configs(), asyncio.sleep(0.01))
+            await self.wait_events()
+            await asyncio.sleep(0.05)
+            await self.wait_events()
+        self.assertEqual(overlaps, [])
+        state = self.server.interfaces[1]
+        self.assertFalse(state.dirty)
+        self.assertEqual(len(self.config_peers()), 19)
+        self.assertEqual((self.folder / 'wg0.conf').read_text(), await state.render('interface_full.conf.j2'))
+        self.assertEqual(self.kernel_peers(), self.db_peers())
+
+
+class BackendTest(unittest.TestCase):
+
+    def test_abstract_backend(self):
+        class Incomplete(WGBackend):
+            async def interface_exists(self, iface: str) -> bool:
+                return True
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+        self.assertIsInstance(get_backend('fake'), FakeBackend)
+        with self.assertRaises(ValueError):
+            get_backend('unknown')
+
+
+class FakeBackendServerTest(ServerTestCase):
+
+    async def start(self, peers: int = 3):
+        self.add_interface()
+        for peer_id in range(1, peers + 1):
+            self.add_peer(peer_id)
+        await self.server.start_server(self.db_conn)
+
+    async def test_startup(self):
+        self.add_interface(2, 'wg1', address='10.2.0.1/24\nfd02::1/64', enabled=False)
+        await self.start()
+        self.assertEqual(list(self.backend.interfaces), ['wg0'])
+        self.assertEqual(self.backend.addresses['wg0'], {'10.1.0.1/24'})
+        self.assertEqual(self.backend.interfaces['wg0'].listen_port, 51821)
+        self.assertEqual(self.kernel_peers(), self.db_peers())
+        self.assertEqual(len(self.kernel_peers()), 3)
+        self.assertEqual(self.config_peers(), [it['public_key'] for it in self.peers.values()])
+
+    async def test_startup_of_running_interface(self):
+        await self.start()
+        await self.server.stop_server(self.db_conn)
+        # Changes of the kernel while the application did not run
+        stranger = keys.get_public_key(keys.generate_private_key())
+        device = self.backend.interfaces['wg0']
+        device.peers.pop(self.peers[1]['public_key'])
+        device.peers[stranger] = WGPeer(stranger)
+        self.server = WGServer('test', self.backend)
+        with mock.patch.object(self.backend, 'interface_up', wraps=self.backend.interface_up) as interface_up:
+            await self.server.start_server(self.db_conn)
+        # The configuration file is up to date, so only peers are repaired
+        interface_up.assert_not_called()
+        self.assertEqual(self.kernel_peers(), self.db_peers())
+
+    async def test_peer_events(self):
+        await self.start()
+        new = self.add_peer(4, allowed_ips='10.1.0.6/32\n192.168.10.0/24')
+        await self.notify_peer(new=new)
+        await self.wait_events()
+        self.assertEqual(self.kernel_peers()[new['public_key']], frozenset({'10.1.0.6/32', '192.168.10.0/24'}))
+        self.assertIn(new['public_key'], self.config_peers())
+        # Delete, disable and change of the key
+        await self.notify_peer(old=self.peers[1])
+        await self.notify_peer(old=self.peers[2], new={**self.peers[2], 'enabled': False})
+        replaced = {**self.peers[3], 'public_key': keys.get_public_key(keys.generate_private_key())}
+        await self.notify_peer(old=self.peers[3], new=replaced)
+        await self.wait_events()
+        self.assertEqual(self.kernel_peers(), self.db_peers())
+        self.assertEqual(sorted(self.config_peers()), sorted(self.db_peers()))
+        self.assertEqual(len(self.kernel_peers()), 2)
+
+    async def test_peer_of_other_interface(self):
+        await self.start()
+        await self.notify_peer(new=self.add_peer(10, iface_id=5))
+        await self.wait_events()
+        self.assertEqual(len(self.kernel_peers()), 3)
+
+    async def test_drift_repair(self):
+        await self.start()
+        device = self.backend.interfaces['wg0']
+        stranger = keys.get_public_key(keys.generate_private_key())
+        device.peers[stranger] = WGPeer(stranger)
+        device.peers.pop(self.peers[1]['public_key'])
+        changed = device.peers[self.peers[2]['public_key']]
+        device.peers[changed.public_key] = changed._replace(allowed_ips=frozenset({'10.9.9.9/32'}))
+        with mock.patch.object(self.backend, 'set_peers', wraps=self.backend.set_peers) as set_peers:
+            self.server.queue.put(1, ('drift', {}, {}))
+            await self.wait_events()
+            self.assertEqual(self.kernel_peers(), self.db_peers())
+            set_peers.assert_called_once()
+            # In sync, nothing is changed
+            self.server.queue.put(1, ('drift', {}, {}))
+            await self.wait_events()
+            set_peers.assert_called_once()
+
+    async def test_interface_update_without_restart(self):
+        await self.start()
+        iface = self.interfaces[1]
+        new = self.interfaces[1] = iface.model_copy(update={
+            'listen_port': 51900, 'address': '10.1.0.1/24\nfd01::1/64', 'mtu': 1380,
+            'updated_at': datetime.now(timezone.utc)
+        })
+        payload = {'old': iface.model_dump(mode='json'), 'new': new.model_dump(mode='json')}
+        with mock.patch.object(self.backend, 'interface_up', wraps=self.backend.interface_up) as interface_up:
+            await self.server.notification_interface(None, 'server_interface', json.dumps(payload))
+            await self.wait_events()
+        interface_up.assert_not_called()
+        self.assertEqual(self.backend.interfaces['wg0'].listen_port, 51900)
+        self.assertEqual(self.backend.addresses['wg0'], {'10.1.0.1/24', 'fd01::1/64'})
+        self.assertEqual(self.backend.mtu['wg0'], 1380)
+        self.assertEqual(self.kernel_peers(), self.db_peers())
+        self.assertIn('ListenPort = 51900', (self.folder / 'wg0.conf').read_text())
+
+    async def update_interface(self, **update):
+        iface = self.interfaces[1]
+        new = self.interfaces[1] = iface.model_copy(update={**update, 'updated_at': datetime.now(timezone.utc)})
+        payload = {'old': iface.model_dump(mode='json'), 'new': new.model_dump(mode='json')}
+        await self.server.notification_interface(None, 'server_interface', json.dumps(payload))
+        await self.wait_events()
+
+    async def remove_mtu(self) -> mock.Mock:
+        await self.start()
+        await self.update_interface(mtu=1380)
+        self.assertEqual(self.backend.mtu['wg0'], 1380)
+        with mock.patch.object(self.backend, 'interface_up', wraps=self.backend.interface_up) as interface_up:
+            await self.update_interface(mtu=None)
+        return interface_up
+
+    async def test_removed_mtu(self):
+        with mock.patch.object(server, 'WIREGUARD_DEFAULT_MTU', 1400):
+            interface_up = await self.remove_mtu()
+        interface_up.assert_not_called()
+        self.assertEqual(self.backend.mtu['wg0'], 1400)
+
+    async def test_removed_mtu_restart(self):
+        with mock.patch.object(server, 'WIREGUARD_DEFAULT_MTU', 0):
+            interface_up = await self.remove_mtu()
+        interface_up.assert_called_once()
+
+    async def test_interface_delete(self):
+        await self.start()
+        payload = {'old': self.interfaces.pop(1).model_dump(mode='json'), 'new': None}
+        await self.server.notification_interface(None, 'server_interface', json.dumps(payload))
+        await self.wait_events()
+        self.assertEqual(self.backend.interfaces, {})
+        self.assertFalse((self.folder / 'wg0.conf').exists())
+        self.assertEqual(self.server.interfaces, {})
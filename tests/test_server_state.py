@@ -0,0 +1,51 @@
+import unittest
+import jinja2
+
+from config import BASE_DIR
+from model.server_state import PEER_TEMPLATES, PeerState
+
+PUBLIC_KEY = 'xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg='
+PRESHARED_KEY = 'FpCyhws9cxwWoV4xELtfJvjJN+zQVRPISllRWgeopVE='
+
+
+class PeerStateTest(unittest.TestCase):
+
+    def setUp(self):
+        # Undefined attributes of the peer fail the rendering
+        self.environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(f'{BASE_DIR}templates/'), undefined=jinja2.StrictUndefined
+        )
+
+    def render(self, template: str, peer: PeerState) -> str:
+        return self.environment.get_template(template).render(peer=peer)
+
+    def test_peer_templates(self):
+        peers = [
+            PeerState(1, 1, 'peer', '10.0.0.2/32', PUBLIC_KEY),
+            PeerState(2, 1, 'peer', '10.0.0.3/32', PUBLIC_KEY, PRESHARED_KEY, '10.0.0.3/32\n192.168.0.0/24'),
+        ]
+        for template in PEER_TEMPLATES.values():
+            for peer in peers:
+                self.assertIn(f'PublicKey = {PUBLIC_KEY}', self.render(template, peer))
+
+    def test_update_block(self):
+        peer = PeerState(2, 1, 'peer', '10.0.0.3/32', PUBLIC_KEY, PRESHARED_KEY, '10.0.0.3/32\n192.168.0.0/24')
+        self.assertEqual(self.render('peer_update.conf.j2', peer).split('\n'), [
+            '',
+            '[Peer]',
+            f'PublicKey = {PUBLIC_KEY}',
+            'AllowedIPs = 10.0.0.3/32',
+            'AllowedIPs = 192.168.0.0/24',
+            f'PresharedKey = {PRESHARED_KEY}',
+            '',
+        ])
+
+    def test_to_wg(self):
+        peer = PeerState(2, 1, 'peer', '10.0.0.3/32', PUBLIC_KEY, '', '10.0.0.3/32\n192.168.0.0/24')
+        wg_peer = peer.to_wg()
+        self.assertEqual(wg_peer.public_key, PUBLIC_KEY)
+        self.assertIsNone(wg_peer.preshared_key)
+        self.assertEqual(wg_peer.persistent_keepalive, 0)
+        self.assertEqual(peer.get_allowed_ips(), '10.0.0.3/32,192.168.0.0/24')
+        # The record is immutable, the peer is built once
+        self.assertIs(peer.to_wg(), wg_peer)
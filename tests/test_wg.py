@@ -0,0 +1,184 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from lib import wg
+from lib.wg import WGInterface, WGPeer, diff_peers, normalize_allowed_ips, parse_config, parse_dump, parse_dump_all
+
+PRIVATE_KEY = 'yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk='
+PUBLIC_KEY = 'HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw='
+PEER1 = 'xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg='
+PEER2 = 'TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0='
+PSK = 'FpCyhws9cxwWoV4xELtfJvjJN+zQVRPISllRWgeopVE='
+
+DUMP = '\n'.join([
+    f'{PRIVATE_KEY}\t{PUBLIC_KEY}\t51820\toff',
+    f'{PEER1}\t{PSK}\t192.0.2.1:51820\t10.0.0.2/32,192.168.0.0/24\t1700000000\t1024\t2048\t25',
+    f'{PEER2}\t(none)\t(none)\t(none)\t0\t0\t0\toff',
+]) + '\n'
+
+
+class ParseDumpTest(unittest.TestCase):
+
+    def test_parse_dump(self):
+        iface = parse_dump(DUMP)
+        self.assertEqual(iface.private_key, PRIVATE_KEY)
+        self.assertEqual(iface.public_key, PUBLIC_KEY)
+        self.assertEqual(iface.listen_port, 51820)
+        self.assertEqual(iface.fwmark, 0)
+        self.assertEqual(list(iface.peers), [PEER1, PEER2])
+        self.assertEqual(iface.peers[PEER1], WGPeer(
+            public_key=PEER1,
+            preshared_key=PSK,
+            allowed_ips=frozenset({'10.0.0.2/32', '192.168.0.0/24'}),
+            persistent_keepalive=25,
+            endpoint='192.0.2.1:51820',
+            latest_handshake=1700000000,
+            transfer_rx=1024,
+            transfer_tx=2048,
+        ))
+        self.assertEqual(iface.peers[PEER2], WGPeer(public_key=PEER2))
+
+    def test_parse_dump_interface_fields(self):
+        cases = [
+            ('(none)\t(none)\t0\toff', (None, None, 0, 0)),
+            (f'{PRIVATE_KEY}\t{PUBLIC_KEY}\t51820\t0x10', (PRIVATE_KEY, PUBLIC_KEY, 51820, 16)),
+            (f'{PRIVATE_KEY}\t{PUBLIC_KEY}\t1\t51', (PRIVATE_KEY, PUBLIC_KEY, 1, 51)),
+        ]
+        for line, (private_key, public_key, listen_port, fwmark) in cases:
+            self.assertEqual(parse_dump(line), WGInterface(private_key, public_key, listen_port, fwmark, {}))
+
+    def test_parse_dump_errors(self):
+        cases = [
+            '',
+            f'{PRIVATE_KEY}\t{PUBLIC_KEY}\t51820',
+            f'{PRIVATE_KEY}\t{PUBLIC_KEY}\t51820\toff\n{PEER1}\t(none)\t(none)',
+            f'{PRIVATE_KEY}\t{PUBLIC_KEY}\tport\toff',
+        ]
+        for content in cases:
+            with self.assertRaises(ValueError):
+                parse_dump(content)
+
+    def test_parse_dump_all(self):
+        content = ''.join(f'wg0\t{line}\n' for line in DUMP.splitlines()) \
+            + f'wg1\t(none)\t(none)\t0\toff\nwg1\t{PEER1}\t(none)\t(none)\t10.1.0.2/32\t0\t0\t0\toff\n'
+        res = parse_dump_all(content)
+        self.assertEqual(list(res), ['wg0', 'wg1'])
+        self.assertEqual(res['wg0'], parse_dump(DUMP))
+        self.assertEqual(res['wg1'].peers[PEER1].allowed_ips, frozenset({'10.1.0.2/32'}))
+        self.assertIsNone(res['wg1'].private_key)
+        self.assertEqual(parse_dump_all(''), {})
+
+    def test_parse_dump_all_errors(self):
+        # A peer of unknown interface and unknown count of columns
+        for content in (f'wg0\t{PEER1}\t(none)\t(none)\t(none)\t0\t0\t0\toff', 'wg0\t1\t2'):
+            with self.assertRaises(ValueError):
+                parse_dump_all(content)
+
+
+class ParseConfigTest(unittest.TestCase):
+
+    def test_parse_config(self):
+        content = f'''
+[Interface]
+PrivateKey = {PRIVATE_KEY}
+ListenPort = 51820
+FwMark = 0x10
+Address = 10.0.0.1/24, fd00::1/64
+PostUp = iptables -A FORWARD -i %i -j ACCEPT
+
+[Peer]  # peer1 (10.0.0.2/32)
+PublicKey = {PEER1}
+AllowedIPs = 10.0.0.2
+AllowedIPs = 192.168.0.0/24
+PresharedKey = {PSK}
+PersistentKeepalive = 25
+
+[Peer]
+PublicKey = {PEER2}
+AllowedIPs = 10.0.0.3/32, 10.0.0.4/32
+PersistentKeepalive = off
+'''
+        iface, addresses = parse_config(content)
+        self.assertEqual(addresses, ['10.0.0.1/24', 'fd00::1/64'])
+        self.assertEqual(iface, WGInterface(
+            private_key=PRIVATE_KEY,
+            public_key=PUBLIC_KEY,
+            listen_port=51820,
+            fwmark=16,
+            peers={
+                PEER1: WGPeer(PEER1, PSK, frozenset({'10.0.0.2/32', '192.168.0.0/24'}), 25),
+                PEER2: WGPeer(PEER2, None, frozenset({'10.0.0.3/32', '10.0.0.4/32'}), 0),
+            }
+        ))
+
+    def test_parse_config_without_interface(self):
+        iface, addresses = parse_config(f'[Peer]\nPublicKey = {PEER1}\n')
+        self.assertEqual(iface, WGInterface(None, None, 0, 0, {PEER1: WGPeer(PEER1)}))
+        self.assertEqual(addresses, [])
+
+
+class DiffPeersTest(unittest.TestCase):
+
+    def test_identical(self):
+        actual = parse_dump(DUMP).peers
+        # Runtime values (endpoint, handshake, transfer) are ignored
+        desired = [
+            WGPeer(PEER1, PSK, normalize_allowed_ips('192.168.0.0/24\n10.0.0.2'), 25),
+            WGPeer(PEER2),
+        ]
+        self.assertEqual(diff_peers(desired, actual), ([], []))
+        self.assertEqual(diff_peers([], {}), ([], []))
+
+    def test_changes(self):
+        actual = parse_dump(DUMP).peers
+        changed = WGPeer(PEER1, None, normalize_allowed_ips('10.0.0.2'), 25)
+        new = WGPeer(PUBLIC_KEY, allowed_ips=normalize_allowed_ips('10.0.0.9'))
+        self.assertEqual(diff_peers([changed, new], actual), ([PEER2], [changed, new]))
+        self.assertEqual(diff_peers([], actual), ([PEER1, PEER2], []))
+        for peer in (WGPeer(PEER2, PSK), WGPeer(PEER2, persistent_keepalive=25),
+                     WGPeer(PEER2, allowed_ips=frozenset({'10.0.0.3/32'}))):
+            self.assertEqual(diff_peers([peer], {PEER2: actual[PEER2]}), ([], [peer]))
+
+
+class SetPeersTest(unittest.TestCase):
+
+    def test_chunks(self):
+        calls = []
+
+        async def cmd(*args, **kwargs):
+            calls.append(args)
+            # Files of preshared keys exist during the command
+            if 'preshared-key' in args and (psk_file := args[args.index('preshared-key') + 1]) != '/dev/null':
+                with open(psk_file) as fd:
+                    calls.append(fd.read())
+            return True
+
+        update = [
+            WGPeer(PEER1, PSK, frozenset({'192.168.0.0/24', '10.0.0.2/32'}), 25),
+            WGPeer(PEER2, None, frozenset({'10.0.0.3/32'})),
+        ]
+        with mock.patch.object(wg, 'cmd', cmd), mock.patch.object(wg, 'WIREGUARD_SET_CHUNK', 2):
+            self.assertTrue(asyncio.run(wg.set_peers('wg0', [PUBLIC_KEY], update)))
+        self.assertEqual(len(calls), 3)
+        first, psk, second = calls
+        self.assertEqual(first[:7], ('wg', 'set', 'wg0', 'peer', PUBLIC_KEY, 'remove', 'peer'))
+        self.assertEqual(first[7:10], (PEER1, 'allowed-ips', '10.0.0.2/32,192.168.0.0/24'))
+        self.assertEqual(first[10], 'preshared-key')
+        self.assertEqual(first[12:], ('persistent-keepalive', '25'))
+        self.assertEqual(psk, PSK)
+        self.assertEqual(second, ('wg', 'set', 'wg0', 'peer', PEER2, 'allowed-ips', '10.0.0.3/32',
+                                  'preshared-key', '/dev/null', 'persistent-keepalive', 'off'))
+
+    def test_failed_command(self):
+        calls = []
+
+        async def cmd(*args, **kwargs):
+            calls.append(args)
+            return None
+
+        remove = [PEER1, PEER2, PUBLIC_KEY]
+        with mock.patch.object(wg, 'cmd', cmd), mock.patch.object(wg, 'WIREGUARD_SET_CHUNK', 2):
+            self.assertFalse(asyncio.run(wg.set_peers('wg0', remove, [])))
+        # The next chunk is not applied after the failure
+        self.assertEqual(calls, [('wg', 'set', 'wg0', 'peer', PEER1, 'remove', 'peer', PEER2, 'remove')])